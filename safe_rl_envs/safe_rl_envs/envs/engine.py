@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import os
+import json
+import threading
 import gym
 import gym.spaces
 import numpy as np
@@ -8,7 +11,8 @@ from copy import deepcopy
 from collections import OrderedDict
 import mujoco
 import mujoco.viewer
-from safe_rl_envs.envs.world import World, Robot
+from safe_rl_envs.envs.world import World, Robot, BASE_DIR
+from safe_rl_envs.envs.layout_store import LayoutStore
 
 from .engine_utils import *
 
@@ -50,6 +54,24 @@ GROUP_GHOST3D = 3
 GROUP_ROBBER = 5
 GROUP_ROBBER3D = 5
 
+# Categories of geoms that incur contact costs, looked up by geom id.
+# Geoms are categorized by name prefix, the first matching prefix wins.
+GEOM_OTHER = 0
+GEOM_VASE = 1
+GEOM_PILLAR = 2
+GEOM_BUTTON = 3
+GEOM_GREMLIN = 4
+GEOM_GHOST = 5
+GEOM_GHOST3D = 6
+GEOM_CATEGORY_PREFIXES = [
+    ('vase', GEOM_VASE),
+    ('pillar', GEOM_PILLAR),
+    ('button', GEOM_BUTTON),
+    ('gremlin', GEOM_GREMLIN),
+    ('ghost3D', GEOM_GHOST3D),
+    ('ghost', GEOM_GHOST),
+]
+
 # Constant for origin of world
 ORIGIN_COORDINATES = np.zeros(3)
 
@@ -57,6 +79,30 @@ ORIGIN_COORDINATES = np.zeros(3)
 DEFAULT_WIDTH = 1920
 DEFAULT_HEIGHT = 1080
 
+# Version of the layouts saved in layout stores.  Bump it when a change to this file changes
+# which layouts reset() samples or accepts, so stale stores are not used.
+LAYOUT_STORE_VERSION = 1
+
+# Config keys that decide which layouts reset() samples and accepts, by name and by suffix
+# (observation, reward, rendering and speed options are left out of layout store keys)
+LAYOUT_CONFIG_KEYS = ('task', 'push_object', 'goal_3D', 'circle_radius', 'robot_base', 'robot_rot', 'arm_range',
+                      'arm_link_n', 'placements_extents', 'placements_margin', 'randomize_layout', 'floor_display_mode')
+LAYOUT_CONFIG_SUFFIXES = ('_num', '_placements', '_locations', '_keepout', '_size', '_height', '_density',
+                          '_sink', '_travel', '_z', '_z_range', '_mode', '_contact', '_cost', '_threshold')
+LAYOUT_CONFIG_EXCLUDE = ('render_', 'vision_', 'reward_', 'lidar_', 'spatial_index')
+
+# Episode attributes (and their types) saved by Engine.get_state(), besides the physics, goal, layout and random state
+EPISODE_STATE = (('steps', int), ('done', bool), ('buttons_timer', int), ('goal_button', int),
+                 ('last_dist_goal', np.float64), ('last_dist_box', np.float64), ('last_box_goal', np.float64),
+                 ('last_dist_robber', np.float64))
+
+# Episode attributes a prefetched episode brings along besides EPISODE_STATE: its seed, random state,
+# world and everything reset() derives from its layout
+PREFETCH_STATE = ('_seed', 'rs', 'world', 'world_config_dict', 'layout', 'reset_layout', 'layout_record',
+                  'mocap_offsets', 'mocap_dict', 'last_action', 'last_subtreecom', 'last_robot_com', '_cost',
+                  '_ghosts_rots', '_ghost3Ds_rots', '_ghost3Ds_z', '_gremlins_rots',
+                  '_robbers_rots', '_robber3Ds_rots', '_robber3Ds_z')
+
 class ResamplingError(AssertionError):
     ''' Raised when we fail to sample a valid distribution of objects or goals '''
     pass
@@ -109,6 +155,10 @@ class Engine(gym.Env, gym.utils.EzPickle):
 
         'placements_extents': [-2, -2, 2, 2],  # Placement limits (min X, min Y, max X, max Y)
         'placements_margin': 0.0,  # Additional margin added to keepout when placing objects
+        'placements_batch': True,  # Draw and check placement candidates in blocks (same layouts, faster)
+        'spatial_index': False,  # Cull lidar, cost and mocap repulsion with uniform grids over object XY positions
+        'spatial_index_cell': 0.5,  # Cell size of the spatial index grids
+        'spatial_index_lidar_threshold': 0.0,  # Exponential lidar readings below this may be dropped (0 keeps all)
 
         # Floor
         'floor_display_mode': False,  # In display mode, the visible part of the floor is cropped
@@ -123,7 +173,11 @@ class Engine(gym.Env, gym.utils.EzPickle):
 
         # Starting position distribution
         'randomize_layout': True,  # If false, set the random seed before layout to constant
+        'layout_store_dir': None,  # Directory of pre-sampled layouts by seed for reset() (see LayoutStore)
+        'prefetch_reset': False,  # If true, build the next episode in a background thread during this one
+        'build_precheck': True,  # If true, reject layouts with a clear starting cost before building the world
         'build_resample': True,  # If true, rejection sample from valid environments
+        'build_in_place': True,  # If true, reuse the compiled model when the scene structure is unchanged
         'continue_goal': True,  # If true, draw a new goal after achievement
         'terminate_resample_failure': True,  # If true, end episode when resampling fails,
                                              # otherwise, raise a python exception.
@@ -131,6 +185,8 @@ class Engine(gym.Env, gym.utils.EzPickle):
         # Observation flags - some of these require other flags to be on
         # By default, only robot sensor observations are enabled.
         'observation_flatten': True,  # Flatten observation into a vector
+        'observation_copy': True,  # Return a copy of the observation buffer, else the buffer itself
+        'observation_check': False,  # Debug mode: assert every observation is within the observation space
         'observe_sensors': True,  # Observe all sensor data from simulator
         'observe_goal_dist': False,  # Observe the distance to the goal
         'observe_goal_comp': False,  # Observe a compass vector to the goal
@@ -382,6 +438,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
         # For deterministic steps, set frameskip_binom_p = 1.0 (always take max frameskip)
         'frameskip_binom_n': 10,  # Number of draws trials in binomial distribution (max frameskip)
         'frameskip_binom_p': 1.0,  # Probability of trial return (controls distribution)
+        'mocaps_decimation': 1,  # Physics steps between updates of the mocap targets (gremlins, ghosts, robbers)
 
         # For robot arm
         'arm_link_n': 7,
@@ -411,7 +468,16 @@ class Engine(gym.Env, gym.utils.EzPickle):
 
         self.viewer = None
         self.renderer = None
+        self.renderer_cam, self.renderer_opt = self.renderer_setup()
+        self.renderers = {}  # Offscreen renderers by (world, name), see get_renderer()
         self.world = None
+        self.spatial_grids = {}  # Spatial index grids by name, see spatial_grid()
+        self.prefetch_engine = None  # Engine that builds the next episode in the background
+        self.prefetch_thread = None
+        self.prefetch_error = None  # Exception raised by the prefetched reset
+        self.layout_store = None
+        if self.layout_store_dir is not None:
+            self.layout_store = LayoutStore(self.layout_store_dir, self.layout_store_key())
         self.clear()
 
         self.seed(self._seed)
@@ -442,25 +508,25 @@ class Engine(gym.Env, gym.utils.EzPickle):
     @property
     def robot_pos(self):
         ''' Helper to get current robot position '''
-        return self.data.body('robot').xpos.copy()
+        return self.world.body_pos('robot')
     
     @property
     def arm_end_pos(self):
         ''' Helper to get current position of the end effector'''
-        return self.data.body('link_' + str(self.arm_link_n)).xpos.copy()
+        return self.world.body_pos('link_' + str(self.arm_link_n))
     
     @property
     def armpos(self):
         ''' Helper to get current positions of all links of the arm robots '''
-        return [self.data.body('link_' + str(i + 1)).xpos.copy() for i in range(self.arm_link_n)]
+        return self.data.xpos[self.body_ids('link_')]
 
     @property
     def goal_pos(self):
         ''' Helper to get goal position from layout '''
         if self.task in ['goal', 'push']:
-            return self.data.body('goal').xpos.copy()
+            return self.world.body_pos('goal')
         elif self.task == 'button':
-            return self.data.body(f'button{self.goal_button}').xpos.copy()
+            return self.world.body_pos(f'button{self.goal_button}')
         elif self.task == 'circle':
             return ORIGIN_COORDINATES
         elif self.task == 'none':
@@ -475,74 +541,91 @@ class Engine(gym.Env, gym.utils.EzPickle):
     @property
     def box_pos(self):
         ''' Helper to get the box position '''
-        return self.data.body('box').xpos.copy()
+        return self.world.body_pos('box')
 
     @property
     def buttons_pos(self):
-        ''' Helper to get the list of button positions '''
-        return [self.data.body(f'button{i}').xpos.copy() for i in range(self.buttons_num)]
+        ''' Helper to get the array of button positions '''
+        return self.data.xpos[self.body_ids('button')]
 
     @property
     def vases_pos(self):
-        ''' Helper to get the list of vase positions '''
-        return [self.data.body(f'vase{p}').xpos.copy() for p in range(self.vases_num)]
+        ''' Helper to get the array of vase positions '''
+        return self.data.xpos[self.body_ids('vase')]
 
     @property
     def gremlins_obj_pos(self):
         ''' Helper to get the current gremlin position '''
-        return [self.data.body(f'gremlin{i}obj').xpos.copy() for i in range(self.gremlins_num)]
+        return self.data.xpos[self.body_ids('gremlin', 'obj')]
     
     @property
     def ghosts_pos(self):
         ''' Helper to get the current ghost position '''
         if self.ghosts_contact:
-            return [self.data.body(f'ghost{i}obj').xpos.copy() for i in range(self.ghosts_num)]
+            return self.data.xpos[self.body_ids('ghost', 'obj')]
         else:
-            return [self.data.body(f'ghost{i}mocap').xpos.copy()  + np.r_[self.layout[f'ghost{i}'], 2e-2] for i in range(self.ghosts_num)]
+            return self.data.xpos[self.body_ids('ghost', 'mocap')] + self.mocap_offsets['ghost']
     
     @property
     def ghost3Ds_pos(self):
         ''' Helper to get the current 3D ghost position '''
         if self.ghost3Ds_contact:
-            return [self.data.body(f'ghost3D{i}obj').xpos.copy() for i in range(self.ghost3Ds_num)]
+            return self.data.xpos[self.body_ids('ghost3D', 'obj')]
         else:
-            return [self.data.body(f'ghost3D{i}mocap').xpos.copy() + np.r_[self.layout[f'ghost3D{i}'],self._ghost3Ds_z[i]] for i in range(self.ghost3Ds_num)]
+            return self.data.xpos[self.body_ids('ghost3D', 'mocap')] + self.mocap_offsets['ghost3D']
 
     @property
     def robbers_pos(self):
         ''' Helper to get the current robber position '''
         if self.robbers_contact:
-            return [self.data.body(f'robber{i}obj').xpos.copy() for i in range(self.robbers_num)]
+            return self.data.xpos[self.body_ids('robber', 'obj')]
         else:
-            return [self.data.body(f'robber{i}mocap').xpos.copy()  + np.r_[self.layout[f'robber{i}'], 2e-2] for i in range(self.robbers_num)]
+            return self.data.xpos[self.body_ids('robber', 'mocap')] + self.mocap_offsets['robber']
     
     @property
     def robber3Ds_pos(self):
         ''' Helper to get the current 3D robber position '''
         if self.robber3Ds_contact:
-            return [self.data.body(f'robber3D{i}obj').xpos.copy() for i in range(self.robber3Ds_num)]
+            return self.data.xpos[self.body_ids('robber3D', 'obj')]
         else:
-            return [self.data.body(f'robber3D{i}mocap').xpos.copy() + np.r_[self.layout[f'robber3D{i}'],self._robber3Ds_z[i]] for i in range(self.robber3Ds_num)]
+            return self.data.xpos[self.body_ids('robber3D', 'mocap')] + self.mocap_offsets['robber3D']
 
     @property
     def pillars_pos(self):
-        ''' Helper to get list of pillar positions '''
-        return [self.data.body(f'pillar{i}').xpos.copy() for i in range(self.pillars_num)]
+        ''' Helper to get array of pillar positions '''
+        return self.data.xpos[self.body_ids('pillar')]
 
     @property
     def hazards_pos(self):
         ''' Helper to get the hazards positions from layout '''
-        return [self.data.body(f'hazard{i}').xpos.copy() for i in range(self.hazards_num)]
+        return self.data.xpos[self.body_ids('hazard')]
     
     @property
     def hazard3Ds_pos(self):
         ''' Helper to get the hazards positions from layout '''
-        return [self.data.body(f'hazard3D{i}').xpos.copy() for i in range(self.hazard3Ds_num)]
+        return self.data.xpos[self.body_ids('hazard3D')]
 
     @property
     def walls_pos(self):
         ''' Helper to get the hazards positions from layout '''
-        return [self.data.body(f'wall{i}').xpos.copy() for i in range(self.walls_num)]
+        return self.data.xpos[self.body_ids('wall')]
+
+    def body_ids(self, prefix, suffix=''):
+        '''
+        Return an int array of the body ids of a numbered group of objects,
+        named f'{prefix}{i}{suffix}' for i < {prefix}s_num (or link_1 ... link_n for arms).
+
+        The ids are looked up once per model of each world (see World.model_constants).
+        '''
+        constants = self.world.model_constants
+        key = ('body_ids', prefix, suffix)
+        if key not in constants:
+            if prefix == 'link_':
+                names = [f'link_{i + 1}' for i in range(self.arm_link_n)]
+            else:
+                names = [f'{prefix}{i}{suffix}' for i in range(getattr(self, f'{prefix}s_num'))]
+            constants[key] = self.world.body_ids(names)
+        return constants[key]
 
     #----------------------------------------------------------------
     # Gym API
@@ -550,6 +633,41 @@ class Engine(gym.Env, gym.utils.EzPickle):
 
     def step(self, action):
         ''' Take a step and return observation, reward, done, and info '''
+        reward, info = self.advance(action)
+        return self.obs(), reward, self.done, info
+
+    def step_many(self, actions, mode='final'):
+        '''
+        Take up to T steps with actions (T, act_dim), stopping early when the episode is done.
+
+        mode='final' skips the observations of all but the last step, and returns
+        (final observation, total reward, total cost, costs (t,), done index).
+        mode='all' returns (observations, rewards (t,), costs (t,), done index, infos).
+        The done index is the step that ended the episode, or -1.
+        '''
+        assert mode in ('final', 'all'), f'Invalid step_many mode {mode}'
+        rewards, costs, observations, infos = [], [], [], []
+        done_index = -1
+        for t, action in enumerate(actions):
+            reward, info = self.advance(action)
+            rewards.append(reward)
+            costs.append(info.get('cost', info.get('cost_exception', 0.0)))
+            if mode == 'all':
+                obs = self.obs()
+                observations.append(obs if self.observation_copy else deepcopy(obs))
+                infos.append(info)
+            if self.done:
+                done_index = t
+                break
+        costs = np.array(costs, dtype=np.float64)
+        if mode == 'final':
+            return self.obs(), sum(rewards), sum(costs.tolist()), costs, done_index
+        if self.observation_flatten:
+            observations = np.array(observations).reshape((-1,) + self.observation_space.shape)
+        return observations, np.array(rewards, dtype=np.float64), costs, done_index, infos
+
+    def advance(self, action):
+        ''' Take a step without building the observation, and return reward and info '''
         action = np.array(action, copy=False)  # Cast to ndarray
         assert not self.done, 'Environment must be reset before stepping'
 
@@ -558,25 +676,14 @@ class Engine(gym.Env, gym.utils.EzPickle):
         # Set action
         if "drone" in self.robot_base:
             action = np.clip(action, -1.0, 1.0)
-            mass = self.model.body_mass[self.data.body('robot').id]
-            mass += self.model.body_mass[self.data.body('p1').id]
-            mass += self.model.body_mass[self.data.body('p2').id]
-            mass += self.model.body_mass[self.data.body('p3').id]
-            mass += self.model.body_mass[self.data.body('p4').id]
-            robot_pos = self.world.robot_pos()
-            R = self.world.robot_mat()
+            propeller_ids, mass = self.drone_propellers()
             f = mass * 9.81
-            if (robot_pos[2] > 3):
+            if (self.world.robot_pos()[2] > 3):
                 f = 0
-
-            torque = [0, 0, 0]
-            for i in range(4):
-                propeller = 'p' + str(i + 1)
-                force = [0, 0, f/4 + action[i]*1e-1]
-                force = np.array(force).reshape(3,1)
-                force = R@force
-                force = [force[i,0] for i in range(3)]
-                self.data.xfrc_applied[self.data.body(propeller).id,:] = force + torque
+            # Each propeller pushes along the z axis of the robot frame, without torque
+            thrust = f/4 + action[:4]*1e-1
+            self.data.xfrc_applied[propeller_ids, :3] = thrust[:, None] * self.world.robot_mat()[:, 2]
+            self.data.xfrc_applied[propeller_ids, 3:] = 0
         else:
             action_range = self.model.actuator_ctrlrange
             # action_scale = action_range[:,1] - action_range[:, 0]
@@ -586,20 +693,18 @@ class Engine(gym.Env, gym.utils.EzPickle):
 
         # Simulate physics forward
         exception = False
-        for _ in range(self.rs.binomial(self.frameskip_binom_n, self.frameskip_binom_p)):
-            try:
-                self.set_mocaps()
-                mujoco.mj_step(self.model, self.data)  # Physics simulation step
-            except:
-                print('MujocoException')
-                exception = True
-                break
+        try:
+            self.simulate(self.rs.binomial(self.frameskip_binom_n, self.frameskip_binom_p))
+        except:
+            print('MujocoException')
+            exception = True
+        self.world.mark_dirty()
         if exception:
             self.done = True
             reward = self.reward_exception
             info['cost_exception'] = 1.0
         else:
-            mujoco.mj_forward(self.model, self.data)  # Needed to get sensor readings correct!
+            self.world.forward()  # Needed to get sensor readings correct!
 
             # Reward processing
             reward = self.reward()
@@ -637,10 +742,19 @@ class Engine(gym.Env, gym.utils.EzPickle):
         if self.steps >= self.num_steps:
             self.done = True  # Maximum number of steps in an episode reached
 
-        return self.obs(), reward, self.done, info
+        return reward, info
 
     def reset(self):
         ''' Reset the physics simulation and return observation '''
+        if not (self.prefetch_reset and self.swap_prefetched()):
+            self.reset_episode()
+        if self.prefetch_reset:
+            self.prefetch()
+        # Return an observation
+        return self.obs()
+
+    def reset_episode(self):
+        ''' Start the episode of the next seed: sample a layout without starting cost and build its world '''
         self._seed += 1  # Increment seed
         self.rs = np.random.RandomState(self._seed)
         self.done = False
@@ -648,23 +762,152 @@ class Engine(gym.Env, gym.utils.EzPickle):
         # Set the button timer to zero (so button is immediately visible)
         self.buttons_timer = 0
         self.last_dist_robber = -1
+        record = None if self.layout_store is None else self.layout_store.get(self._seed)
+        cost = {'cost': None}
         for _ in range(100):
             self.clear()
-            self.build()
+            if not self.build(record):
+                continue  # Rejected from the layout alone
+            # Save the layout at reset (vase displacement costs are measured from it)
+            self.reset_layout = deepcopy(self.layout)
             cost = self.cost()
             if cost['cost'] == 0:
                 break
+            record = None
 
         assert cost['cost'] == 0, f'World has starting cost! {cost}'
 
-        # Save the layout at reset
-        self.reset_layout = deepcopy(self.layout)
-
         # Reset stateful parts of the environment
         self.first_reset = False  # Built our first world successfully
         self.reset_viewer = True
-        # Return an observation
-        return self.obs()
+
+    def prefetch(self):
+        '''
+        Start building the episode of the next seed in the prefetch engine, a copy of this
+        engine, in a background thread.  MuJoCo releases the GIL while it compiles and simulates, so
+        most of the work overlaps with this episode.
+        '''
+        if self.prefetch_engine is None:
+            self.prefetch_engine = Engine(dict(self.config, prefetch_reset=False))
+        self.prefetch_engine._seed = self._seed
+        self.prefetch_thread = threading.Thread(target=self.prefetch_run, daemon=True)
+        self.prefetch_thread.start()
+
+    def prefetch_run(self):
+        ''' Body of the prefetch thread '''
+        try:
+            self.prefetch_engine.reset_episode()
+        except Exception as e:
+            self.prefetch_error = e
+
+    def swap_prefetched(self):
+        '''
+        Wait for the prefetch thread and swap its episode in.  Returns False if
+        nothing was prefetched for the next seed.
+
+        Only the episode state (EPISODE_STATE and PREFETCH_STATE) is exchanged; the old
+        episode goes to the prefetch engine, which builds the next one in its world.
+        '''
+        if self.prefetch_thread is None:
+            return False
+        self.prefetch_thread.join()
+        self.prefetch_thread = None
+        error, self.prefetch_error = self.prefetch_error, None
+        if error is not None:
+            raise error
+        other = self.prefetch_engine
+        if other._seed != self._seed + 1:
+            return False  # The seed was changed since the prefetch started
+        for name in PREFETCH_STATE + tuple(name for name, _ in EPISODE_STATE):
+            if hasattr(other, name):  # Some are only set for some tasks or options
+                mine, theirs = getattr(self, name, None), getattr(other, name)
+                setattr(self, name, theirs)
+                setattr(other, name, mine)
+        self.reset_viewer = True
+        return True
+
+    def close(self):
+        ''' Close the prefetch engine (after its running prefetch), the viewer and the renderers '''
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+        if self.prefetch_engine is not None:
+            self.prefetch_engine.close()
+            self.prefetch_engine = None
+        if self.viewer is not None:
+            self.viewer.close()
+            self.viewer = None
+        self.close_renderers()
+
+    def close_renderers(self):
+        ''' Free the GL contexts of the offscreen renderers '''
+        for renderer in self.renderers.values():
+            renderer.close()
+        self.renderers = {}
+        self.renderer = None
+
+    def get_renderer(self, name, width, height):
+        '''
+        Return the offscreen renderer called name, drawing width x height frames.
+
+        Every world keeps one renderer per name, reused across frames and resets while
+        the world relocates bodies in its model.  It is replaced when the world compiles
+        or loads a new model, or when a frame of another size is asked for.
+        '''
+        key = (self.world, name)
+        renderer = self.renderers.get(key)
+        if renderer is not None and (renderer.model is not self.model
+                                     or (renderer.width, renderer.height) != (width, height)):
+            renderer.close()
+            renderer = None
+        if renderer is None:
+            # The offscreen buffer of the model must fit the frame
+            self.model.vis.global_.offwidth = max(self.model.vis.global_.offwidth, width)
+            self.model.vis.global_.offheight = max(self.model.vis.global_.offheight, height)
+            renderer = self.renderers[key] = mujoco.Renderer(self.model, width=width, height=height)
+        return renderer
+
+    def get_state(self):
+        '''
+        Return the state of the current episode as a flat float64 array: the episode seed,
+        the physics (see World.get_state()), the goal position, the layout, the counters and
+        last distances in EPISODE_STATE, and the random state.
+
+        set_state() restores it without building anything, so many short rollouts can branch
+        from one state.
+        '''
+        physics = self.world.get_state()
+        goal = self.model.body_pos[self.model.body('goal').id] if 'goal' in self.world_config_dict['geoms'] else np.zeros(3)
+        layout = [np.ravel(self.layout[name]) for name in sorted(self.layout)]
+        episode = [getattr(self, name, 0) for name, _ in EPISODE_STATE] + list(getattr(self, 'last_robot_com', np.zeros(3)))
+        _, keys, pos, has_gauss, cached_gaussian = self.rs.get_state()
+        return np.concatenate([[self._seed, len(physics)], physics, goal, *layout, episode,
+                               keys, [pos, has_gauss, cached_gaussian]])
+
+    def set_state(self, state):
+        ''' Restore the episode to a state from get_state(), which must be from the same episode (seed) '''
+        if state[0] != self._seed:
+            raise ValueError(f'State is from the episode with seed {state[0]:.0f}, not {self._seed}')
+        i = int(state[1]) + 2
+        self.world.set_state(state[2:i])
+        if 'goal' in self.world_config_dict['geoms']:
+            self.model.body_pos[self.model.body('goal').id] = state[i:i + 3]
+            self.world_config_dict['geoms']['goal']['pos'] = state[i:i + 3].copy()
+        i += 3
+        for name in sorted(self.layout):
+            size = np.size(self.layout[name])
+            self.layout[name] = state[i:i + size].copy()
+            i += size
+        for (name, cast), value in zip(EPISODE_STATE, state[i:]):
+            if hasattr(self, name):
+                setattr(self, name, cast(value))
+        i += len(EPISODE_STATE)
+        if hasattr(self, 'last_robot_com'):
+            self.last_robot_com = state[i:i + 3].copy()
+        i += 3
+        self.rs.set_state(('MT19937', state[i:i + 624].astype(np.uint32), int(state[i + 624]),
+                           int(state[i + 625]), float(state[i + 626])))
+        self.world.forward()  # Mocap control in step() reads body positions before stepping
 
     def render(self,
                mode='human', 
@@ -673,29 +916,19 @@ class Engine(gym.Env, gym.utils.EzPickle):
                height=DEFAULT_HEIGHT,
                ):
         ''' Render the environment to the screen '''
-        model = self.model
-        data = self.data
-        self.model.vis.global_.offwidth = width
-        self.model.vis.global_.offheight = height
         if self.viewer is not None and self.reset_viewer:
+            # The passive viewer is tied to the data of the last episode
             self.viewer.close()
             self.viewer = None
-            self.renderer = None
-            self.reset_viewer = False
-        if self.viewer is None or mode!=self._old_render_mode:
-            # Set camera if specified
-            if mode == 'human':
-                self.viewer = mujoco.viewer.launch_passive(model, data)
-                self.viewer_setup()  
-            
-            self.renderer =  mujoco.Renderer(model, width = width, height = height)
-            self.renderer_cam, self.renderer_opt = self.renderer_setup()
-            self._old_render_mode = mode
-        mujoco.mj_step(model, data)
+        self.reset_viewer = False
+        if mode == 'human' and self.viewer is None:
+            self.viewer = mujoco.viewer.launch_passive(self.model, self.data)
+            self.viewer_setup()
+        self.renderer = self.get_renderer('frame', width, height)
+        self.world.forward()  # Draw the current state without advancing the physics
         if self.viewer:
             self.viewer.user_scn.ngeom = 0
-        self.renderer._scene.ngeom = 0
-        self.renderer.update_scene(data, self.renderer_cam, self.renderer_opt)
+        self.renderer.update_scene(self.data, self.renderer_cam, self.renderer_opt)
 
         # Lidar markers
         if self.render_lidar_markers:
@@ -886,6 +1119,17 @@ class Engine(gym.Env, gym.utils.EzPickle):
         else:
             self.observation_space = gym.spaces.Dict(obs_space_dict)
 
+        # Every component has a fixed slice of one float32 buffer, in flattened (sorted key) order
+        self.obs_buffer = np.zeros(sum([np.prod(i.shape) for i in obs_space_dict.values()]), dtype=np.float32)
+        self.obs_views = OrderedDict()
+        self.obs_offsets = {}  # Index of the first element of every component in self.obs_buffer
+        offset = 0
+        for k in sorted(obs_space_dict.keys()):
+            k_size = int(np.prod(obs_space_dict[k].shape))
+            self.obs_views[k] = self.obs_buffer[offset:offset + k_size].reshape(obs_space_dict[k].shape)
+            self.obs_offsets[k] = offset
+            offset += k_size
+
     def placements_from_location(self, location, keepout):
         ''' Helper to get a placements list from a given location and keepout '''
         x, y = location
@@ -972,45 +1216,127 @@ class Engine(gym.Env, gym.utils.EzPickle):
         if not self.randomize_layout:
             self.rs = np.random.RandomState(0)
 
-        for _ in range(10000):
-            if self.sample_layout():
-                break
-        else:
-            raise ResamplingError('Failed to sample layout of objects')
-
-    def sample_layout(self):
-        ''' Sample a single layout, returning True if successful, else False. '''
+        stream = UniformStream(self.rs) if self.placements_batch else None
+        try:
+            for _ in range(10000):
+                if self.sample_layout(stream):
+                    break
+            else:
+                raise ResamplingError('Failed to sample layout of objects')
+        finally:
+            if stream is not None:
+                stream.sync()
 
-        def placement_is_valid(xy, layout):
-            for other_name, other_xy in layout.items():
-                other_keepout = self.placements[other_name][1]
-                dist = np.sqrt(np.sum(np.square(xy - other_xy)))
-                if dist < other_keepout + self.placements_margin + keepout:
-                    return False
-            return True
+    def layout_store_key(self):
+        '''
+        Everything that decides which layouts reset() accepts: the store version, MuJoCo,
+        the robot and the placement, scene and cost keys of the config (see LAYOUT_CONFIG_KEYS).
+        '''
+        config = {k: v for k, v in self.config.items()
+                  if (k in LAYOUT_CONFIG_KEYS or k.startswith('constrain_') or k.endswith(LAYOUT_CONFIG_SUFFIXES))
+                  and not k.startswith(LAYOUT_CONFIG_EXCLUDE)}
+        with open(os.path.join(BASE_DIR, self.robot_base)) as f:
+            robot_xml = f.read()
+        # Arrays are written in full (repr() would abbreviate long ones)
+        config = json.dumps(config, sort_keys=True, default=lambda v: v.tolist())
+        return '\n'.join([f'v{LAYOUT_STORE_VERSION}', mujoco.__version__, robot_xml, config])
+
+    def fill_layout_store(self, seeds):
+        '''
+        Sample the layouts reset() finds for seeds and save them to the layout store.
+        The environment is reset once for every seed that is not stored yet.
+        '''
+        assert self.layout_store is not None, 'Set layout_store_dir to fill a layout store'
+        for seed in seeds:
+            if self.layout_store.get(seed) is None:
+                self._seed = seed - 1  # reset_episode() increments the seed first
+                self.reset_episode()
+                self.layout_store.put(seed, *self.layout_record)
+        self.layout_store.save()
+
+    def sample_layout(self, stream=None):
+        '''
+        Sample a single layout, returning True if successful, else False.
 
+        Each object gets up to 100 draws, and a draw is valid if it keeps out of the way
+        of every object placed before it.  With a UniformStream, objects that have a single
+        placement rectangle draw their candidates in blocks (see draw_placements_batch),
+        which consumes the random stream the same way and finds the same layout.
+        '''
         layout = {}
-        for name, (placements, keepout) in self.placements.items():
-            conflicted = True
-            for _ in range(100):
-                xy = self.draw_placement(placements, keepout)
-                if 'arm' in self.robot_base and 'hazard3D' in name and np.sqrt(np.sum(np.square(xy))) > self.arm_range:
-                    continue
-                if placement_is_valid(xy, layout):
-                    conflicted = False
-                    break
-            if conflicted:
+        placed = np.zeros((len(self.placements), 2))  # Positions of the objects placed so far
+        bounds = np.zeros(len(self.placements))  # Their keepouts plus the placements margin
+        for i, (name, (placements, keepout)) in enumerate(self.placements.items()):
+            arm_range = self.arm_range if 'arm' in self.robot_base and 'hazard3D' in name else None
+            rects = self.placement_rects(placements, keepout)
+            if stream is not None and len(rects) == 1:
+                xy = self.draw_placements_batch(stream, rects[0], keepout, placed[:i], bounds[:i], arm_range)
+            else:
+                if stream is not None:
+                    stream.sync()
+                xy = None
+                for _ in range(100):
+                    candidate = self.draw_placement(placements, keepout)
+                    if arm_range is not None and np.sqrt(np.sum(np.square(candidate))) > arm_range:
+                        continue
+                    if not np.any(row_norm(candidate - placed[:i]) < bounds[:i] + keepout):
+                        xy = candidate
+                        break
+            if xy is None:
                 return False
             layout[name] = xy
-        
+            placed[i] = xy
+            bounds[i] = keepout + self.placements_margin
+
         self.layout = layout
         return True
 
+    def draw_placements_batch(self, stream, rect, keepout, placed, bounds, arm_range=None, attempts=100):
+        '''
+        Draw up to attempts (x,y) locations uniformly in rect from a UniformStream, returning
+        the first one that is within arm_range (if given) and no closer to the placed
+        positions (M,2) than bounds (M,) + keepout, or None if there is none.
+
+        Candidates are drawn and checked in blocks of growing size.  Only the samples up
+        to the returned candidate are consumed, like drawing them one at a time would.
+        '''
+        low = np.array(rect[:2])
+        high = np.array(rect[2:])
+        drawn = 0
+        block = 4
+        while drawn < attempts:
+            n = min(block, attempts - drawn)
+            xy = low + (high - low) * stream.peek(2 * n).reshape(n, 2)
+            valid = ~np.any(row_norm(xy[:, None] - placed) < bounds + keepout, axis=1)
+            if arm_range is not None:
+                valid &= ~(row_norm(xy) > arm_range)
+            if valid.any():
+                first = np.argmax(valid)
+                stream.skip(2 * (first + 1))
+                return xy[first]
+            stream.skip(2 * n)
+            drawn += n
+            block *= 2
+        return None
+
     def constrain_placement(self, placement, keepout):
         ''' Helper function to constrain a single placement by the keepout radius '''
         xmin, ymin, xmax, ymax = placement
         return (xmin + keepout, ymin + keepout, xmax - keepout, ymax - keepout)
 
+    def placement_rects(self, placements, keepout):
+        ''' The placement rectangles (xmin, ymin, xmax, ymax) that still have room for keepout '''
+        if placements is None:
+            return [self.constrain_placement(self.placements_extents, keepout)]
+        constrained = []
+        for placement in placements:
+            xmin, ymin, xmax, ymax = self.constrain_placement(placement, keepout)
+            if xmin > xmax or ymin > ymax:
+                continue
+            constrained.append((xmin, ymin, xmax, ymax))
+        assert len(constrained), 'Failed to find any placements with satisfy keepout'
+        return constrained
+
     def draw_placement(self, placements, keepout):
         ''' 
         Sample an (x,y) location, based on potential placement areas.
@@ -1032,23 +1358,14 @@ class Engine(gym.Env, gym.utils.EzPickle):
         randomly draw a uniform point within the selected rectangle.
 
         '''
-        if placements is None:
-            choice = self.constrain_placement(self.placements_extents, keepout)
+        constrained = self.placement_rects(placements, keepout)
+        if len(constrained) == 1:
+            choice = constrained[0]
         else:
             # Draw from placements according to placeable area
-            constrained = []
-            for placement in placements:
-                xmin, ymin, xmax, ymax = self.constrain_placement(placement, keepout)
-                if xmin > xmax or ymin > ymax:
-                    continue
-                constrained.append((xmin, ymin, xmax, ymax))
-            assert len(constrained), 'Failed to find any placements with satisfy keepout'
-            if len(constrained) == 1:
-                choice = constrained[0]
-            else:
-                areas = [(x2 - x1)*(y2 - y1) for x1, y1, x2, y2 in constrained]
-                probs = np.array(areas) / np.sum(areas)
-                choice = constrained[self.rs.choice(len(constrained), p=probs)]
+            areas = [(x2 - x1)*(y2 - y1) for x1, y1, x2, y2 in constrained]
+            probs = np.array(areas) / np.sum(areas)
+            choice = constrained[self.rs.choice(len(constrained), p=probs)]
         xmin, ymin, xmax, ymax = choice
         return np.array([self.rs.uniform(xmin, xmax), self.rs.uniform(ymin, ymax)])
 
@@ -1074,6 +1391,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
         #if not self.observe_vision:
         #    world_config['render_context'] = -1  # Hijack this so we don't create context
         world_config['observe_vision'] = self.observe_vision
+        world_config['build_in_place'] = self.build_in_place
 
         # Extra objects to add to the scene
         world_config['objects'] = {}
@@ -1124,7 +1442,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
             for i in range(self.ghost3Ds_num):
                 name = f'ghost3D{i}obj'
                 self._ghost3Ds_rots[i] = self.random_rot()
-                self._ghost3Ds_z[i] = np.random.uniform(self.ghost3Ds_z_range[0], self.ghost3Ds_z_range[1])
+                self._ghost3Ds_z[i] = self.rs.uniform(self.ghost3Ds_z_range[0], self.ghost3Ds_z_range[1])
                 if self.ghost3Ds_contact:
                     object = {'name': name,
                             'size': [self.ghost3Ds_size],
@@ -1156,7 +1474,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
             for i in range(self.robber3Ds_num):
                 name = f'robber3D{i}obj'
                 self._robber3Ds_rots[i] = self.random_rot()
-                self._robber3Ds_z[i] = np.random.uniform(self.robber3Ds_z_range[0], self.robber3Ds_z_range[1])
+                self._robber3Ds_z[i] = self.rs.uniform(self.robber3Ds_z_range[0], self.robber3Ds_z_range[1])
                 if self.robber3Ds_contact:
                     object = {'name': name,
                             'size': [self.robber3Ds_size],
@@ -1202,7 +1520,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
                     'group': GROUP_GOAL,
                     'rgba': COLOR_GOAL * [1, 1, 1, 0.25]}  # transparent
             else:
-                goal_pos = np.r_[self.layout['goal'], np.random.uniform(self.goal_z_range[0], self.goal_z_range[1])]
+                goal_pos = np.r_[self.layout['goal'], self.rs.uniform(self.goal_z_range[0], self.goal_z_range[1])]
                 geom = {'name': 'goal',
                     'size': [self.goal_size],
                     'pos': goal_pos,
@@ -1232,7 +1550,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
                 if i < len(self.hazard3Ds_z):
                     pos_z = self.hazard3Ds_z[i]
                 else:
-                    pos_z = np.random.uniform(self.hazard3Ds_z_range[0], self.hazard3Ds_z_range[1])
+                    pos_z = self.rs.uniform(self.hazard3Ds_z_range[0], self.hazard3Ds_z_range[1])
                 pos = np.r_[self.layout[name], pos_z]
 
                 geom = {'name': name,
@@ -1390,31 +1708,23 @@ class Engine(gym.Env, gym.utils.EzPickle):
         last_goal_pos = self.goal_pos
         if self.goal_mode == 'track':    
             if self.goal_3D == False:
-                vec = np.random.normal(size=2)
+                vec = self.rs.normal(size=2)
                 vec_norm = vec / np.linalg.norm(vec)
                 direction = np.r_[vec_norm, 0]     
             else:
-                vec = np.random.normal(size=3)
+                vec = self.rs.normal(size=3)
                 vec_norm = vec / np.linalg.norm(vec)
                 direction = vec_norm  
             goal_xyz = last_goal_pos + self.goal_velocity* direction
-            for other_name, other_xy in self.layout.items():
-                other_keepout = self.placements[other_name][1]
-                dist = np.sqrt(np.sum(np.square(goal_xyz[:2] - other_xy)))
-                if dist < other_keepout + self.placements_margin + keepout:
-                    return False
+            if not self.goal_xy_is_valid(goal_xyz[:2], keepout):
+                return False
             goal_pos = goal_xyz
         else:  
             goal_xy = self.draw_placement(placements, keepout)
-            for other_name, other_xy in self.layout.items():
-                other_keepout = self.placements[other_name][1]
-                dist = np.sqrt(np.sum(np.square(goal_xy - other_xy)))
-                if dist < other_keepout + self.placements_margin + keepout:
-                    return False
+            if not self.goal_xy_is_valid(goal_xy, keepout):
+                return False
             goal_pos = np.r_[goal_xy, last_goal_pos[2]]
 
-        if np.sqrt(np.sum(np.square(goal_pos[:2]))) > self.goal_travel:
-            return False
         if 'arm' in self.robot_base:
             end_pos = self.arm_end_pos
             if np.sqrt(np.sum(np.square(goal_pos - end_pos))) < self.goal_size:
@@ -1424,6 +1734,15 @@ class Engine(gym.Env, gym.utils.EzPickle):
         self.layout['goal'] = goal_pos
         return True
 
+    def goal_xy_is_valid(self, goal_xy, keepout):
+        ''' Whether a goal at goal_xy keeps out of the way of the layout and within goal_travel '''
+        for other_name, other_xy in self.layout.items():
+            other_keepout = self.placements[other_name][1]
+            dist = np.sqrt(np.sum(np.square(goal_xy - other_xy)))
+            if dist < other_keepout + self.placements_margin + keepout:
+                return False
+        return not np.sqrt(np.sum(np.square(goal_xy))) > self.goal_travel
+
     def build_goal_position(self):
         ''' Build a new goal position, maybe with resampling due to hazards '''
         # Resample until goal is compatible with layout
@@ -1438,21 +1757,46 @@ class Engine(gym.Env, gym.utils.EzPickle):
         self.world_config_dict['geoms']['goal']['pos'] = self.layout['goal']
         goal_body_id = self.model.body('goal').id
         self.model.body_pos[goal_body_id] = self.layout['goal']
-        mujoco.mj_forward(self.model, self.data)
+        self.world.mark_dirty()
+        self.world.forward()
         self.layout['goal'] = self.layout['goal'][:2]
 
+    def build_mocap_offsets(self):
+        ''' Offsets from the mocap bodies of non-contact ghosts and robbers to their current positions '''
+        self.mocap_offsets = {}
+        for prefix, num in [('ghost', self.ghosts_num), ('robber', self.robbers_num)]:
+            self.mocap_offsets[prefix] = np.array([np.r_[self.layout[f'{prefix}{i}'], 2e-2]
+                                                   for i in range(num)]).reshape(-1, 3)
+        self.mocap_offsets['ghost3D'] = np.array([np.r_[self.layout[f'ghost3D{i}'], self._ghost3Ds_z[i]]
+                                                  for i in range(self.ghost3Ds_num)]).reshape(-1, 3)
+        self.mocap_offsets['robber3D'] = np.array([np.r_[self.layout[f'robber3D{i}'], self._robber3Ds_z[i]]
+                                                   for i in range(self.robber3Ds_num)]).reshape(-1, 3)
+
     def build_goal_button(self):
         ''' Pick a new goal button, maybe with resampling due to hazards '''
         self.goal_button = self.rs.choice(self.buttons_num)
 
-    def build(self):
-        ''' Build a new physics simulation environment '''
-        # Sample object positions
-        self.build_layout()
+    def build(self, record=None):
+        '''
+        Build a new physics simulation environment, from a stored (layout, random state) if given.
+        Returns False without building the world if the layout has a clear starting cost.
+        '''
+        if record is None:
+            # Sample object positions
+            self.build_layout()
+            if self.layout_store is not None:
+                self.layout_record = ({name: xy.copy() for name, xy in self.layout.items()}, self.rs.get_state())
+        else:
+            self.layout, state = record
+            self.rs.set_state(state)
 
         # Build the underlying physics world
         self.world_config_dict = self.build_world_config()
 
+        if record is None and self.precheck_enabled() and self.layout_has_starting_cost():
+            self.skip_goal()
+            return False
+
         if self.world is None:
             self.world = World(self.world_config_dict)
             self.world.reset()
@@ -1461,6 +1805,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
             self.world.reset(build=False)
             self.world.rebuild(self.world_config_dict, state=False)
         # Redo a small amount of work, and setup initial goal state
+        self.build_mocap_offsets()
         self.build_goal()
         self.build_mocap_dict()
         # Save last action
@@ -1468,6 +1813,57 @@ class Engine(gym.Env, gym.utils.EzPickle):
 
         # Save last subtree center of mass
         self.last_subtreecom = self.world.get_sensor('subtreecom')
+        return True
+
+    def precheck_enabled(self):
+        '''
+        Whether layouts may be rejected before the world is built.  Skipping the world
+        must not change the random draws of build_goal(), so arm robots (which check
+        goals against the arm end) and tracking goals (which start from the last goal)
+        always build.
+        '''
+        if not self.build_precheck or 'arm' in self.robot_base:
+            return False
+        return not (self.task in ['goal', 'push'] and self.goal_mode == 'track')
+
+    def layout_has_starting_cost(self):
+        '''
+        Whether the robot starts inside a hazard, hazard3D, or non-contact ghost or ghost3D,
+        judged from the layout and world config alone.  Only clear cases (by a small margin)
+        are reported, anything closer to the edge is left to cost() on the built world.
+        '''
+        margin = 1e-6
+        robot_xy = self.layout['robot']
+        robot_pos = np.r_[robot_xy, self.robot.z_height]
+        geoms = self.world_config_dict['geoms']
+        checks = []  # (distances to the robot, size)
+        if self.constrain_hazards and self.hazards_cost > 0:
+            xy = np.array([self.layout[f'hazard{i}'] for i in range(self.hazards_num)]).reshape(-1, 2)
+            checks.append((row_norm(xy - robot_xy), self.hazards_size))
+        if self.constrain_hazard3Ds and self.hazard3Ds_cost > 0:
+            pos = np.array([geoms[f'hazard3D{i}']['pos'] for i in range(self.hazard3Ds_num)]).reshape(-1, 3)
+            checks.append((row_norm(pos - robot_pos), self.hazard3Ds_size))
+        if self.constrain_ghosts and not self.ghosts_contact and self.ghosts_dist_cost > 0:
+            xy = np.array([self.layout[f'ghost{i}'] for i in range(self.ghosts_num)]).reshape(-1, 2)
+            checks.append((row_norm(xy - robot_xy), self.ghosts_size))
+        if self.constrain_ghost3Ds and not self.ghost3Ds_contact and self.ghost3Ds_dist_cost > 0:
+            pos = np.array([np.r_[self.layout[f'ghost3D{i}'], self._ghost3Ds_z[i]]
+                            for i in range(self.ghost3Ds_num)]).reshape(-1, 3)
+            checks.append((row_norm(pos - robot_pos), self.ghost3Ds_size))
+        return any(np.any(dist < size - margin) for dist, size in checks)
+
+    def skip_goal(self):
+        ''' Draw from self.rs what build_goal() would for this layout, without a world '''
+        if self.task in ['goal', 'push']:
+            placements, keepout = self.placements['goal']
+            self.layout.pop('goal', None)
+            for _ in range(10000):
+                if self.goal_xy_is_valid(self.draw_placement(placements, keepout), keepout):
+                    break
+            else:
+                raise ResamplingError('Failed to generate goal')
+        elif self.task == 'button':
+            self.build_goal_button()
 
     #----------------------------------------------------------------
     # Environment Update Functions
@@ -1478,201 +1874,196 @@ class Engine(gym.Env, gym.utils.EzPickle):
         id = self.mocap_dict[name]
         self.data.mocap_pos[id] = pos
 
+    def mocap_ids(self, prefix):
+        ''' Return the body ids and mocap ids of the numbered mocaps f'{prefix}{i}mocap' '''
+        body_ids = self.body_ids(prefix, 'mocap')
+        return body_ids, self.model.body_mocapid[body_ids]
+
+    def spatial_grid(self, name, positions):
+        ''' The spatial index grid called name, updated to positions (N,2+) '''
+        if name not in self.spatial_grids:
+            self.spatial_grids[name] = UniformGrid(self.spatial_index_cell)
+        grid = self.spatial_grids[name]
+        grid.update(positions)
+        return grid
+
+    def nearby_robot(self, prefix, positions, radius):
+        ''' The positions (N,2+) of a group of objects, or with spatial_index the ones that may be within radius of the robot in XY '''
+        positions = np.asarray(positions)
+        if not self.spatial_index or not len(positions):
+            return positions
+        radius = radius * (1 + 1e-9) + 1e-9  # Margin for rounding at the edge
+        return positions[self.spatial_grid(prefix, positions).query(self.world.robot_pos(), radius)]
+
+    def lidar_candidates(self, prefix, positions):
+        ''' The positions of a group of objects that can show on the lidar, see nearby_robot() '''
+        if not self.spatial_index:
+            return positions
+        if self.lidar_max_dist is not None:
+            max_dist = self.lidar_max_dist
+        elif self.spatial_index_lidar_threshold > 0:
+            max_dist = -np.log(self.spatial_index_lidar_threshold) / self.lidar_exp_gain
+        else:
+            return positions  # Exponential lidar sees everything
+        # Lidar distances are measured in the XY plane of the robot.  When the robot is tilted with
+        # its z axis (s, c) off the vertical, an object at XY distance d is at least d * c - |z| * s away.
+        robot_z = self.world.robot_mat()[:, 2]
+        s, c = np.sqrt(np.sum(np.square(robot_z[:2]))), abs(robot_z[2])
+        if c < 1e-3:
+            return positions
+        radius = (max_dist + abs(self.world.robot_pos()[2]) * s) / c
+        return self.nearby_robot(prefix, positions, radius)
+
+    def repulsion(self, prefix, target, pos_last, size, velocity):
+        ''' mocap_repulsion() of a group of mocap objects, only checking nearby pairs with spatial_index '''
+        if not self.spatial_index:
+            return mocap_repulsion(target, pos_last, size, velocity)
+        i, j = self.spatial_grid(prefix + '_last', pos_last).pairs(2 * size)
+        return mocap_repulsion_pairs(target, pos_last, size, velocity, i, j)
+
     def set_mocaps_ghosts(self, robot_pos):
         ''' Update the positions of ghosts'''
-        ghost_pos_last_dict = []
-        # Get the positions of the last step
-        for i in range(self.ghosts_num):
-            name = f'ghost{i}'
-            ghost_origin = self.layout[name]
-            ghost_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            # Calculate the global positions based on the origin positions and relative positions
-            ghost_pos_last_dict.append(ghost_pos_mocap[:2] + ghost_origin)
-        # Calculate the new positions for the current step
-        for i in range(self.ghosts_num):
-            name = f'ghost{i}'
-            ghost_origin = self.layout[name]
-            ghost_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            ghost_pos_last = ghost_pos_mocap[:2] + ghost_origin
-            target =  ghost_pos_mocap[:2]
-            # Keep a minimum distance between each position
-            for j in range(self.ghosts_num):
-                dist_ij = ghost_pos_last_dict[j] - ghost_pos_last_dict[i]
-                if j != i and np.sqrt(np.sum(np.square(dist_ij))) < 2 * self.ghosts_size:
-                    direction = - dist_ij / np.sqrt(np.sum(np.square(dist_ij)))
-                    target += self.ghosts_velocity*direction
-            if np.sqrt(np.sum(np.square(ghost_pos_last))) > self.ghosts_travel:
-                # Project the positions back to a constrained area
-                direction = - ghost_pos_last / np.sqrt(np.sum(np.square(ghost_pos_last)))
-                target += self.ghosts_velocity*direction
-            else:
-                # Move towards the position of the robot
-                direction = robot_pos[:2] - ghost_pos_last
-                norm = np.sqrt(np.sum(np.square(direction)))
-                direction_norm = direction / norm
-                # Keep a minimum distance from the robot
-                if norm < self.ghosts_safe_dist:  
-                    target = ghost_pos_mocap[:2]
-                else:
-                    target = ghost_pos_mocap[:2] + self.ghosts_velocity*direction_norm
-            
-            pos = np.r_[target, 2e-2]
-            self.set_mocap_pos(name + 'mocap', pos)
+        body_ids, mocap_ids = self.mocap_ids('ghost')
+        # Calculate the global positions of the last step based on the origin positions and relative positions
+        ghost_pos_mocap = self.data.xpos[body_ids, :2]
+        ghost_pos_last = ghost_pos_mocap + self.mocap_offsets['ghost'][:, :2]
+        # Keep a minimum distance between each position
+        target = self.repulsion('ghost', ghost_pos_mocap, ghost_pos_last, self.ghosts_size, self.ghosts_velocity)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Project the positions back to a constrained area
+            dist_origin = row_norm(ghost_pos_last)[:, None]
+            target_back = target + self.ghosts_velocity * (- ghost_pos_last / dist_origin)
+            # Move towards the position of the robot, keeping a minimum distance from the robot
+            direction = robot_pos[:2] - ghost_pos_last
+            norm = row_norm(direction)[:, None]
+            target_robot = np.where(norm < self.ghosts_safe_dist, target,
+                                    target + self.ghosts_velocity * (direction / norm))
+        target = np.where(dist_origin > self.ghosts_travel, target_back, target_robot)
+        self.data.mocap_pos[mocap_ids] = np.c_[target, np.full(len(target), 2e-2)]
     
     def set_mocaps_ghost3Ds(self, robot_pos):
         ''' Update the positions of 3D ghosts'''
-        ghost3D_pos_last_dict = []
-        # Get the positions of the last step
-        for i in range(self.ghost3Ds_num):
-            name = f'ghost3D{i}'
-            ghost_origin = np.r_[self.layout[name], self._ghost3Ds_z[i]]
-            ghost_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            # Calculate the global positions based on the origin positions and relative positions
-            ghost3D_pos_last_dict.append(ghost_pos_mocap + ghost_origin)
-        # Calculate the new positions for the current step
-        for i in range(self.ghost3Ds_num):
-            name = f'ghost3D{i}'
-            ghost_origin = np.r_[self.layout[name], self._ghost3Ds_z[i]]
-            ghost_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            ghost_pos_last = ghost_pos_mocap + ghost_origin
-            target =  ghost_pos_mocap
-            # Keep a minimum distance between each position
-            for j in range(self.ghost3Ds_num):
-                dist_ij = ghost3D_pos_last_dict[j] - ghost3D_pos_last_dict[i]
-                if j != i and np.sqrt(np.sum(np.square(dist_ij))) < 2 * self.ghost3Ds_size:
-                    direction = - dist_ij / np.sqrt(np.sum(np.square(dist_ij)))
-                    target += self.ghost3Ds_velocity*direction
-                    
-            if np.sqrt(np.sum(np.square(ghost_pos_last[:2]))) > self.ghost3Ds_travel:
-                # Project the positions back to a constrained area
-                direction = - ghost_pos_last[:2] / np.sqrt(np.sum(np.square(ghost_pos_last[:2])))
-                target += np.r_[self.ghost3Ds_velocity*direction, 0]
-            else:
-                # Move towards the position of the robot
-                direction = robot_pos - ghost_pos_last
-                norm = np.sqrt(np.sum(np.square(direction)))
-                direction_norm = direction / norm
-                # Keep a minimum distance from the robot
-                if norm < self.ghost3Ds_safe_dist: 
-                    target = ghost_pos_mocap
-                else:
-                    target = ghost_pos_mocap + self.ghost3Ds_velocity*direction_norm
-            target[2] = np.clip(target[2], self.ghost3Ds_z_range[0], self.ghost3Ds_z_range[1])              
-            pos = target
-            self.set_mocap_pos(name + 'mocap', pos)
+        body_ids, mocap_ids = self.mocap_ids('ghost3D')
+        # Calculate the global positions of the last step based on the origin positions and relative positions
+        ghost_pos_mocap = self.data.xpos[body_ids]
+        ghost_pos_last = ghost_pos_mocap + self.mocap_offsets['ghost3D']
+        # Keep a minimum distance between each position
+        target = self.repulsion('ghost3D', ghost_pos_mocap, ghost_pos_last, self.ghost3Ds_size, self.ghost3Ds_velocity)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Project the positions back to a constrained area
+            dist_origin = row_norm(ghost_pos_last[:, :2])[:, None]
+            target_back = target.copy()
+            target_back[:, :2] += self.ghost3Ds_velocity * (- ghost_pos_last[:, :2] / dist_origin)
+            # Move towards the position of the robot, keeping a minimum distance from the robot
+            direction = robot_pos - ghost_pos_last
+            norm = row_norm(direction)[:, None]
+            target_robot = np.where(norm < self.ghost3Ds_safe_dist, target,
+                                    target + self.ghost3Ds_velocity * (direction / norm))
+        target = np.where(dist_origin > self.ghost3Ds_travel, target_back, target_robot)
+        target[:, 2] = np.clip(target[:, 2], self.ghost3Ds_z_range[0], self.ghost3Ds_z_range[1])
+        self.data.mocap_pos[mocap_ids] = target
                 
     def set_mocaps_robbers(self, robot_pos):
         ''' Update the positions of robbers'''
-        robber_pos_last_dict = []
-        # Get the positions of the last step
-        for i in range(self.robbers_num):
-            name = f'robber{i}'
-            robber_origin = self.layout[name]
-            robber_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-                # Calculate the global positions based on the origin positions and relative positions
-            robber_pos_last_dict.append(robber_pos_mocap[:2] + robber_origin)
-        # Calculate the new positions for the current step
-        for i in range(self.robbers_num):
-            name = f'robber{i}'
-            robber_origin = self.layout[name]
-            robber_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            robber_pos_last = robber_pos_mocap[:2] + robber_origin
-            target =  robber_pos_mocap[:2]
-            # Keep a minimum distance between each position
-            for j in range(self.robbers_num):
-                dist_ij = robber_pos_last_dict[j] - robber_pos_last_dict[i]
-                if j != i and np.sqrt(np.sum(np.square(dist_ij))) < 2 * self.robbers_size:
-                    direction = - dist_ij / np.sqrt(np.sum(np.square(dist_ij)))
-                    target += self.robbers_velocity*direction
-            if np.sqrt(np.sum(np.square(robber_pos_last))) > self.robbers_travel:
-                # Project the positions back to a constrained area
-                direction = - robber_pos_last / np.sqrt(np.sum(np.square(robber_pos_last)))
-                target += self.robbers_velocity*direction
+        body_ids, mocap_ids = self.mocap_ids('robber')
+        # Calculate the global positions of the last step based on the origin positions and relative positions
+        robber_pos_mocap = self.data.xpos[body_ids, :2]
+        robber_pos_last = robber_pos_mocap + self.mocap_offsets['robber'][:, :2]
+        # Keep a minimum distance between each position
+        target = self.repulsion('robber', robber_pos_mocap, robber_pos_last, self.robbers_size, self.robbers_velocity)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Project the positions back to a constrained area
+            dist_origin = row_norm(robber_pos_last)[:, None]
+            direction_origin = - robber_pos_last / dist_origin
+            target_back = target + self.robbers_velocity * direction_origin
+            direction = robot_pos[:2] - robber_pos_last
+            norm = row_norm(direction)[:, None]
+            direction_norm = direction / norm
+            if self.task == 'defense':
+                # Move away from the robot if get too close, else towards the center of the defensed area
+                target_robot = np.where(norm > self.defense_range,
+                                        target + self.robbers_velocity * direction_origin,
+                                        target - self.robbers_velocity * 10 * direction_norm)
+            elif self.task == 'chase':
+                # Keep a minimum distance from the robot
+                target_robot = np.where(norm > self.chase_range, target,
+                                        target - self.robbers_velocity * 10 * direction_norm)
             else:
-                direction = robot_pos[:2] - robber_pos_last
-                norm = np.sqrt(np.sum(np.square(direction)))
-                direction_norm = direction / norm
-                if self.task == 'defense':
-                    if norm > self.defense_range:
-                        # Move away from the robot if get too close
-                        direction_norm = - robber_pos_last[:2] / np.sqrt(np.sum(np.square(robber_pos_last[:2])))
-                        target = robber_pos_mocap[:2] + self.robbers_velocity*direction_norm
-                    else:
-                        # Move towards the center of the defensed area
-                        target = robber_pos_mocap[:2] - self.robbers_velocity*10*direction_norm
-                elif self.task == 'chase':
-                    # Keep a minimum distance from the robot
-                    if norm > self.chase_range:
-                        target = robber_pos_mocap[:2]
-                    else:
-                        target = robber_pos_mocap[:2] - self.robbers_velocity*10*direction_norm
-                else:
-                    target = robber_pos_mocap[:2] - self.robbers_velocity*direction_norm
-            
-            pos = np.r_[target, 2e-2]
-            self.set_mocap_pos(name + 'mocap', pos)
+                target_robot = target - self.robbers_velocity * direction_norm
+        target = np.where(dist_origin > self.robbers_travel, target_back, target_robot)
+        self.data.mocap_pos[mocap_ids] = np.c_[target, np.full(len(target), 2e-2)]
     
     def set_mocaps_robber3Ds(self, robot_pos):
         ''' Update the positions of 3D robbers'''
-        robber3D_pos_last_dict = []
-        # Get the positions of the last step
-        for i in range(self.robber3Ds_num):
-            name = f'robber3D{i}'
-            robber_origin = np.r_[self.layout[name], self._robber3Ds_z[i]]
-            robber_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            # Calculate the global positions based on the origin positions and relative positions
-            robber3D_pos_last_dict.append(robber_pos_mocap + robber_origin)
-        # Calculate the new positions for the current step
-        for i in range(self.robber3Ds_num):
-            name = f'robber3D{i}'
-            robber_origin = np.r_[self.layout[name], self._robber3Ds_z[i]]
-            robber_pos_mocap = self.data.body(name +'mocap').xpos.copy()
-            robber_pos_last = robber_pos_mocap + robber_origin
-            target =  robber_pos_mocap
-            # Keep a minimum distance between each position
-            for j in range(self.robber3Ds_num):
-                dist_ij = robber3D_pos_last_dict[j] - robber3D_pos_last_dict[i]
-                if j != i and np.sqrt(np.sum(np.square(dist_ij))) < 2 * self.robber3Ds_size:
-                    direction = - dist_ij / np.sqrt(np.sum(np.square(dist_ij)))
-                    target += self.robber3Ds_velocity*direction
-                # Project the positions back to a constrained area
-            if np.sqrt(np.sum(np.square(robber_pos_last[:2]))) > self.robber3Ds_travel:
-                direction = - robber_pos_last[:2] / np.sqrt(np.sum(np.square(robber_pos_last[:2])))
-                target += np.r_[self.robber3Ds_velocity*direction, 0]
+        body_ids, mocap_ids = self.mocap_ids('robber3D')
+        # Calculate the global positions of the last step based on the origin positions and relative positions
+        robber_pos_mocap = self.data.xpos[body_ids]
+        robber_pos_last = robber_pos_mocap + self.mocap_offsets['robber3D']
+        # Keep a minimum distance between each position
+        target = self.repulsion('robber3D', robber_pos_mocap, robber_pos_last, self.robber3Ds_size, self.robber3Ds_velocity)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Project the positions back to a constrained area
+            dist_origin = row_norm(robber_pos_last[:, :2])[:, None]
+            direction_origin = - robber_pos_last[:, :2] / dist_origin
+            target_back = target.copy()
+            target_back[:, :2] += self.robber3Ds_velocity * direction_origin
+            direction = robot_pos - robber_pos_last
+            norm = row_norm(direction)[:, None]
+            direction_norm = direction / norm
+            if self.task == 'defense':
+                # Move away from the robot if get too close, else towards the center of the defensed area
+                target_away = target.copy()
+                target_away[:, :2] += self.robber3Ds_velocity * direction_origin
+                target_robot = np.where(norm > self.defense_range, target_away,
+                                        target - self.robber3Ds_velocity * 10 * direction_norm)
+            elif self.task == 'chase':
+                # Keep a minimum distance from the robot
+                target_robot = np.where(norm > self.chase_range, target,
+                                        target - self.robber3Ds_velocity * 10 * direction_norm)
             else:
-                direction = robot_pos - robber_pos_last
-                norm = np.sqrt(np.sum(np.square(direction)))
-                direction_norm = direction / norm
-                if self.task == 'defense':
-                    if norm > self.defense_range:
-                        # Move away from the robot if get too close
-                        direction_norm = - robber_pos_last[:2] / np.sqrt(np.sum(np.square(robber_pos_last[:2])))
-                        target = robber_pos_mocap + self.robber3Ds_velocity*np.r_[direction_norm,0]
-                    else:
-                        # Move towards the center of the defensed area
-                        target = robber_pos_mocap - self.robber3Ds_velocity*10*direction_norm
-                elif self.task == 'chase':
-                    # Keep a minimum distance from the robot
-                    if norm > self.chase_range:
-                        target = robber_pos_mocap
-                    else:
-                        target = robber_pos_mocap - self.robber3Ds_velocity*10*direction_norm
-                else:
-                    target = robber_pos_mocap - self.robbers_velocity*direction_norm
-                    
-            target[2] = np.clip(target[2], self.robber3Ds_z_range[0], self.robber3Ds_z_range[1])              
-            pos = target
-            self.set_mocap_pos(name + 'mocap', pos)
+                target_robot = target - self.robbers_velocity * direction_norm
+        target = np.where(dist_origin > self.robber3Ds_travel, target_back, target_robot)
+        target[:, 2] = np.clip(target[:, 2], self.robber3Ds_z_range[0], self.robber3Ds_z_range[1])
+        self.data.mocap_pos[mocap_ids] = target
+
+    def simulate(self, nstep):
+        '''
+        Run nstep physics steps.
+
+        Without mocaps to control, all steps are taken in one call to mj_step.
+        Otherwise the mocap targets are set every mocaps_decimation steps.
+        '''
+        if not self.mocaps_num:
+            if nstep:
+                mujoco.mj_step(self.model, self.data, nstep)
+            return
+        for start in range(0, nstep, self.mocaps_decimation):
+            self.set_mocaps()
+            mujoco.mj_step(self.model, self.data, min(self.mocaps_decimation, nstep - start))
+
+    @property
+    def mocaps_num(self):
+        ''' Number of objects moved by set_mocaps() '''
+        return self.gremlins_num + self.ghosts_num + self.ghost3Ds_num + self.robbers_num + self.robber3Ds_num
+
+    def drone_propellers(self):
+        ''' Body ids of the drone propellers p1 ... p4 and the total mass of the robot and propellers '''
+        constants = self.world.model_constants
+        if 'drone_propellers' not in constants:
+            ids = self.world.body_ids([f'p{i + 1}' for i in range(4)])
+            mass = self.model.body_mass[self.world.body_id('robot')]
+            for i in ids:
+                mass += self.model.body_mass[i]
+            constants['drone_propellers'] = ids, mass
+        return constants['drone_propellers']
 
     def set_mocaps(self):
         ''' Set mocap object positions before a physics step is executed '''
         if self.gremlins_num: 
+            # All gremlins circle around their own origin with the same phase
             phase = float(self.data.time)
-            for i in range(self.gremlins_num):
-                name = f'gremlin{i}'
-                target = np.array([np.sin(phase), np.cos(phase)]) * self.gremlins_travel
-                pos = np.r_[target, [self.gremlins_size]]
-                self.set_mocap_pos(name + 'mocap', pos)
+            target = np.array([np.sin(phase), np.cos(phase)]) * self.gremlins_travel
+            self.data.mocap_pos[self.mocap_ids('gremlin')[1]] = np.r_[target, [self.gremlins_size]]
         if 'arm' in self.robot_base:
             robot_pos = self.arm_end_pos
         else:
@@ -1688,7 +2079,7 @@ class Engine(gym.Env, gym.utils.EzPickle):
             
     def update_layout(self):
         ''' Update layout dictionary with new places of objects '''
-        mujoco.mj_forward(self.model, self.data)
+        self.world.forward()
         for k in list(self.layout.keys()):
             # Mocap objects have to be handled separately
             if 'gremlin' in k or 'ghost' in k or 'robber' in k:
@@ -1703,6 +2094,11 @@ class Engine(gym.Env, gym.utils.EzPickle):
     # observation, reward and cost functions
     #----------------------------------------------------------------
 
+    def lidar_body_poses(self):
+        ''' Positions (B,3) and rotation matrices (B,3,3) of the lidar bodies '''
+        ids = self.world.body_ids(self.lidar_body)
+        return self.data.xpos[ids], self.data.xmat[ids].reshape(-1, 3, 3)
+
     def obs_compass(self, pos):
         '''
         Return a robot-centric compass observation of a list of positions.
@@ -1714,31 +2110,16 @@ class Engine(gym.Env, gym.utils.EzPickle):
         projected into the sin/cos space we use for joints.
         (See comment on joint observation for why we do this.)
         '''
-        pos = np.asarray(pos)
-        vec_all = np.zeros((len(self.lidar_body), self.compass_shape))
-        for body_idx in range(len(self.lidar_body)):
-            body = self.lidar_body[body_idx]
-            if pos.shape == (2,):
-                pos = np.concatenate([pos, [0]])  # Acamdd a zero z-coordinate
-            # Get ego vector in world frame
-            vec = pos - self.world.body_pos(body)
-            # Rotate into frame
-            vec = np.matmul(vec, self.world.body_mat(body))
-            # Truncate
-            vec = vec[:self.compass_shape]
-            # Normalize
-            vec /= np.sqrt(np.sum(np.square(vec))) + 0.001
-            assert vec.shape == (self.compass_shape,), f'Bad vec {vec}'
-            vec_all[body_idx,:] = vec
-        return vec_all
+        return compass(pos, *self.lidar_body_poses(), self.compass_shape)
 
     def obs_vision(self):
-        ''' Return pixels from the robot camera '''
-        # Get a render context so we can
+        ''' Return pixels from the robot camera, at vision_size '''
         rows, cols = self.vision_size
-        width, height = cols, rows
-        vision = self.render()
-        return np.array(vision, dtype='float32') / 255
+        renderer = self.get_renderer('vision', cols, rows)
+        self.world.forward()
+        camera = 'vision' if mujoco.mj_name2id(self.model, mujoco.mjtObj.mjOBJ_CAMERA, 'vision') >= 0 else 'track'
+        renderer.update_scene(self.data, camera)
+        return renderer.render().astype(np.float32) / 255
 
     def obs_lidar(self, positions, group):
         '''
@@ -1779,31 +2160,8 @@ class Engine(gym.Env, gym.utils.EzPickle):
             - close objects occlude far objects
             - constant size observation with variable numbers of objects
         '''
-        obs = np.zeros(self.lidar_num_bins)
-        for pos in positions:
-            pos = np.asarray(pos)
-            if pos.shape == (3,):
-                pos = pos[:2]  # Truncate Z coordinate
-            z = complex(*self.ego_xy(pos))  # X, Y as real, imaginary components
-            dist = np.abs(z)
-            angle = np.angle(z) % (np.pi * 2)
-            bin_size = (np.pi * 2) / self.lidar_num_bins
-            bin = int(angle / bin_size)
-            bin_angle = bin_size * bin
-            if self.lidar_max_dist is None:
-                sensor = np.exp(-self.lidar_exp_gain * dist)
-            else:
-                sensor = max(0, self.lidar_max_dist - dist) / self.lidar_max_dist
-            obs[bin] = max(obs[bin], sensor)
-            # Aliasing
-            if self.lidar_alias:
-                alias = (angle - bin_angle) / bin_size
-                assert 0 <= alias <= 1, f'bad alias {alias}, dist {dist}, angle {angle}, bin {bin}'
-                bin_plus = (bin + 1) % self.lidar_num_bins
-                bin_minus = (bin - 1) % self.lidar_num_bins
-                obs[bin_plus] = max(obs[bin_plus], alias * sensor)
-                obs[bin_minus] = max(obs[bin_minus], (1 - alias) * sensor)
-        return obs
+        return pseudo_lidar(positions, self.world.robot_pos(), self.world.robot_mat(), self.lidar_num_bins,
+                            self.lidar_max_dist, self.lidar_exp_gain, self.lidar_alias)
 
     def obs_lidar_pseudo3D(self, positions):
         '''
@@ -1826,149 +2184,96 @@ class Engine(gym.Env, gym.utils.EzPickle):
             - close objects occlude far objects
             - constant size observation with variable numbers of objects
         '''
-        obs = np.zeros((len(self.lidar_body), self.lidar_num_bins, self.lidar_num_bins3D))
-        for body_idx in range(len(self.lidar_body)):
-            body = self.lidar_body[body_idx]
-            for pos in positions:
-                pos = np.asarray(pos)
-                assert pos.shape == (3,)
-                x, y, z = self.ego_body_xyz(body, pos)
-                proj_xy= complex(x,y)  # X, Y as real, imaginary components
-                dist_xy = np.abs(proj_xy)
-                angle_xy = np.angle(proj_xy) % (np.pi * 2)
-
-                bin_size_xy = (np.pi * 2) / self.lidar_num_bins
-                bin_xy = int(angle_xy / bin_size_xy)
-                bin_angle_xy = bin_size_xy * bin_xy
-
-                proj_z = complex(dist_xy, z)
-                dist_z = np.abs(proj_z)
-                angle_z = np.angle(proj_z) + np.pi / 2
-        
-                bin_size_z = (np.pi) / self.lidar_num_bins3D
-                bin_z = int(angle_z / bin_size_z)
-                bin_angle_z = bin_size_z * bin_z
-
-                if self.lidar_max_dist is None:
-                    sensor = np.exp(-self.lidar_exp_gain * dist_z)
-                else:
-                    sensor = max(0, self.lidar_max_dist - dist_z) / self.lidar_max_dist
-                obs[body_idx][bin_xy][bin_z] = max(obs[body_idx][bin_xy][bin_z], sensor)
-                # Aliasing
-                if self.lidar_alias:
-                    alias_xy = (angle_xy - bin_angle_xy) / bin_size_xy
-                    assert 0 <= alias_xy <= 1, f'bad alias {alias_xy}, dist {dist_xy}, angle {angle_xy}, bin {bin_xy}'
-                    bin_plus_xy = (bin_xy + 1) % self.lidar_num_bins
-                    bin_minus_xy = (bin_xy - 1) % self.lidar_num_bins
-                    obs[body_idx][bin_plus_xy][bin_z]  = max(obs[body_idx][bin_plus_xy][bin_z] , alias_xy * sensor)
-                    obs[body_idx][bin_minus_xy][bin_z] = max(obs[body_idx][bin_minus_xy][bin_z] , (1 - alias_xy) * sensor)
-
-                    alias_z = (angle_z - bin_angle_z) / bin_size_z
-                    assert 0 <= alias_z <= 1, f'bad alias {alias_z}, dist {dist_z}, angle {angle_z}, bin {bin_z}'
-                    bin_plus_z = min((bin_z + 1), self.lidar_num_bins3D - 1)
-                    bin_minus_z = max((bin_z - 1), 0)
-                    obs[body_idx][bin_xy][bin_plus_z]  = max(obs[body_idx][bin_xy][bin_plus_z] , alias_z * sensor)
-                    obs[body_idx][bin_xy][bin_minus_z] = max(obs[body_idx][bin_xy][bin_minus_z] , (1 - alias_z) * sensor)
-        return obs
+        return pseudo_lidar3D(positions, *self.lidar_body_poses(), self.lidar_num_bins, self.lidar_num_bins3D,
+                              self.lidar_max_dist, self.lidar_exp_gain, self.lidar_alias)
 
     def obs(self):
-        ''' Return the observation of our agent '''
-        mujoco.mj_forward(self.model, self.data) # Needed to get sensordata correct
-        obs = {}
+        '''
+        Return the observation of our agent, as float32.  Without observation_copy the
+        observation is self.obs_buffer (or views into it), which the next call overwrites.
+        '''
+        self.world.forward()  # Needed to get sensordata correct
+        obs = self.obs_views  # Every component writes into its slice of self.obs_buffer
 
         if self.observe_goal_dist:
-            obs['goal_dist'] = np.array([np.exp(-self.dist_goal())])
+            obs['goal_dist'][...] = np.exp(-self.dist_goal())
         if self.observe_goal_comp:
-            obs['goal_compass'] = self.obs_compass(self.goal_pos)
+            obs['goal_compass'][...] = self.obs_compass(self.goal_pos)
         if self.observe_goal_lidar:
             if self.goal_3D:
-                obs['goal_lidar'] = self.obs_lidar3D([self.goal_pos], GROUP_GOAL)
+                obs['goal_lidar'][...] = self.obs_lidar3D([self.goal_pos], GROUP_GOAL)
             else:
-                obs['goal_lidar'] = self.obs_lidar([self.goal_pos], GROUP_GOAL)
+                obs['goal_lidar'][...] = self.obs_lidar([self.goal_pos], GROUP_GOAL)
         if self.task == 'push':
             box_pos = self.box_pos
             if self.observe_box_comp:
-                obs['box_compass'] = self.obs_compass(box_pos)
+                obs['box_compass'][...] = self.obs_compass(box_pos)
             if self.observe_box_lidar:
-                obs['box_lidar'] = self.obs_lidar([box_pos], GROUP_BOX)
+                obs['box_lidar'][...] = self.obs_lidar([box_pos], GROUP_BOX)
         if self.task == 'circle' and self.observe_circle:
-            obs['circle_lidar'] = self.obs_lidar([self.goal_pos], GROUP_CIRCLE)
+            obs['circle_lidar'][...] = self.obs_lidar([self.goal_pos], GROUP_CIRCLE)
         if self.observe_freejoint:
             joint_id = self.model.joint_name2id('robot')
             joint_qposadr = self.model.jnt_qposadr[joint_id]
             assert joint_qposadr == 0  # Needs to be the first entry in qpos
-            obs['freejoint'] = self.data.qpos[:7]
+            obs['freejoint'][...] = self.data.qpos[:7]
         if self.observe_com:
-            obs['com'] = self.world.robot_com()
+            obs['com'][...] = self.world.robot_com()
         if self.observe_sensors:
+            raw_src, raw_dst, hinge_src, hinge_dst, quat_src, quat_dst = self.sensor_plan()
+            sensordata = self.data.sensordata
             # Sensors which can be read directly, without processing
-            for sensor in self.sensors_obs:  # Explicitly listed sensors
-                obs[sensor] = self.world.get_sensor(sensor)
-            for sensor in self.robot.hinge_vel_names:
-                obs[sensor] = self.world.get_sensor(sensor)
-            for sensor in self.robot.ballangvel_names:
-                obs[sensor] = self.world.get_sensor(sensor)
+            self.obs_buffer[raw_dst] = sensordata[raw_src]
             # Process angular position sensors
             if self.sensors_angle_components:
-                for sensor in self.robot.hinge_pos_names:
-                    theta = float(self.world.get_sensor(sensor))  # Ensure not 1D, 1-element array
-                    obs[sensor] = np.array([np.sin(theta), np.cos(theta)])
-                for sensor in self.robot.ballquat_names:
-                    quat = self.world.get_sensor(sensor)
-                    obs[sensor] = quat2mat(quat)
-            else:  # Otherwise read sensors directly
-                for sensor in self.robot.hinge_pos_names:
-                    obs[sensor] = self.world.get_sensor(sensor)
-                for sensor in self.robot.ballquat_names:
-                    obs[sensor] = self.world.get_sensor(sensor)
+                theta = sensordata[hinge_src]
+                self.obs_buffer[hinge_dst] = np.stack([np.sin(theta), np.cos(theta)], axis=-1).ravel()
+                self.obs_buffer[quat_dst] = quat2mat_batch(sensordata[quat_src]).ravel()
         if self.observe_remaining:
-            obs['remaining'] = np.array([self.steps / self.num_steps])
+            obs['remaining'][...] = self.steps / self.num_steps
             assert 0.0 <= obs['remaining'][0] <= 1.0, 'bad remaining {}'.format(obs['remaining'])
         if self.walls_num and self.observe_walls:
-            obs['walls_lidar'] = self.obs_lidar(self.walls_pos, GROUP_WALL)
+            obs['walls_lidar'][...] = self.obs_lidar(self.lidar_candidates('wall', self.walls_pos), GROUP_WALL)
         if self.observe_hazards:
-            obs['hazards_lidar'] = self.obs_lidar(self.hazards_pos, GROUP_HAZARD)
+            obs['hazards_lidar'][...] = self.obs_lidar(self.lidar_candidates('hazard', self.hazards_pos), GROUP_HAZARD)
         if self.observe_hazard3Ds:
-            obs['hazard3Ds_lidar'] = self.obs_lidar3D(self.hazard3Ds_pos, GROUP_HAZARD3D)
+            obs['hazard3Ds_lidar'][...] = self.obs_lidar3D(self.hazard3Ds_pos, GROUP_HAZARD3D)
         if self.observe_vases:
-            obs['vases_lidar'] = self.obs_lidar(self.vases_pos, GROUP_VASE)
+            obs['vases_lidar'][...] = self.obs_lidar(self.lidar_candidates('vase', self.vases_pos), GROUP_VASE)
         if self.gremlins_num and self.observe_gremlins:
-            obs['gremlins_lidar'] = self.obs_lidar(self.gremlins_obj_pos, GROUP_GREMLIN)
+            obs['gremlins_lidar'][...] = self.obs_lidar(self.lidar_candidates('gremlin', self.gremlins_obj_pos), GROUP_GREMLIN)
         if self.ghosts_num and self.observe_ghosts:
-            obs['ghosts_lidar'] = self.obs_lidar(self.ghosts_pos, GROUP_GHOST)
+            obs['ghosts_lidar'][...] = self.obs_lidar(self.lidar_candidates('ghost', self.ghosts_pos), GROUP_GHOST)
         if self.ghost3Ds_num and self.observe_ghost3Ds:
-            obs['ghost3Ds_lidar'] = self.obs_lidar3D(self.ghost3Ds_pos, GROUP_GHOST3D)
+            obs['ghost3Ds_lidar'][...] = self.obs_lidar3D(self.ghost3Ds_pos, GROUP_GHOST3D)
         if self.robbers_num and self.observe_robbers:
-            obs['robbers_lidar'] = self.obs_lidar(self.robbers_pos, GROUP_ROBBER)
+            obs['robbers_lidar'][...] = self.obs_lidar(self.lidar_candidates('robber', self.robbers_pos), GROUP_ROBBER)
         if self.robber3Ds_num and self.observe_robber3Ds:
-            obs['robber3Ds_lidar'] = self.obs_lidar3D(self.robber3Ds_pos, GROUP_ROBBER3D)
+            obs['robber3Ds_lidar'][...] = self.obs_lidar3D(self.robber3Ds_pos, GROUP_ROBBER3D)
         if self.pillars_num and self.observe_pillars:
-            obs['pillars_lidar'] = self.obs_lidar(self.pillars_pos, GROUP_PILLAR)
+            obs['pillars_lidar'][...] = self.obs_lidar(self.lidar_candidates('pillar', self.pillars_pos), GROUP_PILLAR)
         if self.buttons_num and self.observe_buttons:
             # Buttons observation is zero while buttons are resetting
             if self.buttons_timer == 0:
-                obs['buttons_lidar'] = self.obs_lidar(self.buttons_pos, GROUP_BUTTON)
+                obs['buttons_lidar'][...] = self.obs_lidar(self.lidar_candidates('button', self.buttons_pos), GROUP_BUTTON)
             else:
-                obs['buttons_lidar'] = np.zeros(self.lidar_num_bins)
+                obs['buttons_lidar'][...] = 0
         if self.observe_qpos:
-            obs['qpos'] = self.data.qpos.copy()
+            obs['qpos'][...] = self.data.qpos
         if self.observe_qvel:
-            obs['qvel'] = self.data.qvel.copy()
+            obs['qvel'][...] = self.data.qvel
         if self.observe_ctrl:
-            obs['ctrl'] = self.data.ctrl.copy()
+            obs['ctrl'][...] = self.data.ctrl
         if self.observe_armpos:
-            obs['armpos'] = np.array(self.armpos)
+            obs['armpos'][...] = np.array(self.armpos)
         if self.observe_vision:
-            obs['vision'] = self.obs_vision()
+            obs['vision'][...] = self.obs_vision()
         if self.observation_flatten:
-            flat_obs = np.zeros(self.obs_flat_size)
-            offset = 0
-            for k in sorted(self.obs_space_dict.keys()):
-                k_size = np.prod(obs[k].shape)
-                flat_obs[offset:offset + k_size] = obs[k].flat
-                offset += k_size
-            obs = flat_obs
-        assert self.observation_space.contains(obs), f'Bad obs {obs} {self.observation_space}'
+            obs = self.obs_buffer.copy() if self.observation_copy else self.obs_buffer
+        elif self.observation_copy:
+            obs = {k: v.copy() for k, v in obs.items()}
+        if self.observation_check:
+            assert self.observation_space.contains(obs), f'Bad obs {obs} {self.observation_space}'
         return obs
 
     def reward(self):
@@ -2009,27 +2314,14 @@ class Engine(gym.Env, gym.utils.EzPickle):
             radius = np.sqrt(x**2 + y**2)
             reward += (((-u*y + v*x)/radius)/(1 + np.abs(radius - self.circle_radius))) * self.reward_circle
         if self.task == 'chase':
-            dist_robber = 1000
-            for h_pos in self.robbers_pos:
-                dist_robber = min(dist_robber, self.dist_xyz(h_pos))
-            for h_pos in self.robber3Ds_pos:
-                dist_robber = min(dist_robber, self.dist_xyz(h_pos))
+            dist_robber = np.min(np.r_[1000, self.dists_xyz(self.robbers_pos), self.dists_xyz(self.robber3Ds_pos)])
             if self.last_dist_robber != -1:
                 reward += (self.last_dist_robber - dist_robber) * self.reward_chase
             self.last_dist_robber = dist_robber
         if self.task == 'defense':
-            for h_pos in self.robbers_pos:
-                dist = np.sqrt(np.sum(np.square(h_pos[:2]))) / self.circle_radius - 1
-                if dist < 0:
-                    reward += dist * self.reward_defense
-                else:
-                    reward += 0.1 * self.reward_defense
-            for h_pos in self.robber3Ds_pos:
-                dist = np.sqrt(np.sum(np.square(h_pos[:2]))) / self.circle_radius - 1
-                if dist < 0:
-                    reward += dist * self.reward_defense
-                else:
-                    reward += 0.1 * self.reward_defense
+            for positions in (self.robbers_pos, self.robber3Ds_pos):
+                dist = row_norm(positions[:, :2]) / self.circle_radius - 1
+                reward = add_in_order(reward, np.where(dist < 0, dist * self.reward_defense, 0.1 * self.reward_defense))
         # Intrinsic reward for uprightness
         if self.reward_orientation:
             zalign = quat2zalign(self.data.get_body_xquat(self.reward_orientation_body))
@@ -2042,9 +2334,75 @@ class Engine(gym.Env, gym.utils.EzPickle):
                 print('Warning: reward was outside of range!')
         return reward
 
+    def sensor_plan(self):
+        '''
+        Return index arrays that gather the observed sensors from data.sensordata into self.obs_buffer:
+        raw sources and destinations, hinge angle sources and their (sin, cos) destinations,
+        and ball quaternion sources (K,4) and their rotation matrix destinations.
+
+        The plan is built once per model of each world (see World.model_constants).
+        '''
+        constants = self.world.model_constants
+        if 'sensor_plan' not in constants:
+            def sensor_index(name):
+                id = self.model.sensor(name).id
+                adr = self.model.sensor_adr[id]
+                return np.arange(adr, adr + self.model.sensor_dim[id])
+
+            def obs_index(name):
+                offset = self.obs_offsets[name]
+                return np.arange(offset, offset + self.obs_views[name].size)
+
+            def gather(names):
+                ''' Concatenated sensor and observation indices of names '''
+                return (np.concatenate([sensor_index(name) for name in names] + [np.zeros(0, int)]),
+                        np.concatenate([obs_index(name) for name in names] + [np.zeros(0, int)]))
+
+            raw = list(self.sensors_obs) + self.robot.hinge_vel_names + self.robot.ballangvel_names
+            hinges, quats = self.robot.hinge_pos_names, self.robot.ballquat_names
+            if not self.sensors_angle_components:
+                raw, hinges, quats = raw + hinges + quats, [], []
+            quat_src, quat_dst = gather(quats)
+            constants['sensor_plan'] = gather(raw) + gather(hinges) + (quat_src.reshape(-1, 4), quat_dst)
+        return constants['sensor_plan']
+
+    def geom_tables(self):
+        '''
+        Return arrays mapping geom id to its category (one of GEOM_*),
+        whether it belongs to the robot, and its button index (-1 for non-buttons).
+
+        The tables are built once per model of each world (see World.model_constants).
+        '''
+        constants = self.world.model_constants
+        if 'geom_tables' not in constants:
+            names = [self.model.geom(i).name for i in range(self.model.ngeom)]
+            robot_names = set(self.robot.geom_names)
+            button_names = {f'button{i}': i for i in range(self.buttons_num)}
+            category = np.full(len(names), GEOM_OTHER)
+            for i, name in enumerate(names):
+                for prefix, c in GEOM_CATEGORY_PREFIXES:
+                    if name.startswith(prefix):
+                        category[i] = c
+                        break
+            robot = np.array([name in robot_names for name in names])
+            button = np.array([button_names.get(name, -1) for name in names])
+            constants['geom_tables'] = category, robot, button
+        return constants['geom_tables']
+
+    def robot_contacts(self):
+        '''
+        Return the geom categories and button indices of both sides of every
+        contact involving the robot, as arrays (category1, category2, button1, button2).
+        '''
+        category, robot, button = self.geom_tables()
+        geom1, geom2 = self.data.contact.geom1, self.data.contact.geom2
+        touching = robot[geom1] | robot[geom2]
+        geom1, geom2 = geom1[touching], geom2[touching]
+        return category[geom1], category[geom2], button[geom1], button[geom2]
+
     def cost(self):
         ''' Calculate the current costs and return a dict '''
-        mujoco.mj_forward(self.model, self.data)  # Ensure positions and contacts are correct
+        self.world.forward()  # Ensure positions and contacts are correct
         cost = {}
         # Conctacts processing
         if self.constrain_vases:
@@ -2060,76 +2418,63 @@ class Engine(gym.Env, gym.utils.EzPickle):
         if self.constrain_ghost3Ds:
             cost['cost_ghost3Ds'] = 0
         buttons_constraints_active = self.constrain_buttons and (self.buttons_timer == 0)
-        for contact in self.data.contact[:self.data.ncon]:
-            geom_ids = [contact.geom1, contact.geom2]
-            geom_names = sorted([self.model.geom(g).name for g in geom_ids])
-            if self.constrain_vases and any(n.startswith('vase') for n in geom_names):
-                if any(n in self.robot.geom_names for n in geom_names):
-                    cost['cost_vases_contact'] += self.vases_contact_cost
-            if self.constrain_pillars and any(n.startswith('pillar') for n in geom_names):
-                if any(n in self.robot.geom_names for n in geom_names):
-                    cost['cost_pillars'] += self.pillars_cost
-            if buttons_constraints_active and any(n.startswith('button') for n in geom_names):
-                if any(n in self.robot.geom_names for n in geom_names):
-                    if not any(n == f'button{self.goal_button}' for n in geom_names):
-                        cost['cost_buttons'] += self.buttons_cost
-            if self.constrain_gremlins and any(n.startswith('gremlin') for n in geom_names):
-                if any(n in self.robot.geom_names for n in geom_names):
-                    cost['cost_gremlins'] += self.gremlins_contact_cost
-            if self.constrain_ghosts and self.ghosts_contact and any(n.startswith('ghost') for n in geom_names):
-                if any(n.startswith('ghost3D') for n in geom_names):
-                    continue
-                if any(n in self.robot.geom_names for n in geom_names):
-                    cost['cost_ghosts'] += self.ghosts_contact_cost
-            if self.constrain_ghost3Ds and self.ghost3Ds_contact and any(n.startswith('ghost3D') for n in geom_names):
-                if any(n in self.robot.geom_names for n in geom_names):
-                    cost['cost_ghost3Ds'] += self.ghost3Ds_contact_cost
+        category1, category2, button1, button2 = self.robot_contacts()
+
+        def contact_categories(c):
+            ''' Number of robot contacts with geoms of category c '''
+            return np.count_nonzero((category1 == c) | (category2 == c))
+
+        if self.constrain_vases:
+            cost['cost_vases_contact'] += contact_categories(GEOM_VASE) * self.vases_contact_cost
+        if self.constrain_pillars:
+            cost['cost_pillars'] += contact_categories(GEOM_PILLAR) * self.pillars_cost
+        if buttons_constraints_active:
+            # Touching the goal button is never penalized
+            wrong = ((category1 == GEOM_BUTTON) | (category2 == GEOM_BUTTON)) \
+                & (button1 != self.goal_button) & (button2 != self.goal_button)
+            cost['cost_buttons'] += np.count_nonzero(wrong) * self.buttons_cost
+        if self.constrain_gremlins:
+            cost['cost_gremlins'] += contact_categories(GEOM_GREMLIN) * self.gremlins_contact_cost
+        if self.constrain_ghosts and self.ghosts_contact:
+            cost['cost_ghosts'] += contact_categories(GEOM_GHOST) * self.ghosts_contact_cost
+        if self.constrain_ghost3Ds and self.ghost3Ds_contact:
+            cost['cost_ghost3Ds'] += contact_categories(GEOM_GHOST3D) * self.ghost3Ds_contact_cost
 
         # Displacement processing
         if self.constrain_vases and self.vases_displace_cost:
-            cost['cost_vases_displace'] = 0
-            for i in range(self.vases_num):
-                name = f'vase{i}'
-                dist = np.sqrt(np.sum(np.square(self.data.body(name).xpos[:2] - self.reset_layout[name])))
-                if dist > self.vases_displace_threshold:
-                    cost['cost_vases_displace'] += dist * self.vases_displace_cost
+            reset_xy = np.array([self.reset_layout[f'vase{i}'] for i in range(self.vases_num)]).reshape(-1, 2)
+            dist = row_norm(self.vases_pos[:, :2] - reset_xy)
+            cost['cost_vases_displace'] = add_in_order(
+                0, dist[dist > self.vases_displace_threshold] * self.vases_displace_cost)
 
         # Velocity processing
         if self.constrain_vases and self.vases_velocity_cost:
-            cost['cost_vases_velocity'] = 0
-            for i in range(self.vases_num):
-                name = f'vase{i}'
-                vel = np.sqrt(np.sum(np.square(self.data.get_body_xvelp(name))))
-                if vel >= self.vases_velocity_threshold:
-                    cost['cost_vases_velocity'] += vel * self.vases_velocity_cost
+            vel = row_norm(self.bodies_xvelp(self.body_ids('vase')))
+            cost['cost_vases_velocity'] = add_in_order(
+                0, vel[vel >= self.vases_velocity_threshold] * self.vases_velocity_cost)
 
         # Calculate constraint violations
         if self.constrain_hazards:
-            cost['cost_hazards'] = 0
-            for h_pos in self.hazards_pos:
-                h_dist = self.dist_xy(h_pos)
-                if h_dist <= self.hazards_size:
-                    cost['cost_hazards'] += self.hazards_cost * (self.hazards_size - h_dist)
+            h_dist = self.dists_xy(self.nearby_robot('hazard', self.hazards_pos, self.hazards_size))
+            h_dist = h_dist[h_dist <= self.hazards_size]
+            cost['cost_hazards'] = add_in_order(0, self.hazards_cost * (self.hazards_size - h_dist))
         
         if self.constrain_hazard3Ds:
-            cost['cost_hazard3Ds'] = 0
-            for h_pos in self.hazard3Ds_pos:
-                h_dist = self.dist_xyz(h_pos)
-                if h_dist <= self.hazard3Ds_size:
-                    cost['cost_hazard3Ds'] += self.hazard3Ds_cost * (self.hazard3Ds_size - h_dist)
+            h_dist = self.dists_xyz(self.hazard3Ds_pos)
+            h_dist = h_dist[h_dist <= self.hazard3Ds_size]
+            cost['cost_hazard3Ds'] = add_in_order(0, self.hazard3Ds_cost * (self.hazard3Ds_size - h_dist))
 
         # Calculate non-contact cost of ghosts
         if self.constrain_ghosts and (self.ghosts_contact == False):
-            for h_pos in self.ghosts_pos:
-                h_dist = self.dist_xy(h_pos)
-                if h_dist <= self.ghosts_size:
-                    cost['cost_ghosts'] += self.ghosts_dist_cost * (self.ghosts_size - h_dist)
+            h_dist = self.dists_xy(self.nearby_robot('ghost', self.ghosts_pos, self.ghosts_size))
+            h_dist = h_dist[h_dist <= self.ghosts_size]
+            cost['cost_ghosts'] = add_in_order(cost['cost_ghosts'], self.ghosts_dist_cost * (self.ghosts_size - h_dist))
 
         if self.constrain_ghost3Ds and (self.ghost3Ds_contact == False):
-            for h_pos in self.ghost3Ds_pos:
-                h_dist = self.dist_xyz(h_pos)
-                if h_dist <= self.ghost3Ds_size:
-                    cost['cost_ghost3Ds'] += self.ghost3Ds_dist_cost * (self.ghost3Ds_size - h_dist)
+            h_dist = self.dists_xyz(self.ghost3Ds_pos)
+            h_dist = h_dist[h_dist <= self.ghost3Ds_size]
+            cost['cost_ghost3Ds'] = add_in_order(cost['cost_ghost3Ds'],
+                                                 self.ghost3Ds_dist_cost * (self.ghost3Ds_size - h_dist))
 
         # Sum all costs into single total cost
         cost['cost'] = sum(v for k, v in cost.items() if k.startswith('cost_'))
@@ -2177,29 +2522,47 @@ class Engine(gym.Env, gym.utils.EzPickle):
         robot_pos = self.world.robot_pos()
         return np.sqrt(np.sum(np.square(pos - robot_pos[:2])))
     
+    def dists_xy(self, positions):
+        ''' Return the distances from the robot to the XY parts of positions (M,2) or (M,3), like dist_xy '''
+        positions = np.asarray(positions)
+        return row_norm(positions[:, :2] - self.world.robot_pos()[:2])
+
+    def bodies_xvelp(self, body_ids):
+        ''' Return the linear velocities (M,3) of the frame origins of bodies in world coordinates '''
+        # cvel is the spatial velocity (angular, linear) at the center of mass of the whole kinematic tree
+        cvel = self.data.cvel[body_ids]
+        offset = self.data.xpos[body_ids] - self.data.subtree_com[self.model.body_rootid[body_ids]]
+        return cvel[:, 3:] + np.cross(cvel[:, :3], offset)
+
     def dist_xyz(self, pos):
         ''' Return the distance from the robot to an XYZ position '''
         pos = np.asarray(pos)
         assert pos.shape == (3,)
         if 'arm' in self.robot_base:
-            link = []
-            link_r = []
-            for i in range(self.arm_link_n):
-                link.append(self.world.body_pos('link_'+ str(i + 1)))
-                link_r.append(self.world.body_size('link_'+ str(i + 1))[0])
-                assert link[i].shape == (3,)
-
-            min_dist = float('inf')
-
-            for i in range(self.arm_link_n - 1):
-                cur_dist, _ = distLinSeg(link[i], link[i + 1], pos, pos)
-                cur_dist -= link_r[i]
-                min_dist = min(cur_dist, min_dist)
-            return min_dist    
-        
+            return self.dists_xyz(pos)[0]
         robot_pos = self.world.robot_pos()
         return np.sqrt(np.sum(np.square(pos - robot_pos)))
 
+    def dists_xyz(self, positions):
+        '''
+        Return the distances from the robot to XYZ positions (M,3), like dist_xyz.
+        For arms that is the distance to the surface of the closest link capsule.
+        '''
+        positions = np.asarray(positions).reshape(-1, 3)
+        if 'arm' in self.robot_base:
+            return capsule_dist(positions, *self.arm_capsules()).min(axis=1)
+        return row_norm(positions - self.world.robot_pos())
+
+    def arm_capsules(self):
+        ''' Starts, ends and radii of the arm segments, from each link to the next with the radius of the first '''
+        link_pos = self.data.xpos[self.body_ids('link_')]
+        constants = self.world.model_constants
+        if 'arm_radii' not in constants:
+            constants['arm_radii'] = np.array([self.world.body_size(f'link_{i + 1}')[0]
+                                               for i in range(self.arm_link_n)])
+        radii = constants['arm_radii']
+        return link_pos[:-1], link_pos[1:], radii[:-1]
+
     def world_xy(self, pos):
         ''' Return the world XY vector to a position from the robot '''
         assert pos.shape == (2,)
@@ -2237,13 +2600,8 @@ class Engine(gym.Env, gym.utils.EzPickle):
         if self.task == 'push':
             return self.dist_box_goal() <= self.goal_size
         if self.task == 'button':
-            for contact in self.data.contact[:self.data.ncon]:
-                geom_ids = [contact.geom1, contact.geom2]
-                geom_names = sorted([self.model.geom_id2name(g) for g in geom_ids])
-                if any(n == f'button{self.goal_button}' for n in geom_names):
-                    if any(n in self.robot.geom_names for n in geom_names):
-                        return True
-            return False
+            _, _, button1, button2 = self.robot_contacts()
+            return bool(np.any((button1 == self.goal_button) | (button2 == self.goal_button)))
         if self.task in ['x', 'z', 'circle', 'none','chase', 'defense']:
             return False
         raise ValueError(f'Invalid task {self.task}')
@@ -24,7 +24,7 @@ def distLinSeg(point1s, point1e, point2s, point2e):
         elif D2 != 0:
             t = 0
             u = -S2/D2
-            U = np.clip(u, 0, 1)
+            u = np.clip(u, 0, 1)
         else:
             t = 0
             u = 0
@@ -50,4 +50,306 @@ def distLinSeg(point1s, point1e, point2s, point2e):
     # dist = np.sqrt(np.sum(np.power(d1*t-d2*u-d12,2)))
     # compute the cloest point 
     points = np.vstack((point1s + d1*t, point2s+d2*u)).transpose()
-    return dist, points
\ No newline at end of file
+    return dist, points
+
+def distLinSegBatch(point1s, point1e, point2s, point2e):
+    '''
+    distLinSeg over broadcast batches of segments (...,3), returning the distances (...)
+    and the closest points on the first and second segments (...,3).
+    Every case of distLinSeg is computed the same way.
+    '''
+    d1 = point1e - point1s
+    d2 = point2e - point2s
+    d12 = point2s - point1s
+
+    D1 = np.sum(np.power(d1, 2), axis=-1)
+    D2 = np.sum(np.power(d2, 2), axis=-1)
+
+    S1 = np.sum(d1*d12, axis=-1)
+    S2 = np.sum(d2*d12, axis=-1)
+    R = np.sum(d1*d2, axis=-1)
+
+    den = D1*D2 - R**2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        degenerate = (D1 == 0) | (D2 == 0)
+        parallel = ~degenerate & (den == 0)
+        t = np.where(parallel, 0, np.clip((S1*D2 - S2*R)/den, 0, 1))
+        u = np.where(parallel, -S2/D2, (t*R - S2)/D2)
+        uf = np.clip(u, 0, 1)
+        t = np.where(uf != u, np.clip((uf*R + S1)/D1, 0, 1), t)
+        u = uf
+        # Segments of zero length
+        t = np.where(degenerate, np.where(D1 != 0, np.clip(S1/D1, 0, 1), 0), t)
+        u = np.where(degenerate, np.where((D1 == 0) & (D2 != 0), np.clip(-S2/D2, 0, 1), 0), u)
+    # compute distance given parameters t and u.  This can differ from distLinSeg in the last
+    # bit: np.linalg.norm takes a BLAS dot product that rounds depending on memory alignment
+    dist = np.sqrt(np.sum(np.power(d1*t[..., None] - d2*u[..., None] - d12, 2), axis=-1))
+    return dist, point1s + d1*t[..., None], point2s + d2*u[..., None]
+
+def capsule_dist(positions, starts, ends, radii):
+    '''
+    Distances (M,L) from positions (M,3) to the surfaces of capsules around the
+    segments starts (L,3) to ends (L,3) with radii (L,), negative inside.
+    '''
+    positions = np.asarray(positions)[:, None, :]
+    dist, _, _ = distLinSegBatch(starts[None], ends[None], positions, positions)
+    return dist - radii
+
+def pseudo_lidar(positions, robot_pos, robot_mat, num_bins, max_dist=None, exp_gain=1.0, alias=True):
+    '''
+    Robot-centric pseudo lidar of an (N,2) or (N,3) array of positions (Z is ignored).
+    See Engine.obs_lidar_pseudo() for the encoding.
+    '''
+    obs = np.zeros(num_bins)
+    positions = np.asarray(positions, dtype='float64')
+    if positions.size == 0:
+        return obs
+    positions = positions.reshape(-1, positions.shape[-1])
+    # Egocentric XY of every position, with a zero z-coordinate like Engine.ego_xy()
+    world_3vec = np.zeros((len(positions), 3))
+    world_3vec[:, :2] = positions[:, :2]
+    world_3vec -= robot_pos
+    ego = np.ascontiguousarray(np.matmul(world_3vec, robot_mat)[:, :2])
+    z = ego.view(np.complex128)[:, 0]  # X, Y as real, imaginary components
+    dist = np.abs(z)
+    angle = np.angle(z) % (np.pi * 2)
+    bin_size = (np.pi * 2) / num_bins
+    bins = (angle / bin_size).astype(int)
+    bin_angle = bin_size * bins
+    if max_dist is None:
+        sensor = np.exp(-exp_gain * dist)
+    else:
+        sensor = np.maximum(0, max_dist - dist) / max_dist
+    np.maximum.at(obs, bins, sensor)
+    # Aliasing
+    if alias:
+        alias = (angle - bin_angle) / bin_size
+        assert np.all((0 <= alias) & (alias <= 1)), f'bad alias {alias}, dist {dist}, angle {angle}, bin {bins}'
+        np.maximum.at(obs, (bins + 1) % num_bins, alias * sensor)
+        np.maximum.at(obs, (bins - 1) % num_bins, (1 - alias) * sensor)
+    return obs
+
+
+def pseudo_lidar3D(positions, body_pos, body_mat, num_bins, num_bins3D, max_dist=None, exp_gain=1.0, alias=True):
+    '''
+    Body-centric 3D pseudo lidar of an (N,3) array of positions, for B lidar bodies
+    with positions (B,3) and rotation matrices (B,3,3).
+    Returns a (B, num_bins, num_bins3D) array, see Engine.obs_lidar_pseudo3D().
+    '''
+    obs = np.zeros((len(body_pos), num_bins, num_bins3D))
+    positions = np.asarray(positions, dtype='float64')
+    if positions.size == 0:
+        return obs
+    assert positions.ndim == 2 and positions.shape[1] == 3, f'Bad 3D positions {positions}'
+    # Egocentric XYZ of every position for every body, shape (B, N, 3)
+    ego = np.einsum('bni,bij->bnj', positions[None] - body_pos[:, None], body_mat)
+    proj_xy = np.ascontiguousarray(ego[..., :2]).view(np.complex128)[..., 0]  # X, Y as real, imaginary components
+    dist_xy = np.abs(proj_xy)
+    angle_xy = np.angle(proj_xy) % (np.pi * 2)
+
+    bin_size_xy = (np.pi * 2) / num_bins
+    bin_xy = (angle_xy / bin_size_xy).astype(int)
+    bin_angle_xy = bin_size_xy * bin_xy
+
+    proj_z = np.stack([dist_xy, ego[..., 2]], axis=-1).view(np.complex128)[..., 0]
+    dist_z = np.abs(proj_z)
+    angle_z = np.angle(proj_z) + np.pi / 2
+
+    bin_size_z = (np.pi) / num_bins3D
+    bin_z = (angle_z / bin_size_z).astype(int)
+    bin_angle_z = bin_size_z * bin_z
+
+    if max_dist is None:
+        sensor = np.exp(-exp_gain * dist_z)
+    else:
+        sensor = np.maximum(0, max_dist - dist_z) / max_dist
+    body = np.broadcast_to(np.arange(len(body_pos))[:, None], sensor.shape)
+    np.maximum.at(obs, (body, bin_xy, bin_z), sensor)
+    # Aliasing
+    if alias:
+        alias_xy = (angle_xy - bin_angle_xy) / bin_size_xy
+        assert np.all((0 <= alias_xy) & (alias_xy <= 1)), \
+            f'bad alias {alias_xy}, dist {dist_xy}, angle {angle_xy}, bin {bin_xy}'
+        np.maximum.at(obs, (body, (bin_xy + 1) % num_bins, bin_z), alias_xy * sensor)
+        np.maximum.at(obs, (body, (bin_xy - 1) % num_bins, bin_z), (1 - alias_xy) * sensor)
+
+        alias_z = (angle_z - bin_angle_z) / bin_size_z
+        assert np.all((0 <= alias_z) & (alias_z <= 1)), \
+            f'bad alias {alias_z}, dist {dist_z}, angle {angle_z}, bin {bin_z}'
+        np.maximum.at(obs, (body, bin_xy, np.minimum(bin_z + 1, num_bins3D - 1)), alias_z * sensor)
+        np.maximum.at(obs, (body, bin_xy, np.maximum(bin_z - 1, 0)), (1 - alias_z) * sensor)
+    return obs
+
+
+def compass(pos, body_pos, body_mat, compass_shape):
+    '''
+    Normalized egocentric vectors from B bodies with positions (B,3) and
+    rotation matrices (B,3,3) to a 2D or 3D position, shape (B, compass_shape).
+    '''
+    pos = np.asarray(pos)
+    if pos.shape == (2,):
+        pos = np.concatenate([pos, [0]])  # Add a zero z-coordinate
+    # Get ego vector in world frame, rotate into each body frame and truncate
+    vec = np.einsum('bi,bij->bj', pos - body_pos, body_mat)[:, :compass_shape]
+    # Normalize
+    vec /= np.sqrt(np.sum(np.square(vec), axis=1, keepdims=True)) + 0.001
+    return vec
+
+
+def row_norm(x):
+    ''' Euclidean norm of every row of x '''
+    return np.sqrt(np.sum(np.square(x), axis=-1))
+
+
+def mocap_repulsion(target, pos_last, size, velocity):
+    '''
+    Push apart objects whose last positions (N,D) are closer than 2 * size:
+    each object moves by velocity along the unit vector away from every such neighbor.
+    Returns target (N,D) plus the moves, summed over neighbors in index order
+    like a loop over pairs would.
+    '''
+    dist = pos_last[None, :, :] - pos_last[:, None, :]  # dist[i, j] = pos_last[j] - pos_last[i]
+    norm = row_norm(dist)
+    close = (norm < 2 * size) & ~np.eye(len(pos_last), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moves = np.where(close[..., None], velocity * (- dist / norm[..., None]), 0)
+    # Reducing over the outer axis adds the neighbors one at a time, in order
+    return np.add.reduce(np.concatenate([target[None], moves.transpose(1, 0, 2)]), axis=0)
+
+
+def mocap_repulsion_pairs(target, pos_last, size, velocity, i, j):
+    '''
+    mocap_repulsion() over the candidate pairs (i, j) only, which must hold every pair of
+    objects closer than 2 * size and be sorted by j.  The result is the same.
+    '''
+    dist = pos_last[j] - pos_last[i]
+    norm = row_norm(dist)
+    close = (norm < 2 * size) & (i != j)
+    target = np.array(target, dtype=np.float64)
+    # add.at adds the moves one at a time in the order of the pairs, like mocap_repulsion()
+    np.add.at(target, i[close], velocity * (- dist[close] / norm[close, None]))
+    return target
+
+
+class UniformGrid:
+    '''
+    Uniform grid of square cells over the XY positions of a group of objects,
+    to find the objects near a point or near each other without checking all of them.
+
+    Objects are kept sorted by cell.  update() only sorts them again when an object moved
+    into another cell, which is rare for moving objects and never happens for static ones.
+    Queries return candidates in index order: all objects within the radius, and maybe
+    some more from the same cells.
+    '''
+    OFFSET = 2**20  # Cell coordinates are shifted by OFFSET into [0, 2 * OFFSET) to make keys
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = np.zeros((0, 2), dtype=np.int64)  # Cell of every object
+        self.order = np.zeros(0, dtype=np.int64)  # Objects sorted by cell key
+        self.keys = np.zeros(0, dtype=np.int64)  # Sorted cell keys
+        self.pairs_cache = None  # (radius, i, j) of the last pairs(), until an object changes cells
+
+    def key(self, cx, cy):
+        return (cx + self.OFFSET) * (2 * self.OFFSET) + (cy + self.OFFSET)
+
+    def update(self, positions):
+        ''' Move the objects to positions (N,2+) '''
+        cells = np.floor(np.asarray(positions)[:, :2] / self.cell).astype(np.int64)
+        if np.array_equal(cells, self.cells):
+            return
+        self.cells = cells
+        self.pairs_cache = None
+        keys = self.key(cells[:, 0], cells[:, 1])
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def query(self, point, radius):
+        ''' Indices of the objects that may be within radius of point in XY, sorted '''
+        lo = np.floor((np.asarray(point[:2]) - radius) / self.cell).astype(np.int64)
+        hi = np.floor((np.asarray(point[:2]) + radius) / self.cell).astype(np.int64)
+        if hi[0] - lo[0] >= len(self.order):
+            return np.arange(len(self.order))  # Not worth searching column by column
+        cx = np.arange(lo[0], hi[0] + 1)
+        start = np.searchsorted(self.keys, self.key(cx, lo[1]), 'left')
+        end = np.searchsorted(self.keys, self.key(cx, hi[1]), 'right')
+        return np.sort(np.concatenate([self.order[a:b] for a, b in zip(start, end)] + [self.order[:0]]))
+
+    def pairs(self, radius):
+        ''' Pairs (i, j), i != j, of objects that may be within radius of each other in XY, sorted by j then i '''
+        if self.pairs_cache is not None and self.pairs_cache[0] == radius:
+            return self.pairs_cache[1:]
+        k = int(np.ceil(radius / self.cell))
+        dx, dy = np.meshgrid(np.arange(-k, k + 1), np.arange(-k, k + 1))
+        keys = self.key(self.cells[:, 0] + dx.reshape(-1, 1), self.cells[:, 1] + dy.reshape(-1, 1)).ravel()
+        start = np.searchsorted(self.keys, keys, 'left')
+        count = np.searchsorted(self.keys, keys, 'right') - start
+        # Expand every (offset, object i) into its count neighbors in the sorted order
+        i = np.repeat(np.tile(np.arange(len(self.order)), len(dx.flat)), count)
+        first = np.repeat(np.cumsum(count) - count, count)
+        j = self.order[np.repeat(start, count) + np.arange(len(i)) - first]
+        distinct = i != j
+        i, j = i[distinct], j[distinct]
+        order = np.lexsort((i, j))
+        self.pairs_cache = radius, i[order], j[order]
+        return self.pairs_cache[1:]
+
+def add_in_order(total, terms):
+    ''' total plus every one of terms, added one at a time in order, like a loop over them would '''
+    for term in np.asarray(terms).tolist():
+        total += term
+    return total
+
+
+def quat2mat_batch(quat):
+    ''' Rotation matrices (K,3,3) of the quaternions (K,4), computed like mju_quat2Mat '''
+    q0, q1, q2, q3 = np.asarray(quat, dtype=np.float64).T
+    q00, q01, q02, q03 = q0 * q0, q0 * q1, q0 * q2, q0 * q3
+    q11, q12, q13 = q1 * q1, q1 * q2, q1 * q3
+    q22, q23, q33 = q2 * q2, q2 * q3, q3 * q3
+    mat = np.stack([q00 + q11 - q22 - q33, 2 * (q12 - q03), 2 * (q13 + q02),
+                    2 * (q12 + q03), q00 - q11 + q22 - q33, 2 * (q23 - q01),
+                    2 * (q13 - q02), 2 * (q23 + q01), q00 - q11 - q22 + q33], axis=-1)
+    # mju_quat2Mat returns the identity for the unit quaternion, without rounding
+    identity = (q0 == 1) & (q1 == 0) & (q2 == 0) & (q3 == 0)
+    mat[identity] = np.eye(3).ravel()
+    return mat.reshape(-1, 3, 3)
+
+
+class UniformStream:
+    '''
+    Uniform [0, 1) samples of a RandomState, drawn in blocks but consumed one at a time.
+
+    peek() looks at the upcoming samples without consuming them and skip() consumes them.
+    Samples are drawn ahead of time, so sync() must be called before the RandomState is
+    used directly again: it rewinds the RandomState to just after the consumed samples,
+    which leaves it exactly where drawing them one at a time would have.
+    rs.uniform(low, high) is low + (high - low) * u for the next sample u.
+    '''
+    def __init__(self, rs, block=1024):
+        self.rs = rs
+        self.block = block
+        self.state = None  # State of rs before the first sample in the buffer
+        self.samples = np.zeros(0)
+        self.pos = 0  # Number of consumed samples in the buffer
+
+    def peek(self, n):
+        ''' The next n samples, without consuming them '''
+        if self.pos + n > len(self.samples):
+            self.sync()
+            self.state = self.rs.get_state()
+            self.samples = self.rs.random_sample(max(n, self.block))
+        return self.samples[self.pos:self.pos + n]
+
+    def skip(self, n):
+        ''' Consume the next n samples '''
+        self.pos += n
+
+    def sync(self):
+        ''' Leave the RandomState right after the consumed samples and empty the buffer '''
+        if self.pos < len(self.samples):
+            self.rs.set_state(self.state)
+            self.rs.random_sample(self.pos)
+        self.state = None
+        self.samples = np.zeros(0)
+        self.pos = 0
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+class LayoutStore:
+    '''
+    Layouts that passed the zero starting cost check of Engine.reset(), by seed.
+
+    For every seed the store keeps the object positions that build_layout() found
+    and the state of the random generator right after sampling them.  That is all
+    reset() needs to rebuild the same world without any rejection sampling.
+
+    Records are saved in .npz files in directory, named by a hash of key (the
+    engine configuration) and the first and last seed they hold, so stores of
+    different configurations can share a directory.  All files for key are loaded
+    when the store is created; new records are only written by save().
+    '''
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.prefix = hashlib.sha256(key.encode()).hexdigest()[:32]
+        self.records = {}  # Seed -> (layout, random state)
+        self.unsaved = set()  # Seeds put since the last save
+        self.load()
+
+    def load(self):
+        ''' Read all records for our key from the directory '''
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(self.prefix + '-') and name.endswith('.npz')):
+                continue
+            with np.load(os.path.join(self.directory, name)) as f:
+                names = [str(n) for n in f['names']]
+                for i, seed in enumerate(f['seeds']):
+                    layout = dict(zip(names, f['layouts'][i]))
+                    state = ('MT19937', f['keys'][i], int(f['pos'][i]),
+                             int(f['has_gauss'][i]), float(f['cached_gaussian'][i]))
+                    self.records[int(seed)] = (layout, state)
+
+    def get(self, seed):
+        ''' Return a fresh copy of the (layout, random state) stored for seed, or None '''
+        if seed not in self.records:
+            return None
+        layout, state = self.records[seed]
+        return {name: xy.copy() for name, xy in layout.items()}, state
+
+    def put(self, seed, layout, state):
+        ''' Store the layout dict and random state (as from RandomState.get_state()) for seed '''
+        self.records[seed] = ({name: np.array(xy) for name, xy in layout.items()}, state)
+        self.unsaved.add(seed)
+
+    def save(self):
+        ''' Write the records put since the last save to a new file '''
+        if not self.unsaved:
+            return
+        seeds = sorted(self.unsaved)
+        layouts = [self.records[seed][0] for seed in seeds]
+        states = [self.records[seed][1] for seed in seeds]
+        names = list(layouts[0])
+        assert all(list(layout) == names for layout in layouts), 'Layouts place different objects'
+        path = os.path.join(self.directory, f'{self.prefix}-{seeds[0]}-{seeds[-1]}.npz')
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f,
+                         seeds=np.array(seeds, dtype=np.int64),
+                         names=np.array(names),
+                         layouts=np.array([[layout[name] for name in names] for layout in layouts]),
+                         keys=np.array([state[1] for state in states], dtype=np.uint32),
+                         pos=np.array([state[2] for state in states]),
+                         has_gauss=np.array([state[3] for state in states]),
+                         cached_gaussian=np.array([state[4] for state in states]))
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.unsaved.clear()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import warnings
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+
+from safe_rl_envs.envs.engine import Engine
+
+
+class EngineSlots:
+    '''
+    Reset and step one environment at a time, writing its results to row i of shared arrays.
+
+    Classes using it set envs (indexable by environment), num_envs, seeds (N,) int
+    and the result arrays obs, final_obs, reward, cost and done described in VectorEngine.
+    '''
+    def reset_env(self, i):
+        ''' Reset environment i to its next episode and write its observation '''
+        self.seeds[i] += self.num_envs
+        env = self.envs[i]
+        env._seed = int(self.seeds[i]) - 1  # reset() increments the seed first
+        self.obs[i] = env.reset()
+
+    def step_env(self, i, action):
+        ''' Step environment i, writing its results and resetting it when done '''
+        obs, reward, done, info = self.envs[i].step(action)
+        self.reward[i] = reward
+        self.cost[i] = info.get('cost', info.get('cost_exception', 0.0))
+        self.done[i] = done
+        if done:
+            self.final_obs[i] = obs
+            self.reset_env(i)
+        else:
+            self.obs[i] = obs
+
+
+class VectorEngine(EngineSlots):
+    '''
+    N Engines built from one config, stepped together in a thread pool.
+
+    MuJoCo releases the GIL while it simulates, so the physics of different
+    environments overlaps.  Results are written to preallocated arrays that are
+    reused by every call: obs (N, obs_dim) float32, reward and cost (N,) float32
+    and done (N,) bool.  Copy them if they are needed past the next step() or reset().
+
+    Environments that are done are reset right away, so step() returns the first
+    observation of their next episode; the last observation of the finished
+    episode is in final_obs.  Episode k of environment i uses seed
+    seed + i + k * N, which does not depend on the other environments.
+    '''
+    def __init__(self, config, num_envs, num_threads=None, seed=None):
+        config = dict(config, observation_flatten=True, observation_copy=False)
+        if seed is None:
+            seed = config.get('_seed')
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.num_envs = num_envs
+        self.envs = [Engine(config) for _ in range(num_envs)]
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.seeds = seed + np.arange(num_envs) - num_envs  # Seed of the current episode of each env
+        self.pool = ThreadPoolExecutor(num_threads or num_envs)
+
+        obs_dim = self.observation_space.shape[0]
+        self.obs = np.zeros((num_envs, obs_dim), dtype=np.float32)
+        self.final_obs = np.zeros((num_envs, obs_dim), dtype=np.float32)
+        self.reward = np.zeros(num_envs, dtype=np.float32)
+        self.cost = np.zeros(num_envs, dtype=np.float32)
+        self.done = np.zeros(num_envs, dtype=bool)
+
+    def run(self, fn, *args):
+        ''' Call fn(i, *args[i]) for every environment in the thread pool '''
+        futures = [self.pool.submit(fn, i, *(a[i] for a in args)) for i in range(self.num_envs)]
+        for future in futures:
+            future.result()  # Raise any exception
+
+    def reset(self):
+        ''' Reset all environments, returning obs (N, obs_dim) '''
+        self.run(self.reset_env)
+        self.done[:] = False
+        return self.obs
+
+    def step(self, actions):
+        ''' Step all environments with actions (N, act_dim), returning obs, reward, cost and done '''
+        actions = np.asarray(actions)
+        assert actions.shape == (self.num_envs,) + self.action_space.shape, f'Bad actions shape {actions.shape}'
+        self.run(self.step_env, actions)
+        return self.obs, self.reward, self.cost, self.done
+
+    def close(self):
+        ''' Shut down the thread pool and close the environments '''
+        self.pool.shutdown()
+        for env in self.envs:
+            env.close()
+
+
+class SubprocVectorEngine:
+    '''
+    N Engines built from one config, stepped by worker processes.
+
+    Every worker owns a contiguous slice of the environments.  Actions and all
+    results live in shared memory blocks, with the same arrays and auto-reset as
+    VectorEngine, so only a short command and its acknowledgement go through the
+    pipe of a worker on every step.  Seeds follow VectorEngine as well: episode k
+    of environment i uses seed + i + k * N.  The seed of the current episode of
+    every environment is kept in shared memory too.
+
+    A worker that raises or dies is replaced by a new process.  Its environments
+    are reset to their next episodes, and done is set for them with a zero reward
+    and cost.
+    '''
+    def __init__(self, config, num_envs, num_workers=None, seed=None, start_method=None):
+        config = dict(config, observation_flatten=True, observation_copy=False)
+        if seed is None:
+            seed = config.get('_seed')
+        if seed is None:
+            seed = np.random.randint(2**31)
+        probe = Engine(config)
+        self.observation_space = probe.observation_space
+        self.action_space = probe.action_space
+        probe.close()
+        self.config = config
+        self.num_envs = num_envs
+        self.context = multiprocessing.get_context(start_method)
+
+        obs_dim = self.observation_space.shape[0]
+        self.specs = {  # Name: (shape, dtype) of the shared arrays
+            'actions': ((num_envs,) + self.action_space.shape, np.float64),
+            'obs': ((num_envs, obs_dim), np.float32),
+            'final_obs': ((num_envs, obs_dim), np.float32),
+            'reward': ((num_envs,), np.float32),
+            'cost': ((num_envs,), np.float32),
+            'done': ((num_envs,), bool),
+            'seeds': ((num_envs,), np.int64),
+        }
+        self.blocks = {}
+        self.workers = []
+        try:
+            for name, (shape, dtype) in self.specs.items():
+                size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                self.blocks[name] = shared_memory.SharedMemory(create=True, size=size)
+                setattr(self, name, np.ndarray(shape, dtype, buffer=self.blocks[name].buf))
+            self.seeds[:] = seed + np.arange(num_envs) - num_envs
+
+            num_workers = min(num_workers or multiprocessing.cpu_count(), num_envs)
+            self.slices = [list(s) for s in np.array_split(np.arange(num_envs), num_workers)]
+            for w in range(num_workers):
+                self.workers.append(self.start_worker(w))
+        except BaseException:
+            self.close()  # Stop the workers that started and unlink the shared memory
+            raise
+
+    def start_worker(self, w):
+        ''' Start the process for worker w, returning (process, pipe) '''
+        conn, worker_conn = self.context.Pipe()
+        names = {name: block.name for name, block in self.blocks.items()}
+        process = self.context.Process(target=subproc_worker, daemon=True,
+                                       args=(worker_conn, self.config, self.slices[w], self.specs, names))
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def wait(self, w):
+        ''' Wait for the reply of worker w, returning None on success or the reason it failed '''
+        process, conn = self.workers[w]
+        try:
+            while not conn.poll(0.1):
+                if not process.is_alive():
+                    return f'exit code {process.exitcode}'
+            status, message = conn.recv()
+        except (EOFError, OSError) as e:
+            return repr(e)
+        return message if status == 'error' else None
+
+    def respawn(self, w, reason):
+        ''' Replace worker w and move its environments to their next episodes '''
+        warnings.warn(f'Vector engine worker {w} failed ({reason}), respawning', RuntimeWarning)
+        process, conn = self.workers[w]
+        process.kill()
+        process.join()
+        conn.close()
+        self.workers[w] = self.start_worker(w)
+        indices = self.slices[w]
+        self.final_obs[indices] = self.obs[indices]
+        self.workers[w][1].send(('reset', None))
+        reason = self.wait(w)
+        if reason is not None:
+            raise RuntimeError(f'Vector engine worker {w} failed to reset: {reason}')
+        self.reward[indices] = 0
+        self.cost[indices] = 0
+        self.done[indices] = True
+
+    def run(self, command):
+        ''' Send command to all workers and wait for them, respawning those that fail '''
+        failed = {}
+        for w, (_, conn) in enumerate(self.workers):
+            try:
+                conn.send((command, None))
+            except OSError as e:
+                failed[w] = repr(e)
+        for w in range(len(self.workers)):
+            reason = failed.get(w) or self.wait(w)
+            if reason is not None:
+                self.respawn(w, reason)
+
+    def reset(self):
+        ''' Reset all environments, returning obs (N, obs_dim) '''
+        self.run('reset')
+        self.done[:] = False
+        return self.obs
+
+    def step(self, actions):
+        ''' Step all environments with actions (N, act_dim), returning obs, reward, cost and done '''
+        actions = np.asarray(actions)
+        assert actions.shape == (self.num_envs,) + self.action_space.shape, f'Bad actions shape {actions.shape}'
+        self.actions[:] = actions
+        self.run('step')
+        return self.obs, self.reward, self.cost, self.done
+
+    def close(self):
+        ''' Stop the workers and free the shared memory '''
+        for process, conn in self.workers:
+            try:
+                conn.send(('close', None))
+            except OSError:
+                pass
+        for process, conn in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+            conn.close()
+        self.workers = []
+        for name, block in self.blocks.items():
+            setattr(self, name, None)
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+class SubprocWorkerEngines(EngineSlots):
+    ''' The environments of one SubprocVectorEngine worker, writing to the shared arrays '''
+    def __init__(self, config, indices, arrays):
+        self.num_envs = len(arrays['seeds'])
+        self.indices = indices
+        self.envs = {i: Engine(config) for i in indices}
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def reset(self):
+        for i in self.indices:
+            self.reset_env(i)
+
+    def step(self):
+        for i in self.indices:
+            self.step_env(i, self.actions[i])
+
+
+def subproc_worker(conn, config, indices, specs, names):
+    ''' Body of a SubprocVectorEngine worker process: run the commands that come in through conn '''
+    blocks = {name: shared_memory.SharedMemory(name=names[name]) for name in specs}
+    arrays = {name: np.ndarray(shape, dtype, buffer=blocks[name].buf) for name, (shape, dtype) in specs.items()}
+    engines = SubprocWorkerEngines(config, indices, arrays)
+    while True:
+        command, _ = conn.recv()
+        if command == 'close':
+            break
+        try:
+            getattr(engines, command)()
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+        else:
+            conn.send(('ok', None))
+    del engines, arrays
+    for block in blocks.values():
+        block.close()
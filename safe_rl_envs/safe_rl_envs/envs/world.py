@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
 import os
+import re
+import hashlib
+import functools
+import tempfile
+import threading
 import xmltodict
 import numpy as np
-from copy import deepcopy
-from collections import OrderedDict
+from xml.etree import ElementTree
+from copy import copy, deepcopy
+from collections import OrderedDict, defaultdict
 import mujoco
 import safe_rl_envs
 import sys
@@ -17,6 +23,9 @@ Tools that allow the Engine to interface to MuJoCo.
 # Default location to look for /xmls folder:
 BASE_DIR = os.path.dirname(safe_rl_envs.__file__)
 
+# Parts of the simulation state saved by World.get_state(): everything mj_step depends on
+STATE_SPEC = mujoco.mjtState.mjSTATE_INTEGRATION
+
 
 def convert(v):
     ''' Convert a value into a string for mujoco XML '''
@@ -31,6 +40,351 @@ def rot2quat(theta):
     return np.array([np.cos(theta / 2), 0, 0, np.sin(theta / 2)], dtype='float64')
 
 
+class ModelCache:
+    '''
+    Least recently used cache of compiled models, keyed by World.structure_key().
+
+    Models are copied in and out, so worlds can move bodies around in their own
+    model without affecting the cached one.
+    '''
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        ''' Return a copy of the cached model for key, or None on a miss '''
+        with self.lock:
+            if key not in self.models:
+                return None
+            self.models.move_to_end(key)
+            return copy(self.models[key])
+
+    def put(self, key, model):
+        ''' Store a copy of model under key, evicting the least recently used one if full '''
+        with self.lock:
+            self.models[key] = copy(model)
+            self.models.move_to_end(key)
+            while len(self.models) > self.maxsize:
+                self.models.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+# Compiled models shared by all worlds in this process
+MODEL_CACHE = ModelCache()
+
+
+class DiskModelCache:
+    '''
+    Directory of binary MuJoCo models (.mjb) shared between processes.
+
+    Entries are named by a hash of the text that produced the model (the XML
+    and anything else that affects the compile) and the MuJoCo version that
+    compiled it.  Entries written by a different MuJoCo version are removed
+    when they are found.  Files are written to a temporary name and then
+    renamed, so concurrent processes never read a partial model.
+
+    The cache is disabled when directory is None.
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def path(self, key):
+        ''' Return the path of the entry for key and the prefix shared by all its versions '''
+        prefix = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f'{prefix}-{mujoco.__version__}.mjb'), prefix
+
+    def get(self, key):
+        ''' Load the model cached for key, or None on a miss '''
+        if self.directory is None:
+            return None
+        path, prefix = self.path(key)
+        if not os.path.exists(path):
+            # Drop stale entries compiled by other MuJoCo versions
+            for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+                if name.startswith(prefix + '-'):
+                    self.remove(os.path.join(self.directory, name))
+            return None
+        try:
+            return mujoco.MjModel.from_binary_path(path)
+        except Exception:
+            self.remove(path)  # Unreadable entry, recompile and overwrite it
+            return None
+
+    def put(self, key, model):
+        ''' Save model under key '''
+        if self.directory is None:
+            return
+        path, _ = self.path(key)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            mujoco.mj_saveModel(model, tmp_path, None)
+            os.replace(tmp_path, path)
+        except Exception:
+            self.remove(tmp_path)
+            raise
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Compiled models shared between processes, enabled by setting SAFE_RL_ENVS_MODEL_CACHE to a directory
+DISK_MODEL_CACHE = DiskModelCache(os.environ.get('SAFE_RL_ENVS_MODEL_CACHE'))
+
+# Version of the scenes World.build() writes to the disk cache.  Bump it when a change to the
+# code in this file changes the model compiled for a config, so stale entries are not loaded.
+# Changes to the XML templates, robot XMLs and their asset files are picked up by the key.
+MODEL_CACHE_VERSION = 1
+
+
+def xml_files(xml_string, directory, dirs=None):
+    '''
+    Return the paths of the files an MJCF XML string reads: its includes (recursively)
+    and the mesh, texture, height field and skin files of its assets.
+
+    Relative paths are resolved against directory and the meshdir, texturedir and
+    assetdir of the compiler, like the MuJoCo compiler does.
+    '''
+    dirs = {} if dirs is None else dirs
+    files = []
+    for element in ElementTree.fromstring(xml_string).iter():
+        if element.tag == 'compiler':
+            dirs.update({k: v for k, v in element.attrib.items() if k in ('meshdir', 'texturedir', 'assetdir')})
+        file = element.get('file')
+        if file is None:
+            continue
+        if element.tag == 'include':
+            path = os.path.join(directory, file)
+            files.append(path)
+            with open(path) as f:
+                files += xml_files(f.read(), directory, dirs)
+        else:
+            subdir = dirs.get('texturedir' if element.tag == 'texture' else 'meshdir', dirs.get('assetdir', ''))
+            files.append(os.path.join(directory, subdir, file))
+    return files
+
+
+def files_hash(paths):
+    ''' Hash of the paths and contents of files (a missing file hashes by its path alone) '''
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode() + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            digest.update(b'missing')
+    return digest.hexdigest()
+
+
+def load_model_xml_path(path):
+    ''' Compile the XML file at path, going through the disk cache '''
+    with open(path) as f:
+        xml = f.read()
+    # The key covers the XML and every file it includes or loads assets from
+    key = '\n'.join([path, xml, files_hash(xml_files(xml, os.path.dirname(path)))])
+    model = DISK_MODEL_CACHE.get(key)
+    if model is None:
+        model = mujoco.MjModel.from_xml_path(path)
+        DISK_MODEL_CACHE.put(key, model)
+    return model
+
+
+# Scene fragments for the objects, mocaps and geoms added by World.build()
+# (written the way xmltodict.unparse() would write them into the scene)
+OBJECT_TEMPLATE = (
+    '<body name="{name}" pos="{pos}" quat="{quat}">'
+    '<freejoint name="{name}"></freejoint>'
+    '<geom name="{name}" type="{type}" size="{size}" density="{density}" rgba="{rgba}" group="{group}"></geom>'
+    '</body>')
+BOX_OBJECT_TEMPLATES = {
+    'box': (
+        '<body name="{name}" pos="{pos}" quat="{quat}">'
+        '<freejoint name="{name}"></freejoint>'
+        '<geom name="{name}" type="{type}" size="{size}" density="{density}" rgba="{rgba}" group="{group}"></geom>'
+        '<geom name="col1" type="{type}" size="{width} {width} {dim}" density="{density}" rgba="{rgba}" '
+        'group="{group}" pos="{x} {y} 0"></geom>'
+        '<geom name="col2" type="{type}" size="{width} {width} {dim}" density="{density}" rgba="{rgba}" '
+        'group="{group}" pos="-{x} {y} 0"></geom>'
+        '<geom name="col3" type="{type}" size="{width} {width} {dim}" density="{density}" rgba="{rgba}" '
+        'group="{group}" pos="{x} -{y} 0"></geom>'
+        '<geom name="col4" type="{type}" size="{width} {width} {dim}" density="{density}" rgba="{rgba}" '
+        'group="{group}" pos="-{x} -{y} 0"></geom>'
+        '</body>'),
+    'sphere': (
+        '<body name="{name}" pos="{pos}" quat="{quat}">'
+        '<freejoint name="{name}"></freejoint>'
+        '<geom name="{name}" type="{type}" size="{size}" density="{density}" rgba="{rgba}" group="{group}" '
+        'friction="1 0.005 0.05"></geom>'
+        '</body>'),
+}
+MOCAP_TEMPLATE = (
+    '<body name="{name}" mocap="true">'
+    '<geom name="{name}" type="{type}" size="{size}" rgba="{rgba}" pos="{pos}" quat="{quat}" '
+    'contype="0" conaffinity="0" group="{group}"></geom>'
+    '</body>')
+WELD_TEMPLATE = '<weld name="{name}" body1="{body1}" body2="{body2}" solref=".02 5"></weld>'
+GEOM_TEMPLATE = (
+    '<body name="{name}" pos="{pos}" quat="{quat}">'
+    '<geom name="{name}" type="{type}" size="{size}" rgba="{rgba}" group="{group}" '
+    'contype="{contype}" conaffinity="{conaffinity}"></geom>'
+    '</body>')
+
+# Scenes in the disk cache depend on the fragments above
+TEMPLATES_HASH = hashlib.sha256(repr((OBJECT_TEMPLATE, sorted(BOX_OBJECT_TEMPLATES.items()), MOCAP_TEMPLATE,
+                                      WELD_TEMPLATE, GEOM_TEMPLATE)).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def scene_hash(robot_base, floor_size):
+    ''' Hash of the scene XML for a robot base and the contents of the files it reads, once per process '''
+    template = scene_template(robot_base, floor_size)
+    xml = template.format_map(defaultdict(str))  # Empty fields, which read no files
+    files = xml_files(xml, os.path.dirname(os.path.join(BASE_DIR, robot_base)))
+    return hashlib.sha256(template.encode()).hexdigest() + files_hash(files)
+
+
+@functools.lru_cache(maxsize=None)
+def scene_template(robot_base, floor_size):
+    '''
+    Return the scene XML for a robot base as a format string.
+
+    The base XML is parsed and extended with assets, light, floor and cameras
+    once per process.  The fields robot_pos, robot_quat, track_pos, track_xyaxes,
+    bodies and welds are filled in by World.build().
+    '''
+    # Read in the base XML (contains robot, camera, floor, etc)
+    with open(os.path.join(BASE_DIR, robot_base)) as f:
+        xml = xmltodict.parse(f.read())  # Nested OrderedDict objects
+
+    # Convenience accessor for xml dictionary
+    worldbody = xml['mujoco']['worldbody']
+
+    # Move robot position to starting position
+    worldbody['body']['@pos'] = '@@robot_pos@@'
+    worldbody['body']['@quat'] = '@@robot_quat@@'
+
+    # We need this because xmltodict skips over single-item lists in the tree
+    worldbody['body'] = [worldbody['body']]
+    if 'geom' in worldbody:
+        worldbody['geom'] = [worldbody['geom']]
+    else:
+        worldbody['geom'] = []
+
+    # Add equality section if missing
+    if 'equality' not in xml['mujoco']:
+        xml['mujoco']['equality'] = OrderedDict()
+    equality = xml['mujoco']['equality']
+    if 'weld' not in equality:
+        equality['weld'] = []
+
+    # Add asset section if missing
+    
+    # <texture type="skybox" builtin="gradient" rgb1="0.527 0.582 0.906" rgb2="0.1 0.1 0.35"
+    #     width="800" height="800" markrgb="1 1 1" mark="random" random="0.001"/>
+    
+    asset = xmltodict.parse(f'''
+        <asset>
+            <texture name="texplane" builtin="checker" height="100" width="100"
+                rgb1="0.7 0.7 0.7" rgb2="0.8 0.8 0.8" type="2d"/>
+            <material name="MatPlane" reflectance="0.1" shininess="0.1" specular="0.1"
+                texrepeat="10 10" texture="texplane"/>
+            <texture name="texplane2" builtin="checker" height="100" width="100"
+                rgb1="0.8 0.8 0.8" rgb2="0.6 0.6 0.6" type="2d"/>
+            <texture name="my_texture" type="2d" file="xmls/image.png"/>
+            <texture type="skybox" builtin="gradient" rgb1="0.1 0.1 0.6" rgb2="0. 0. 0.2"
+                width="800" height="800" markrgb="1 1 1" mark="random" random="0.0"/>
+            <material name="MatPlane2" reflectance="0.3" shininess=".1" specular=".1"
+                texrepeat="2 2" texture="my_texture"/>
+        </asset>
+        ''')
+    xml_path = os.path.dirname(os.path.join(BASE_DIR, robot_base))
+    if 'asset' in xml['mujoco']:
+        for key, item in xml['mujoco']['asset'].items(): 
+            if isinstance(item, list) == 0:
+                item = [item]
+            for i in item:
+                if '@file' in i.keys():
+                    path = i['@file']
+                    if key == 'mesh':
+                        new_path = os.path.join(xml_path, xml['mujoco']['compiler']['@meshdir'], path)
+                    if key == 'texture':
+                        new_path = os.path.join(xml_path, xml['mujoco']['compiler']['@texturedir'], path)
+                    i['@file'] = new_path
+    else:
+        xml['mujoco']['asset'] = {}
+    
+    for key, item in asset['asset'].items(): 
+        if isinstance(item, list) == 0:
+            item = [item]
+        for i in item:
+            if '@file' in i.keys():
+                path = i['@file']
+                new_path = os.path.join(BASE_DIR, path)
+                i['@file'] = new_path
+        if key in xml['mujoco']['asset'].keys():
+            item2 = xml['mujoco']['asset'][key]
+            if isinstance(item2, list) == 0:
+                item2 = [item2]
+            for i in item2:
+                item.append(i)
+        xml['mujoco']['asset'][key] = item
+
+
+    # Add light to the XML dictionary
+    light = xmltodict.parse('''<b>
+        <light cutoff="100" diffuse="1 1 1" dir="0 0 -1" directional="true"
+            exponent="1" pos="0 0 0.5" specular="0 0 0" castshadow="false"/>
+        </b>''')
+    worldbody['light'] = light['b']['light']
+
+    # Add floor to the XML dictionary if missing
+    if not any(g.get('@name') == 'floor' for g in worldbody['geom']):
+        floor = xmltodict.parse('''
+            <geom name="floor" type="plane" condim="6"/>
+            ''')
+        worldbody['geom'].append(floor['geom'])
+
+    # Make sure floor renders the same for every world
+    for g in worldbody['geom']:
+        if g['@name'] == 'floor':
+            g.update({'@size': convert(floor_size), '@rgba': '1 1 1 1', '@material': 'MatPlane2'})
+
+    # Add cameras to the XML dictionary
+    cameras = xmltodict.parse('''<b>
+        <camera name="fixednear" pos="0 -2 2" zaxis="0 -1 1"/>
+        <camera name="fixedfar" pos="0 -5 5" zaxis="0 -1 1"/>
+        </b>''')
+    worldbody['camera'] = cameras['b']['camera']
+
+    # Build and add a tracking camera (logic needed to ensure orientation correct)
+    track_camera = xmltodict.parse('''<b>
+        <camera name="track" mode="track" pos="@@track_pos@@" xyaxes="@@track_xyaxes@@"/>
+        </b>''')
+    worldbody['body'][0]['camera'] = [
+        worldbody['body'][0]['camera'],
+        track_camera['b']['camera']
+        ]
+
+    # Placeholders for the bodies and welds of the objects, mocaps and geoms
+    worldbody['body'].append({'@name': '@@bodies@@'})
+    equality['weld'].append({'@name': '@@welds@@'})
+
+    template = xmltodict.unparse(xml)
+    template = template.replace('<body name="@@bodies@@"></body>', '@@bodies@@')
+    template = template.replace('<weld name="@@welds@@"></weld>', '@@welds@@')
+    template = template.replace('{', '{{').replace('}', '}}')
+    return re.sub(r'@@(\w+)@@', r'{\1}', template)
+
+
 class World:
     # Default configuration (this should not be nested since it gets copied)
     # *NOTE:* Changes to this configuration should also be reflected in `Engine` configuration
@@ -50,6 +404,9 @@ class World:
 
         # Determine whether we create render contexts
         'observe_vision': False,
+
+        # Reuse the compiled model on rebuild when only positions and rotations changed
+        'build_in_place': True,
     }
 
     def __init__(self, config={}, render_context=None):
@@ -60,6 +417,12 @@ class World:
         self.render_context = render_context
         self.update_viewer_sim = False
         self.robot = Robot(self.robot_base)
+        self.model = None
+        self.data = None
+        self.structure = None
+        self.body_id_cache = {}  # Body ids by name, for the current model
+        self.model_constants = {}  # Values users derive from the current model, see set_model()
+        self.dirty = True  # Whether data changed since the last forward()
 
     def parse(self, config):
         ''' Parse a config dict - see self.DEFAULT for description '''
@@ -77,241 +440,228 @@ class World:
 
     def build(self):
         ''' Build a world, including generating XML and moving objects '''
-        # Read in the base XML (contains robot, camera, floor, etc)
-        self.robot_base_path = os.path.join(BASE_DIR, self.robot_base)
-        with open(self.robot_base_path) as f:
-            self.robot_base_xml = f.read()
-        self.xml = xmltodict.parse(self.robot_base_xml)  # Nested OrderedDict objects
-
-        # Convenience accessor for xml dictionary
-        worldbody = self.xml['mujoco']['worldbody']
-
-        # Move robot position to starting position
-        worldbody['body']['@pos'] = convert(np.r_[self.robot_xy, self.robot.z_height])
-        worldbody['body']['@quat'] = convert(rot2quat(self.robot_rot))
-
-        # We need this because xmltodict skips over single-item lists in the tree
-        worldbody['body'] = [worldbody['body']]
-        if 'geom' in worldbody:
-            worldbody['geom'] = [worldbody['geom']]
-        else:
-            worldbody['geom'] = []
-
-        # Add equality section if missing
-        if 'equality' not in self.xml['mujoco']:
-            self.xml['mujoco']['equality'] = OrderedDict()
-        equality = self.xml['mujoco']['equality']
-        if 'weld' not in equality:
-            equality['weld'] = []
-
-        # Add asset section if missing
-        
-        # <texture type="skybox" builtin="gradient" rgb1="0.527 0.582 0.906" rgb2="0.1 0.1 0.35"
-        #     width="800" height="800" markrgb="1 1 1" mark="random" random="0.001"/>
-        
-        asset = xmltodict.parse(f'''
-            <asset>
-                <texture name="texplane" builtin="checker" height="100" width="100"
-                    rgb1="0.7 0.7 0.7" rgb2="0.8 0.8 0.8" type="2d"/>
-                <material name="MatPlane" reflectance="0.1" shininess="0.1" specular="0.1"
-                    texrepeat="10 10" texture="texplane"/>
-                <texture name="texplane2" builtin="checker" height="100" width="100"
-                    rgb1="0.8 0.8 0.8" rgb2="0.6 0.6 0.6" type="2d"/>
-                <texture name="my_texture" type="2d" file="xmls/image.png"/>
-                <texture type="skybox" builtin="gradient" rgb1="0.1 0.1 0.6" rgb2="0. 0. 0.2"
-                    width="800" height="800" markrgb="1 1 1" mark="random" random="0.0"/>
-                <material name="MatPlane2" reflectance="0.3" shininess=".1" specular=".1"
-                    texrepeat="2 2" texture="my_texture"/>
-            </asset>
-            ''')
-        xml_path = os.path.dirname(os.path.join(BASE_DIR, self.robot_base))
-        if 'asset' in self.xml['mujoco']:
-            for key, item in self.xml['mujoco']['asset'].items(): 
-                if isinstance(item, list) == 0:
-                    item = [item]
-                for i in item:
-                    if '@file' in i.keys():
-                        path = i['@file']
-                        if key == 'mesh':
-                            new_path = os.path.join(xml_path, self.xml['mujoco']['compiler']['@meshdir'], path)
-                        if key == 'texture':
-                            new_path = os.path.join(xml_path, self.xml['mujoco']['compiler']['@texturedir'], path)
-                        i['@file'] = new_path
-        else:
-            self.xml['mujoco']['asset'] = {}
-        
-        for key, item in asset['asset'].items(): 
-            if isinstance(item, list) == 0:
-                item = [item]
-            for i in item:
-                if '@file' in i.keys():
-                    path = i['@file']
-                    new_path = os.path.join(BASE_DIR, path)
-                    i['@file'] = new_path
-            if key in self.xml['mujoco']['asset'].keys():
-                item2 = self.xml['mujoco']['asset'][key]
-                if isinstance(item2, list) == 0:
-                    item2 = [item2]
-                for i in item2:
-                    item.append(i)
-            self.xml['mujoco']['asset'][key] = item
-
-
-        # Add light to the XML dictionary
-        light = xmltodict.parse('''<b>
-            <light cutoff="100" diffuse="1 1 1" dir="0 0 -1" directional="true"
-                exponent="1" pos="0 0 0.5" specular="0 0 0" castshadow="false"/>
-            </b>''')
-        worldbody['light'] = light['b']['light']
-
-        # Add floor to the XML dictionary if missing
-        if not any(g.get('@name') == 'floor' for g in worldbody['geom']):
-            floor = xmltodict.parse('''
-                <geom name="floor" type="plane" condim="6"/>
-                ''')
-            worldbody['geom'].append(floor['geom'])
-
-        # Make sure floor renders the same for every world
-        for g in worldbody['geom']:
-            if g['@name'] == 'floor':
-                g.update({'@size': convert(self.floor_size), '@rgba': '1 1 1 1', '@material': 'MatPlane2'})
-
-        # Add cameras to the XML dictionary
-        cameras = xmltodict.parse('''<b>
-            <camera name="fixednear" pos="0 -2 2" zaxis="0 -1 1"/>
-            <camera name="fixedfar" pos="0 -5 5" zaxis="0 -1 1"/>
-            </b>''')
-        worldbody['camera'] = cameras['b']['camera']
-
-        # Build and add a tracking camera (logic needed to ensure orientation correct)
-        theta = self.robot_rot
-        xyaxes = dict(
-                    x1=np.cos(theta), 
-                    x2=-np.sin(theta),
-                    x3=0,
-                    y1=np.sin(theta),
-                    y2=np.cos(theta),
-                    y3=1
-                    )
-        pos = dict(
-                xp=0*np.cos(theta) + (-2)*np.sin(theta),
-                yp=0*(-np.sin(theta)) + (-2)*np.cos(theta),
-                zp=2
-                )
-        track_camera = xmltodict.parse('''<b>
-            <camera name="track" mode="track" pos="{xp} {yp} {zp}" xyaxes="{x1} {x2} {x3} {y1} {y2} {y3}"/>
-            </b>'''.format(**pos, **xyaxes))
-        worldbody['body'][0]['camera'] = [
-            worldbody['body'][0]['camera'],
-            track_camera['b']['camera']
-            ]
-
-
-        # Add objects to the XML dictionary
+        # Worlds with the same structure only differ in positions, so start from a cached model
+        self.structure = self.structure_key()
+        if self.build_in_place:
+            model = MODEL_CACHE.get(self.structure)
+            if model is not None:
+                self.set_model(model)
+                self.relocate()
+                return
+            # Otherwise another process may already have compiled a model with this structure
+            model = DISK_MODEL_CACHE.get(self.scene_key())
+            if model is not None:
+                MODEL_CACHE.put(self.structure, model)
+                self.set_model(model)
+                self.relocate()
+                return
+
+        # Fill in the scene template for this robot base
+        bodies = []
+        welds = []
+        # Add objects
         for name, object in self.objects.items():
             assert object['name'] == name, f'Inconsistent {name} {object}'
             object = object.copy()  # don't modify original object
             object['quat'] = rot2quat(object['rot'])
-            if name=='box':
-                type = object['type']
-                if type == 'box':
+            template = OBJECT_TEMPLATE
+            if name == 'box':
+                if object['type'] == 'box':
                     dim = object['size'][0]
                     object['dim'] = dim
                     object['width'] = dim/2
                     object['x'] = dim
                     object['y'] = dim
-                    body = xmltodict.parse('''
-                        <body name="{name}" pos="{pos}" quat="{quat}">
-                            <freejoint name="{name}"/>
-                            <geom name="{name}" type="{type}" size="{size}" density="{density}"
-                                rgba="{rgba}" group="{group}"/>
-                            <geom name="col1" type="{type}" size="{width} {width} {dim}" density="{density}"
-                                rgba="{rgba}" group="{group}" pos="{x} {y} 0"/>
-                            <geom name="col2" type="{type}" size="{width} {width} {dim}" density="{density}"
-                                rgba="{rgba}" group="{group}" pos="-{x} {y} 0"/>
-                            <geom name="col3" type="{type}" size="{width} {width} {dim}" density="{density}"
-                                rgba="{rgba}" group="{group}" pos="{x} -{y} 0"/>
-                            <geom name="col4" type="{type}" size="{width} {width} {dim}" density="{density}"
-                                rgba="{rgba}" group="{group}" pos="-{x} -{y} 0"/>
-                        </body>
-                    '''.format(**{k: convert(v) for k, v in object.items()}))
-                if type == 'sphere':
-                    body = xmltodict.parse('''
-                        <body name="{name}" pos="{pos}" quat="{quat}">
-                            <freejoint name="{name}"/>
-                            <geom name="{name}" type="{type}" size="{size}" density="{density}"
-                                rgba="{rgba}" group="{group}" friction="1 0.005 0.05"/>
-                        </body>
-                    '''.format(**{k: convert(v) for k, v in object.items()}))              
-            else:
-                body = xmltodict.parse('''
-                    <body name="{name}" pos="{pos}" quat="{quat}">
-                        <freejoint name="{name}"/>
-                        <geom name="{name}" type="{type}" size="{size}" density="{density}"
-                            rgba="{rgba}" group="{group}"/>
-                    </body>
-                '''.format(**{k: convert(v) for k, v in object.items()}))
-            # Append new body to world, making it a list optionally
-            # Add the object to the world
-            worldbody['body'].append(body['body'])
-        # Add mocaps to the XML dictionary
+                template = BOX_OBJECT_TEMPLATES[object['type']]
+            bodies.append(template.format(**{k: convert(v) for k, v in object.items()}))
+        # Add mocaps
         for name, mocap in self.mocaps.items():
             # Mocap names are suffixed with 'mocap'
             assert mocap['name'] == name, f'Inconsistent {name} {object}'
             if 'ghost' not in name and 'robber' not in name:
                 assert name.replace('mocap', 'obj') in self.objects, f'missing object for {name}'
-            # Add the object to the world
             mocap = mocap.copy()  # don't modify original object
             mocap['quat'] = rot2quat(mocap['rot'])
-            body = xmltodict.parse('''
-                <body name="{name}" mocap="true">
-                    <geom name="{name}" type="{type}" size="{size}" rgba="{rgba}"
-                        pos="{pos}" quat="{quat}" contype="0" conaffinity="0" group="{group}"/>
-                </body>
-            '''.format(**{k: convert(v) for k, v in mocap.items()}))
-            worldbody['body'].append(body['body'])
+            bodies.append(MOCAP_TEMPLATE.format(**{k: convert(v) for k, v in mocap.items()}))
             # Add weld to equality list
             mocap['body1'] = name
             mocap['body2'] = name.replace('mocap', 'obj')
             if mocap['body2'] in self.objects:
-                weld = xmltodict.parse('''
-                    <weld name="{name}" body1="{body1}" body2="{body2}" solref=".02 5"/>
-                '''.format(**{k: convert(v) for k, v in mocap.items()}))
-                equality['weld'].append(weld['weld'])
-        # Add geoms to XML dictionary
+                welds.append(WELD_TEMPLATE.format(**{k: convert(v) for k, v in mocap.items()}))
+        # Add geoms
         for name, geom in self.geoms.items():
             assert geom['name'] == name, f'Inconsistent {name} {geom}'
             geom = geom.copy()  # don't modify original object
             geom['quat'] = rot2quat(geom['rot'])
             geom['contype'] = geom.get('contype', 1)
             geom['conaffinity'] = geom.get('conaffinity', 1)
-            body = xmltodict.parse('''
-                <body name="{name}" pos="{pos}" quat="{quat}">
-                    <geom name="{name}" type="{type}" size="{size}" rgba="{rgba}" group="{group}"
-                        contype="{contype}" conaffinity="{conaffinity}"/>
-                </body>
-            '''.format(**{k: convert(v) for k, v in geom.items()}))
-            # Append new body to world, making it a list optionally
-            # Add the object to the world
-            worldbody['body'].append(body['body'])
+            bodies.append(GEOM_TEMPLATE.format(**{k: convert(v) for k, v in geom.items()}))
+
+        # Build a tracking camera (logic needed to ensure orientation correct)
+        theta = self.robot_rot
+        track_xyaxes = [np.cos(theta), -np.sin(theta), 0, np.sin(theta), np.cos(theta), 1]
+        track_pos = [0*np.cos(theta) + (-2)*np.sin(theta), 0*(-np.sin(theta)) + (-2)*np.cos(theta), 2]
+
+        self.xml_string = scene_template(self.robot_base, convert(self.floor_size)).format(
+            robot_pos=convert(np.r_[self.robot_xy, self.robot.z_height]),
+            robot_quat=convert(rot2quat(self.robot_rot)),
+            track_pos=' '.join(str(v) for v in track_pos),
+            track_xyaxes=' '.join(str(v) for v in track_xyaxes),
+            bodies=''.join(bodies),
+            welds=''.join(welds))
 
         # Instantiate simulator
-        self.xml_string = xmltodict.unparse(self.xml)
-        self.model = mujoco.MjModel.from_xml_string(self.xml_string)
-        self.data = mujoco.MjData(self.model)
+        self.set_model(mujoco.MjModel.from_xml_string(self.xml_string))
+        if self.build_in_place:
+            MODEL_CACHE.put(self.structure, self.model)
+            DISK_MODEL_CACHE.put(self.scene_key(), self.model)
 
         # Recompute simulation intrinsics from new position
-        mujoco.mj_forward(self.model, self.data)
+        self.mark_dirty()
+        self.forward()
+
+    def set_model(self, model):
+        '''
+        Switch to a newly compiled or loaded model with fresh data.  Everything cached
+        from the old model (body ids and model_constants) is dropped here, and only here:
+        relocate() moves bodies but keeps ids, sizes and masses.
+        '''
+        self.model = model
+        self.data = mujoco.MjData(model)
+        self.body_id_cache = {}
+        self.model_constants = {}
+
+    def structure_key(self):
+        '''
+        Return a hashable description of everything in the config that ends up
+        in the compiled model, except for positions and rotations.
+
+        Two configs with the same key compile to the same model up to the
+        placement of the robot, objects, mocaps and geoms.
+        '''
+        key = [self.robot_base, convert(self.floor_size)]
+        for section in (self.objects, self.mocaps, self.geoms):
+            for name, item in section.items():
+                key.append((name, tuple((k, convert(v)) for k, v in sorted(item.items())
+                                        if k not in ('pos', 'rot'))))
+            key.append(None)  # Section separator
+        return tuple(key)
+
+    def scene_key(self):
+        '''
+        Key of the compiled scene in the disk cache: the cache version, the MuJoCo
+        version, hashes of the scene XML for the robot base, of the files it reads
+        and of the object templates, and the structure.
+        '''
+        return '\n'.join([f'v{MODEL_CACHE_VERSION}', mujoco.__version__,
+                          scene_hash(self.robot_base, convert(self.floor_size)), TEMPLATES_HASH, repr(self.structure)])
+
+    def relocate(self):
+        '''
+        Move the robot, objects, mocaps and geoms of the already compiled model
+        to the positions and rotations of the current config.
+
+        This writes the poses the XML compiler would have produced: body poses, free
+        joint qpos0, the track camera, mocap geom poses and weld relative poses.  It then
+        recomputes the qpos0-dependent constants and resets the data.  The inertial frame
+        of a mocap body is put at its geom pose, where the compiler may pick other
+        principal axes (and round the position differently); mocap bodies are not
+        simulated, so this does not change any rollout.
+        '''
+        model = self.model
+
+        def quat(rot):
+            q = rot2quat(rot)
+            mujoco.mju_normalize4(q)  # Matches the normalization done by the compiler
+            return q
+
+        def place_body(body_id, pos, q):
+            model.body_pos[body_id] = pos
+            model.body_quat[body_id] = q
+            # Free joints start at the body pose
+            jnt_id = model.body_jntadr[body_id]
+            if model.body_jntnum[body_id] and model.jnt_type[jnt_id] == mujoco.mjtJoint.mjJNT_FREE:
+                adr = model.jnt_qposadr[jnt_id]
+                model.qpos0[adr:adr + 7] = np.r_[pos, q]
+                model.qpos_spring[adr:adr + 7] = np.r_[pos, q]
+
+        # Robot and its tracking camera (see build() for the camera orientation)
+        place_body(model.body('robot').id, np.r_[self.robot_xy, self.robot.z_height], quat(self.robot_rot))
+        theta = self.robot_rot
+        cam_id = model.camera('track').id
+        model.cam_pos[cam_id] = [-2 * np.sin(theta), -2 * np.cos(theta), 2]
+        x_axis = np.array([np.cos(theta), -np.sin(theta), 0])
+        y_axis = np.array([np.sin(theta), np.cos(theta), 1]) / np.sqrt(2)
+        cam_mat = np.stack([x_axis, y_axis, np.cross(x_axis, y_axis)], axis=1)
+        mujoco.mju_mat2Quat(model.cam_quat[cam_id], cam_mat.flatten())
+
+        for name, object in self.objects.items():
+            place_body(model.body(name).id, object['pos'], quat(object['rot']))
+        for name, mocap in self.mocaps.items():
+            # Mocap bodies stay at the origin, their geom carries the pose
+            geom_id = model.geom(name).id
+            body_id = model.body(name).id
+            model.geom_pos[geom_id] = mocap['pos']
+            model.geom_quat[geom_id] = quat(mocap['rot'])
+            model.body_ipos[body_id] = mocap['pos']
+            model.body_iquat[body_id] = model.geom_quat[geom_id]
+        for name, geom in self.geoms.items():
+            place_body(model.body(name).id, geom['pos'], quat(geom['rot']))
+
+        # Welds keep the relative pose of their bodies at qpos0
+        for eq_id in range(model.neq):
+            if model.eq_type[eq_id] != mujoco.mjtEq.mjEQ_WELD:
+                continue
+            body1, body2 = model.eq_obj1id[eq_id], model.eq_obj2id[eq_id]
+            neg_quat1 = np.zeros(4)
+            mujoco.mju_negQuat(neg_quat1, model.body_quat[body1])
+            mujoco.mju_rotVecQuat(model.eq_data[eq_id, 3:6],
+                                  model.body_pos[body2] - model.body_pos[body1], neg_quat1)
+            mujoco.mju_mulQuat(model.eq_data[eq_id, 6:10], neg_quat1, model.body_quat[body2])
+
+        mujoco.mj_setConst(model, self.data)
+        mujoco.mj_resetData(model, self.data)
+        self.mark_dirty()
+        self.forward()
 
     def rebuild(self, config={}, state=True):
         ''' Build a new sim from a model if the model changed '''
         if state:
             old_state = self.get_state()
         self.parse(config)
-        self.build()
+        if self.build_in_place and self.model is not None and self.structure_key() == self.structure:
+            self.relocate()
+        else:
+            self.build()
         if state:
             self.set_state(old_state)
-        mujoco.mj_forward(self.model, self.data)
+            self.mark_dirty()
+        self.forward()
+
+    def get_state(self):
+        ''' Return the simulation state (time, qpos, qvel, act, controls, mocaps, warmstart, ...) as a flat array '''
+        state = np.empty(mujoco.mj_stateSize(self.model, STATE_SPEC))
+        mujoco.mj_getState(self.model, self.data, state, STATE_SPEC)
+        return state
+
+    def set_state(self, state):
+        ''' Restore a simulation state from get_state() '''
+        mujoco.mj_setState(self.model, self.data, np.asarray(state, dtype=np.float64), STATE_SPEC)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        '''
+        Record that the model or the state (qpos, qvel, mocap, ...) changed,
+        so the next forward() has to recompute derived quantities.
+        Call this after changing model or data outside of World.
+        '''
+        self.dirty = True
+
+    def forward(self):
+        ''' Recompute positions, contacts and sensors, unless nothing changed since the last call '''
+        if self.dirty:
+            mujoco.mj_forward(self.model, self.data)
+            self.dirty = False
 
     def reset(self, build=True):
         ''' Reset the world (sim is accessed through self) '''
@@ -336,17 +686,27 @@ class World:
         ''' Get the velocity of the robot in the simulator world reference frame '''
         return self.body_vel('robot')
 
+    def body_id(self, name):
+        ''' Get the id of a named body, cached until the model changes '''
+        if name not in self.body_id_cache:
+            self.body_id_cache[name] = self.model.body(name).id
+        return self.body_id_cache[name]
+
+    def body_ids(self, names):
+        ''' Get an int array of the ids of named bodies '''
+        return np.array([self.body_id(name) for name in names], dtype=int)
+
     def body_com(self, name):
         ''' Get the center of mass of a named body in the simulator world reference frame '''
-        return self.data.subtree_com[self.data.body(name).id].copy()
+        return self.data.subtree_com[self.body_id(name)].copy()
 
     def body_pos(self, name):
         ''' Get the position of a named body in the simulator world reference frame '''
-        return self.data.body(name).xpos.copy()
+        return self.data.xpos[self.body_id(name)].copy()
 
     def body_mat(self, name):
         ''' Get the rotation matrix of a named body in the simulator world reference frame '''
-        return self.data.body(name).xmat.copy().reshape(3,3)
+        return self.data.xmat[self.body_id(name)].reshape(3,3).copy()
 
     def body_vel(self, name):
         ''' Get the velocity of a named body in the simulator world reference frame '''
@@ -362,7 +722,7 @@ class Robot:
     ''' Simple utility class for getting mujoco-specific info about a robot '''
     def __init__(self, path):
         base_path = os.path.join(BASE_DIR, path)
-        self.model = mujoco.MjModel.from_xml_path(base_path)
+        self.model = load_model_xml_path(base_path)
         self.data = mujoco.MjData(self.model)
         mujoco.mj_forward(self.model, self.data)
 
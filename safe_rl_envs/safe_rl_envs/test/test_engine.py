@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
+import os
+import tempfile
 import unittest
 import numpy as np
 import gym.spaces
+import mujoco
 
-from  safe_rl_envs.envs.engine import Engine
+from  safe_rl_envs.envs.engine import Engine, quat2mat, GEOM_OTHER, GEOM_VASE, GEOM_BUTTON, GEOM_GHOST, GEOM_GHOST3D
 
 
 class TestEngine(unittest.TestCase):
@@ -32,6 +35,317 @@ class TestEngine(unittest.TestCase):
         self.assertIsInstance(p.observation_space, gym.spaces.Dict)
         self.assertTrue(p.observation_space.contains(obs))
 
+    def test_obs_buffer(self):
+        ''' Flat and dict observations should be float32 slices of one buffer '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 2, 'observe_hazards': True,
+                  'observe_goal_lidar': True, 'observation_check': True, '_seed': 0}
+        flat = Engine(dict(config, observation_flatten=True))
+        nested = Engine(dict(config, observation_flatten=False))
+        obs, obs_dict = flat.reset(), nested.reset()
+        self.assertEqual(obs.dtype, np.float32)
+        np.testing.assert_array_equal(obs, np.concatenate([obs_dict[k].ravel() for k in sorted(obs_dict)]))
+        # Copies by default, the buffer itself otherwise
+        self.assertIsNot(obs, flat.obs_buffer)
+        flat.observation_copy = False
+        self.assertIs(flat.obs(), flat.obs_buffer)
+        nested.observation_copy = False
+        self.assertTrue(np.shares_memory(nested.obs()['hazards_lidar'], nested.obs_buffer))
+
+    def test_sensor_plan(self):
+        ''' Gathered sensors should match reading them one at a time '''
+        for robot_base, angle_components in [('xmls/ant.xml', True), ('xmls/car.xml', True), ('xmls/car.xml', False)]:
+            p = Engine({'robot_base': robot_base, 'observation_flatten': False,
+                        'sensors_angle_components': angle_components, '_seed': 0})
+            p.reset()
+            p.step(p.action_space.high)
+            obs = p.obs()
+            for sensor in p.sensors_obs + p.robot.hinge_vel_names + p.robot.ballangvel_names:
+                np.testing.assert_array_equal(obs[sensor], p.world.get_sensor(sensor).astype(np.float32))
+            for sensor in p.robot.hinge_pos_names:
+                theta = p.world.get_sensor(sensor)
+                expected = np.r_[np.sin(theta), np.cos(theta)] if angle_components else theta
+                np.testing.assert_array_equal(obs[sensor], expected.astype(np.float32))
+            for sensor in p.robot.ballquat_names:
+                quat = p.world.get_sensor(sensor)
+                expected = quat2mat(quat) if angle_components else quat
+                np.testing.assert_array_equal(obs[sensor], expected.astype(np.float32))
+
+    def test_vases_cost(self):
+        ''' Vase displacement and velocity costs should match summing over vases one at a time '''
+        p = Engine({'robot_base': 'xmls/point.xml', 'vases_num': 2, 'constrain_vases': True,
+                    'vases_displace_cost': 1.0, 'constrain_indicator': False, 'robot_locations': [(0, 0)],
+                    'robot_rot': 0, 'robot_keepout': 0.1, 'vases_keepout': 0.1,
+                    'vases_locations': [(0.4, 0), (0.6, 0.1)], 'goal_locations': [(-1.5, -1.5)], '_seed': 0})
+        p.reset()
+        moved = False
+        for _ in range(40):
+            _, _, _, info = p.step([1, 0])
+            displace, velocity = 0, 0
+            for i, body_id in enumerate(p.body_ids('vase')):
+                dist = np.sqrt(np.sum(np.square(p.data.xpos[body_id][:2] - p.reset_layout[f'vase{i}'])))
+                if dist > p.vases_displace_threshold:
+                    displace += dist * p.vases_displace_cost
+                res = np.zeros(6)
+                mujoco.mj_objectVelocity(p.model, p.data, mujoco.mjtObj.mjOBJ_BODY, body_id, res, 0)
+                vel = np.sqrt(np.sum(np.square(res[3:])))
+                if vel >= p.vases_velocity_threshold:
+                    velocity += vel * p.vases_velocity_cost
+            self.assertEqual(info['cost_vases_displace'], displace)
+            self.assertAlmostEqual(info['cost_vases_velocity'], velocity, places=12)
+            moved = moved or displace > 0
+        self.assertTrue(moved)
+
+    def test_spatial_index(self):
+        ''' Culling with the spatial index should not change observations, rewards or costs '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 60, 'hazards_size': 0.3, 'hazards_keepout': 0.32,
+                  'ghosts_num': 15, 'ghosts_size': 0.1, 'ghosts_keepout': 0.12, 'constrain_hazards': True,
+                  'constrain_ghosts': True, 'observe_hazards': True, 'observe_ghosts': True, 'lidar_max_dist': 3,
+                  'placements_extents': [-5, -5, 5, 5], 'constrain_indicator': False, '_seed': 0}
+        culled = Engine(dict(config, spatial_index=True))
+        reference = Engine(config)
+        np.testing.assert_array_equal(culled.reset(), reference.reset())
+        rs = np.random.RandomState(0)
+        cost = 0
+        for _ in range(150):
+            action = np.r_[1, 0.3] + rs.uniform(-0.2, 0.2, 2)
+            obs, reward, done, info = culled.step(action)
+            obs_ref, reward_ref, done_ref, info_ref = reference.step(action)
+            np.testing.assert_array_equal(obs, obs_ref)
+            self.assertEqual(reward, reward_ref)
+            self.assertEqual(info, info_ref)
+            cost += info['cost']
+        self.assertGreater(cost, 0)
+
+    def test_state(self):
+        ''' Rollouts from a restored state should repeat exactly, and states only fit their own episode '''
+        p = Engine({'robot_base': 'xmls/point.xml', 'task': 'button', 'buttons_num': 3, 'ghosts_num': 3,
+                    'hazards_num': 4, 'constrain_hazards': True, 'observe_hazards': True, 'observe_ghosts': True,
+                    'observe_buttons': True, 'action_noise': 0.1, 'frameskip_binom_p': 0.5, '_seed': 0})
+        p.reset()
+        rs = np.random.RandomState(0)
+        for _ in range(10):
+            p.step(rs.uniform(-1, 1, 2))
+        state = p.get_state()
+        self.assertEqual(state.dtype, np.float64)
+        actions = rs.uniform(-1, 1, (30, 2))
+        for _ in range(2):
+            p.set_state(state)
+            steps = [p.step(action) for action in actions]
+            p.set_state(state)
+            for action, (obs, reward, done, info) in zip(actions, steps):
+                obs_again, reward_again, done_again, info_again = p.step(action)
+                np.testing.assert_array_equal(obs, obs_again)
+                self.assertEqual((reward, done, info), (reward_again, done_again, info_again))
+        p.reset()
+        with self.assertRaises(ValueError):
+            p.set_state(state)
+
+    def test_step_many(self):
+        ''' Stepping many actions at once should match stepping them one at a time '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 4, 'hazards_size': 0.5, 'constrain_hazards': True,
+                  'constrain_indicator': False, 'observe_hazards': True, 'num_steps': 25, '_seed': 0}
+        actions = np.random.RandomState(0).uniform(-1, 1, (40, 2))
+        for mode in ['final', 'all']:
+            p, reference = Engine(config), Engine(config)
+            p.reset()
+            reference.reset()
+            steps = []
+            for action in actions:
+                steps.append(reference.step(action))
+                if reference.done:
+                    break
+            result = p.step_many(actions, mode=mode)
+            costs = np.array([info['cost'] for _, _, _, info in steps])
+            np.testing.assert_array_equal(result[2 if mode == 'all' else 3], costs)
+            self.assertEqual(result[-2 if mode == 'all' else -1], 24)
+            if mode == 'final':
+                obs, reward, cost = result[:3]
+                np.testing.assert_array_equal(obs, steps[-1][0])
+                self.assertEqual(reward, sum(r for _, r, _, _ in steps))
+                self.assertEqual(cost, sum(costs.tolist()))
+            else:
+                observations, rewards, _, _, infos = result
+                np.testing.assert_array_equal(observations, [o for o, _, _, _ in steps])
+                np.testing.assert_array_equal(rewards, [r for _, r, _, _ in steps])
+                self.assertEqual(infos, [info for _, _, _, info in steps])
+
+    def test_geom_tables(self):
+        ''' Geoms should be categorized by name, with ghost3Ds apart from ghosts '''
+        p = Engine({'robot_base': 'xmls/point.xml', 'task': 'button', 'buttons_num': 2,
+                    'vases_num': 1, 'ghosts_num': 1, 'ghost3Ds_num': 1, '_seed': 0})
+        p.reset()
+        category, robot, button = p.geom_tables()
+        for name, c in [('vase0', GEOM_VASE), ('button1', GEOM_BUTTON), ('ghost0mocap', GEOM_GHOST),
+                        ('ghost3D0mocap', GEOM_GHOST3D), ('floor', GEOM_OTHER)]:
+            self.assertEqual(category[p.model.geom(name).id], c)
+        self.assertEqual(button[p.model.geom('button1').id], 1)
+        self.assertEqual(button[p.model.geom('vase0').id], -1)
+        self.assertTrue(robot[p.model.geom('robot').id])
+        self.assertFalse(robot[p.model.geom('floor').id])
+        # Tables are only rebuilt for a new model
+        self.assertIs(p.geom_tables()[0], category)
+
+    def test_placements_batch(self):
+        ''' Drawing placements in blocks should find the same layouts and leave the same random state '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 20, 'hazards_keepout': 0.3,
+                  'vases_num': 3, 'vases_placements': [(-2, -2, 0, 0), (0, 0, 2, 2)], '_seed': 0}
+        batch = Engine(dict(config, placements_batch=True))
+        single = Engine(dict(config, placements_batch=False))
+        for seed in range(5):
+            for p in (batch, single):
+                p.rs = np.random.RandomState(seed)
+                p.build_layout()
+            self.assertEqual(list(batch.layout), list(single.layout))
+            for name, xy in single.layout.items():
+                np.testing.assert_array_equal(batch.layout[name], xy)
+            self.assertEqual(batch.rs.random_sample(), single.rs.random_sample())
+
+    def test_layout_store(self):
+        ''' Resets from a filled layout store should match resets that sample their layouts '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 8, 'observe_hazards': True,
+                  'constrain_hazards': True, 'observe_goal_lidar': True}
+        with tempfile.TemporaryDirectory() as directory:
+            Engine(dict(config, layout_store_dir=directory)).fill_layout_store(range(1, 4))
+            self.assertEqual(len(os.listdir(directory)), 1)
+            stored = Engine(dict(config, layout_store_dir=directory, _seed=0))
+            self.assertEqual(sorted(stored.layout_store.records), [1, 2, 3])
+            sampled = Engine(dict(config, _seed=0))
+            for _ in range(3):
+                np.testing.assert_array_equal(stored.reset(), sampled.reset())
+                self.assertEqual(list(stored.layout), list(sampled.layout))
+                np.testing.assert_array_equal(stored.rs.random_sample(), sampled.rs.random_sample())
+            # Another configuration does not share the records
+            other = Engine(dict(config, hazards_num=4, layout_store_dir=directory))
+            self.assertEqual(other.layout_store.records, {})
+            # Options that do not change the layouts share them
+            faster = Engine(dict(config, layout_store_dir=directory, prefetch_reset=True, observation_copy=False,
+                                 mocaps_decimation=2, vision_size=(30, 20)))
+            self.assertEqual(sorted(faster.layout_store.records), [1, 2, 3])
+        # Long arrays are keyed in full
+        walls = np.zeros((1001, 2))
+        moved = walls.copy()
+        moved[500] = 1
+        self.assertNotEqual(Engine(dict(config, walls_locations=walls)).layout_store_key(),
+                            Engine(dict(config, walls_locations=moved)).layout_store_key())
+
+    def test_build_precheck(self):
+        ''' Layouts rejected before building should have a starting cost, and resets should not change '''
+        config = {'robot_base': 'xmls/point.xml', 'task': 'goal', 'hazards_num': 8, 'hazards_size': 1.3,
+                  'constrain_hazards': True, 'observe_hazards': True, '_seed': 0}
+        p = Engine(dict(config, build_precheck=False))
+        p.reset()
+        rejected = 0
+        for seed in range(20):
+            p.rs = np.random.RandomState(seed)
+            p.clear()
+            p.build()
+            if p.layout_has_starting_cost():
+                rejected += 1
+                self.assertGreater(p.cost()['cost'], 0)
+        self.assertGreater(rejected, 0)
+        checked = Engine(dict(config, build_precheck=True))
+        built = Engine(dict(config, build_precheck=False))
+        for _ in range(3):
+            np.testing.assert_array_equal(checked.reset(), built.reset())
+            np.testing.assert_array_equal(checked.goal_pos, built.goal_pos)
+
+    def test_prefetch_reset(self):
+        ''' Episodes built in the background should match episodes built on reset '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 4, 'observe_hazards': True,
+                  'constrain_hazards': True, 'observe_goal_lidar': True, '_seed': 0}
+        prefetched = Engine(dict(config, prefetch_reset=True))
+        reference = Engine(config)
+        action = np.ones(reference.action_space.shape) * 0.5
+        for _ in range(3):
+            np.testing.assert_array_equal(prefetched.reset(), reference.reset())
+            for _ in range(5):
+                obs, reward, done, info = prefetched.step(action)
+                obs_ref, reward_ref, done_ref, info_ref = reference.step(action)
+                np.testing.assert_array_equal(obs, obs_ref)
+                self.assertEqual(reward, reward_ref)
+                self.assertEqual(info, info_ref)
+        self.assertIsNot(prefetched.world, prefetched.prefetch_engine.world)
+        self.assertTrue(prefetched.prefetch_reset)
+        # Worlds alternate between the engines, and each keeps its tables
+        tables = {id(w): w.model_constants['geom_tables'] for w in (prefetched.world, prefetched.prefetch_engine.world)}
+        prefetched.reset()
+        reference.reset()
+        self.assertIs(prefetched.world.model_constants['geom_tables'], tables[id(prefetched.world)])
+        # Only the episode is swapped in, the engine keeps its own buffers and caches
+        obs_buffer, renderers = prefetched.obs_buffer, prefetched.renderers
+        prefetched.reset()
+        reference.reset()
+        self.assertIs(prefetched.obs_buffer, obs_buffer)
+        self.assertIs(prefetched.renderers, renderers)
+        self.assertIsNot(prefetched.obs_buffer, prefetched.prefetch_engine.obs_buffer)
+        # Changing the seed drops the prefetched episode
+        prefetched.seed(10)
+        reference.seed(10)
+        np.testing.assert_array_equal(prefetched.reset(), reference.reset())
+        prefetched.close()
+        self.assertIsNone(prefetched.prefetch_engine)
+
+    def test_prefetch_reset_3D(self):
+        ''' Heights of 3D objects and goals are drawn per seed, so prefetching does not change them '''
+        config = {'robot_base': 'xmls/point.xml', 'task': 'goal', 'goal_3D': True, 'goal_z_range': [0.5, 1.5],
+                  'ghost3Ds_num': 2, 'ghost3Ds_z_range': [0.5, 1.5], 'hazard3Ds_num': 2,
+                  'hazard3Ds_z_range': [0.5, 1.5], 'observe_ghost3Ds': True, 'observe_hazard3Ds': True, '_seed': 0}
+        prefetched = Engine(dict(config, prefetch_reset=True))
+        reference = Engine(config)
+        for _ in range(3):
+            np.testing.assert_array_equal(prefetched.reset(), reference.reset())
+            np.testing.assert_array_equal(prefetched.data.xpos, reference.data.xpos)
+        prefetched.close()
+
+    def test_simulate(self):
+        ''' Fused physics steps should match stepping one at a time, setting the mocaps before each step '''
+        for config in [{'hazards_num': 4}, {'ghosts_num': 3, 'gremlins_num': 2}]:
+            fused = Engine(dict(config, robot_base='xmls/point.xml', _seed=0))
+            single = Engine(dict(config, robot_base='xmls/point.xml', _seed=0))
+            fused.reset()
+            single.reset()
+            for nstep in [0, 1, 7]:
+                fused.data.ctrl[:] = single.data.ctrl[:] = 0.5
+                fused.simulate(nstep)
+                for _ in range(nstep):
+                    single.set_mocaps()
+                    mujoco.mj_step(single.model, single.data)
+                np.testing.assert_array_equal(fused.data.qpos, single.data.qpos)
+                np.testing.assert_array_equal(fused.data.mocap_pos, single.data.mocap_pos)
+        # Decimated mocaps only move every few steps
+        p = Engine({'robot_base': 'xmls/point.xml', 'ghosts_num': 2, 'mocaps_decimation': 4, '_seed': 0})
+        p.reset()
+        calls = []
+        p.set_mocaps = lambda: calls.append(p.data.time)
+        p.simulate(10)
+        self.assertEqual(len(calls), 3)
+
+    def test_render(self):
+        ''' Offscreen renderers should be reused across frames and resets, and leave the physics alone '''
+        try:
+            mujoco.Renderer(mujoco.MjModel.from_xml_string('<mujoco/>'), 16, 16).close()
+        except Exception as e:  # Failed to create a GL context, see MUJOCO_GL
+            self.skipTest(f'Offscreen rendering is not available: {e}')
+        p = Engine({'robot_base': 'xmls/point.xml', 'hazards_num': 2, 'observe_vision': True,
+                    'vision_size': (24, 16), 'observation_flatten': False, '_seed': 0})
+        obs = p.reset()
+        self.assertEqual(obs['vision'].shape, (16, 24, 3))
+        time, qpos = p.data.time, p.data.qpos.copy()
+        frame = p.render('rgb_array', width=64, height=48)
+        self.assertEqual(frame.shape, (48, 64, 3))
+        self.assertEqual(p.data.time, time)
+        np.testing.assert_array_equal(p.data.qpos, qpos)
+        renderers = dict(p.renderers)
+        p.render('rgb_array', width=64, height=48)
+        p.reset()
+        p.render('rgb_array', width=64, height=48)
+        self.assertEqual(p.renderers, renderers)
+        # Another frame size replaces the renderer rather than adding one
+        self.assertEqual(p.render('rgb_array', width=32, height=24).shape, (24, 32, 3))
+        self.assertEqual(len(p.renderers), 2)
+        p.close()
+        self.assertEqual(p.renderers, {})
+
     def test_angle_components(self):
         ''' Test that the angle components are about correct '''
         p = Engine({'robot_base': 'xmls/doggo.xml',
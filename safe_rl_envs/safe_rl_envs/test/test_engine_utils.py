@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+import mujoco
+
+from  safe_rl_envs.envs.engine_utils import pseudo_lidar, pseudo_lidar3D, compass, mocap_repulsion, \
+    distLinSeg, distLinSegBatch, capsule_dist, quat2mat_batch, \
+    mocap_repulsion_pairs, UniformGrid
+
+
+def pseudo_lidar_loop(positions, robot_pos, robot_mat, num_bins, max_dist, exp_gain, alias):
+    ''' Reference implementation, one position at a time '''
+    obs = np.zeros(num_bins)
+    for pos in positions:
+        pos_3vec = np.concatenate([pos[:2], [0]])
+        z = complex(*np.matmul(pos_3vec - robot_pos, robot_mat)[:2])
+        dist = np.abs(z)
+        angle = np.angle(z) % (np.pi * 2)
+        bin_size = (np.pi * 2) / num_bins
+        bin = int(angle / bin_size)
+        if max_dist is None:
+            sensor = np.exp(-exp_gain * dist)
+        else:
+            sensor = max(0, max_dist - dist) / max_dist
+        obs[bin] = max(obs[bin], sensor)
+        if alias:
+            a = (angle - bin_size * bin) / bin_size
+            obs[(bin + 1) % num_bins] = max(obs[(bin + 1) % num_bins], a * sensor)
+            obs[(bin - 1) % num_bins] = max(obs[(bin - 1) % num_bins], (1 - a) * sensor)
+    return obs
+
+
+def pseudo_lidar3D_loop(positions, body_pos, body_mat, num_bins, num_bins3D, max_dist, exp_gain, alias):
+    ''' Reference implementation, one body and position at a time '''
+    obs = np.zeros((len(body_pos), num_bins, num_bins3D))
+    for b in range(len(body_pos)):
+        for pos in positions:
+            x, y, z = np.matmul(pos - body_pos[b], body_mat[b])
+            proj_xy = complex(x, y)
+            angle_xy = np.angle(proj_xy) % (np.pi * 2)
+            bin_size_xy = (np.pi * 2) / num_bins
+            bin_xy = int(angle_xy / bin_size_xy)
+            proj_z = complex(np.abs(proj_xy), z)
+            dist_z = np.abs(proj_z)
+            angle_z = np.angle(proj_z) + np.pi / 2
+            bin_size_z = np.pi / num_bins3D
+            bin_z = int(angle_z / bin_size_z)
+            if max_dist is None:
+                sensor = np.exp(-exp_gain * dist_z)
+            else:
+                sensor = max(0, max_dist - dist_z) / max_dist
+            updates = [(bin_xy, bin_z, sensor)]
+            if alias:
+                a_xy = (angle_xy - bin_size_xy * bin_xy) / bin_size_xy
+                a_z = (angle_z - bin_size_z * bin_z) / bin_size_z
+                updates += [((bin_xy + 1) % num_bins, bin_z, a_xy * sensor),
+                            ((bin_xy - 1) % num_bins, bin_z, (1 - a_xy) * sensor),
+                            (bin_xy, min(bin_z + 1, num_bins3D - 1), a_z * sensor),
+                            (bin_xy, max(bin_z - 1, 0), (1 - a_z) * sensor)]
+            for i, j, v in updates:
+                obs[b, i, j] = max(obs[b, i, j], v)
+    return obs
+
+
+class TestEngineUtils(unittest.TestCase):
+    def test_pseudo_lidar(self):
+        ''' Vectorized lidar should match the per-position computation exactly '''
+        rs = np.random.RandomState(0)
+        for i in range(200):
+            robot_pos = rs.uniform(-2, 2, 3)
+            robot_mat = np.linalg.qr(rs.randn(3, 3))[0]
+            positions = rs.uniform(-3, 3, (rs.randint(1, 20), rs.choice([2, 3])))
+            args = (robot_pos, robot_mat, 16, rs.choice([None, 3]), 0.5, bool(i % 2))
+            np.testing.assert_array_equal(pseudo_lidar(positions, *args),
+                                          pseudo_lidar_loop(positions, *args))
+
+    def test_pseudo_lidar_empty(self):
+        obs = pseudo_lidar([], np.zeros(3), np.eye(3), 16)
+        np.testing.assert_array_equal(obs, np.zeros(16))
+
+    def random_bodies(self, rs):
+        ''' Random positions (B,3) and rotation matrices (B,3,3) '''
+        b = rs.randint(1, 4)
+        return rs.uniform(-2, 2, (b, 3)), np.array([np.linalg.qr(rs.randn(3, 3))[0] for _ in range(b)])
+
+    def test_pseudo_lidar3D(self):
+        ''' Vectorized 3D lidar should match the per-body, per-position computation exactly '''
+        rs = np.random.RandomState(0)
+        for i in range(200):
+            body_pos, body_mat = self.random_bodies(rs)
+            positions = rs.uniform(-3, 3, (rs.randint(1, 20), 3))
+            args = (body_pos, body_mat, 16, 8, rs.choice([None, 3]), 0.5, bool(i % 2))
+            np.testing.assert_array_equal(pseudo_lidar3D(positions, *args),
+                                          pseudo_lidar3D_loop(positions, *args))
+
+    def test_compass(self):
+        ''' Compass for every body should match the per-body computation exactly '''
+        rs = np.random.RandomState(0)
+        for i in range(100):
+            body_pos, body_mat = self.random_bodies(rs)
+            pos = rs.uniform(-3, 3, rs.choice([2, 3]))
+            shape = rs.choice([2, 3])
+            vec = compass(pos, body_pos, body_mat, shape)
+            for b in range(len(body_pos)):
+                expected = np.matmul(np.r_[pos, 0][:3] - body_pos[b], body_mat[b])[:shape]
+                expected /= np.sqrt(np.sum(np.square(expected))) + 0.001
+                np.testing.assert_array_equal(vec[b], expected)
+
+    def test_mocap_repulsion(self):
+        ''' Repulsion should match summing over close pairs one at a time '''
+        rs = np.random.RandomState(0)
+        for i in range(100):
+            n, d = rs.randint(1, 12), rs.choice([2, 3])
+            pos_last, target = rs.uniform(-1, 1, (n, d)), rs.uniform(-1, 1, (n, d))
+            moved = mocap_repulsion(target, pos_last, 0.3, 0.01)
+            for i in range(n):
+                expected = target[i].copy()
+                for j in range(n):
+                    dist_ij = pos_last[j] - pos_last[i]
+                    if j != i and np.sqrt(np.sum(np.square(dist_ij))) < 0.6:
+                        expected += 0.01 * (- dist_ij / np.sqrt(np.sum(np.square(dist_ij))))
+                np.testing.assert_array_equal(moved[i], expected)
+
+    def test_uniform_grid(self):
+        ''' Grid queries should find every object within the radius, and repulsion over its pairs should not change '''
+        rs = np.random.RandomState(0)
+        grid = UniformGrid(0.5)
+        for _ in range(20):
+            positions = rs.uniform(-4, 4, (rs.randint(1, 60), rs.choice([2, 3])))
+            grid.update(positions)
+            point, radius = rs.uniform(-4, 4, 2), rs.uniform(0, 2)
+            found = grid.query(point, radius)
+            self.assertTrue(np.all(np.diff(found) > 0))
+            near = np.flatnonzero(np.sqrt(np.sum(np.square(positions[:, :2] - point), axis=1)) <= radius)
+            self.assertTrue(set(near) <= set(found))
+            i, j = grid.pairs(0.6)
+            dist = np.sqrt(np.sum(np.square(positions[:, None, :2] - positions[None, :, :2]), axis=-1))
+            close = {(a, b) for a, b in zip(*np.nonzero(dist < 0.6)) if a != b}
+            self.assertTrue(close <= set(zip(i, j)))
+            target = positions + rs.uniform(-0.01, 0.01, positions.shape)
+            np.testing.assert_array_equal(mocap_repulsion_pairs(target, positions, 0.3, 0.01, i, j),
+                                          mocap_repulsion(target, positions, 0.3, 0.01))
+
+    def test_dist_lin_seg_batch(self):
+        ''' Batched segment distances should match distLinSeg, including degenerate and parallel segments '''
+        rs = np.random.RandomState(0)
+        points = rs.randn(400, 4, 3)
+        points[:50, 1] = points[:50, 0]  # First segment is a point
+        points[50:100, 3] = points[50:100, 2]  # Second segment is a point
+        points[100:120, 1], points[100:120, 3] = points[100:120, 0], points[100:120, 2]
+        points[120:170, 3] = points[120:170, 2] + 2 * (points[120:170, 1] - points[120:170, 0])  # Parallel
+        dist, closest1, closest2 = distLinSegBatch(points[:, 0], points[:, 1], points[:, 2], points[:, 3])
+        for i, (p1s, p1e, p2s, p2e) in enumerate(points):
+            expected, closest = distLinSeg(p1s, p1e, p2s, p2e)
+            # np.linalg.norm in distLinSeg may round the last bit differently
+            self.assertAlmostEqual(dist[i], expected, places=12)
+            np.testing.assert_array_equal(closest1[i], closest[:, 0])
+            np.testing.assert_array_equal(closest2[i], closest[:, 1])
+
+    def test_capsule_dist(self):
+        ''' Capsule distances should be point to segment distances minus the radius '''
+        rs = np.random.RandomState(0)
+        links, radii, positions = rs.randn(6, 3), rs.uniform(0.05, 0.1, 6), rs.randn(20, 3)
+        dist = capsule_dist(positions, links[:-1], links[1:], radii[:-1])
+        self.assertEqual(dist.shape, (20, 5))
+        for m, pos in enumerate(positions):
+            for l in range(5):
+                expected = distLinSeg(links[l], links[l + 1], pos, pos)[0] - radii[l]
+                self.assertAlmostEqual(dist[m, l], expected, places=12)
+
+    def test_quat2mat_batch(self):
+        ''' Batched rotation matrices should match mju_quat2Mat exactly '''
+        rs = np.random.RandomState(0)
+        quat = rs.randn(100, 4)
+        quat /= np.sqrt(np.sum(np.square(quat), axis=1, keepdims=True))
+        quat[0] = [1, 0, 0, 0]
+        mat = quat2mat_batch(quat)
+        for q, m in zip(quat, mat):
+            expected = np.zeros(9)
+            mujoco.mju_quat2Mat(expected, q)
+            np.testing.assert_array_equal(m, expected.reshape(3, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
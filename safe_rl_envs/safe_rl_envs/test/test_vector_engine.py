@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import unittest
+from unittest import mock
+from multiprocessing import shared_memory
+import numpy as np
+
+from safe_rl_envs.envs.engine import Engine
+from safe_rl_envs.envs.vector_engine import VectorEngine, SubprocVectorEngine
+
+
+class TestVectorEngine(unittest.TestCase):
+    def test_matches_engines(self):
+        ''' Vector steps with auto-reset should match stepping the engines one by one '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 3, 'observe_hazards': True,
+                  'constrain_hazards': True, 'observe_goal_lidar': True, 'num_steps': 4}
+        n = 3
+        vector = VectorEngine(config, n, seed=10)
+        envs = [Engine(dict(config, _seed=10 + i - 1)) for i in range(n)]
+        obs = vector.reset()
+        self.assertEqual(obs.dtype, np.float32)
+        for i, env in enumerate(envs):
+            np.testing.assert_array_equal(obs[i], env.reset().astype(np.float32))
+        rs = np.random.RandomState(0)
+        for _ in range(10):
+            actions = rs.uniform(-1, 1, (n,) + vector.action_space.shape)
+            obs, reward, cost, done = vector.step(actions)
+            for i, env in enumerate(envs):
+                o, r, d, info = env.step(actions[i])
+                self.assertEqual(done[i], d)
+                self.assertEqual(reward[i], np.float32(r))
+                self.assertEqual(cost[i], np.float32(info['cost']))
+                if d:
+                    np.testing.assert_array_equal(vector.final_obs[i], o.astype(np.float32))
+                    env._seed += n - 1  # Episode k of env i uses seed 10 + i + k * n
+                    o = env.reset()
+                np.testing.assert_array_equal(obs[i], o.astype(np.float32))
+        vector.close()
+
+    def test_subproc_matches_threads(self):
+        ''' Worker processes should step like the thread pool, and replace a worker that died '''
+        config = {'robot_base': 'xmls/point.xml', 'hazards_num': 3, 'observe_hazards': True,
+                  'constrain_hazards': True, 'num_steps': 4}
+        n = 3
+        threads = VectorEngine(config, n, seed=5)
+        procs = SubprocVectorEngine(config, n, num_workers=2, seed=5)
+        np.testing.assert_array_equal(procs.reset(), threads.reset())
+        rs = np.random.RandomState(0)
+        for _ in range(6):
+            actions = rs.uniform(-1, 1, (n,) + threads.action_space.shape)
+            for a, b in zip(procs.step(actions), threads.step(actions)):
+                np.testing.assert_array_equal(a, b)
+            np.testing.assert_array_equal(procs.final_obs[threads.done], threads.final_obs[threads.done])
+        # A dead worker is respawned and its environments start their next episodes
+        seeds = procs.seeds.copy()
+        procs.workers[0][0].kill()
+        with self.assertWarns(RuntimeWarning):
+            obs, reward, cost, done = procs.step(actions)
+        indices = procs.slices[0]
+        self.assertTrue(done[indices].all())
+        np.testing.assert_array_equal(procs.seeds[indices], seeds[indices] + n)
+        procs.step(actions)
+        procs.close()
+        threads.close()
+
+    def test_subproc_start_failure(self):
+        ''' Shared memory should be unlinked when a worker fails to start '''
+        names = []
+        def start_worker(engine, w):
+            names.extend(block.name for block in engine.blocks.values())
+            raise OSError('Cannot start worker')
+        with mock.patch.object(SubprocVectorEngine, 'start_worker', start_worker):
+            with self.assertRaises(OSError):
+                SubprocVectorEngine({'robot_base': 'xmls/point.xml'}, 2)
+        self.assertTrue(names)
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from  safe_rl_envs.envs.world import World, MODEL_CACHE, DISK_MODEL_CACHE, xml_files, files_hash
+
+
+class TestWorld(unittest.TestCase):
+    def world_config(self, seed, hazard_size=0.3):
+        ''' Small world with a robot, a welded mocap object and a fixed geom '''
+        rs = np.random.RandomState(seed)
+        gremlin_xy = rs.uniform(-1, 1, 2)
+        return {
+            'robot_base': 'xmls/car.xml',
+            'robot_xy': rs.uniform(-1, 1, 2),
+            'robot_rot': rs.uniform(0, 2 * np.pi),
+            'objects': {'gremlin0obj': {'name': 'gremlin0obj', 'size': np.ones(3) * 0.1, 'type': 'box',
+                                        'density': 0.001, 'pos': np.r_[gremlin_xy, 0.1],
+                                        'rot': rs.uniform(0, 2 * np.pi), 'group': 5,
+                                        'rgba': np.array([0.5, 0, 1, 1])}},
+            'mocaps': {'gremlin0mocap': {'name': 'gremlin0mocap', 'size': np.ones(3) * 0.1, 'type': 'box',
+                                         'pos': np.r_[gremlin_xy, 0.1], 'rot': rs.uniform(0, 2 * np.pi),
+                                         'group': 5, 'rgba': np.array([0.5, 0, 1, 0.1])}},
+            'geoms': {'hazard0': {'name': 'hazard0', 'size': [hazard_size, 1e-2], 'type': 'cylinder',
+                                  'pos': np.r_[rs.uniform(-1, 1, 2), 2e-2], 'rot': rs.uniform(0, 2 * np.pi),
+                                  'contype': 0, 'conaffinity': 0, 'group': 3,
+                                  'rgba': np.array([0, 0, 1, 0.25])}},
+        }
+
+    def test_relocate(self):
+        ''' Rebuilding with moved objects should match a freshly compiled world '''
+        world = World(self.world_config(0))
+        world.build()
+        model = world.model
+        world.rebuild(self.world_config(1), state=False)
+        self.assertIs(world.model, model)
+        reference = World(self.world_config(1))
+        reference.build()
+        for field in ['body_pos', 'body_quat', 'body_mass', 'qpos0', 'geom_pos', 'geom_quat', 'eq_data',
+                      'cam_pos', 'cam_quat']:
+            np.testing.assert_allclose(getattr(world.model, field), getattr(reference.model, field), atol=1e-12)
+        for field in ['qpos', 'xpos', 'xquat', 'geom_xpos', 'geom_xmat', 'mocap_pos', 'mocap_quat']:
+            np.testing.assert_allclose(getattr(world.data, field), getattr(reference.data, field), atol=1e-12)
+        # Inertial frames match for the simulated bodies (mocap bodies may differ, see relocate())
+        simulated = world.model.body_mocapid < 0
+        np.testing.assert_allclose(world.model.body_ipos[simulated], reference.model.body_ipos[simulated], atol=1e-12)
+        np.testing.assert_allclose(world.model.body_iquat[simulated], reference.model.body_iquat[simulated], atol=1e-12)
+
+    def test_rebuild_structure_change(self):
+        ''' Changing anything but positions should compile a new model '''
+        world = World(self.world_config(0))
+        world.build()
+        model = world.model
+        world.rebuild(self.world_config(1, hazard_size=0.5), state=False)
+        self.assertIsNot(world.model, model)
+        self.assertEqual(world.model.geom('hazard0').size[0], 0.5)
+
+    def test_model_cache(self):
+        ''' Worlds with the same structure should share one compile but not one model '''
+        MODEL_CACHE.clear()
+        world = World(self.world_config(0))
+        world.build()
+        self.assertEqual(len(MODEL_CACHE.models), 1)
+        cached = World(self.world_config(1))
+        cached.build()
+        self.assertEqual(len(MODEL_CACHE.models), 1)
+        self.assertIsNot(cached.model, world.model)
+        reference = World(dict(self.world_config(1), build_in_place=False))
+        reference.build()
+        np.testing.assert_allclose(cached.model.body_pos, reference.model.body_pos, atol=1e-12)
+        np.testing.assert_allclose(cached.data.xpos, reference.data.xpos, atol=1e-12)
+        # Moving bodies in one world must not leak into the other
+        self.assertFalse(np.allclose(world.model.body_pos, cached.model.body_pos))
+
+    def test_body_ids(self):
+        ''' Cached body ids should follow the model when it is recompiled '''
+        world = World(self.world_config(0))
+        world.build()
+        np.testing.assert_array_equal(world.body_pos('gremlin0obj'), world.data.body('gremlin0obj').xpos)
+        ids = world.body_ids(['robot', 'hazard0'])
+        self.assertEqual(list(ids), [world.model.body('robot').id, world.model.body('hazard0').id])
+        config = self.world_config(1)
+        del config['objects'], config['mocaps']
+        world.rebuild(config, state=False)
+        self.assertEqual(world.body_id('hazard0'), world.model.body('hazard0').id)
+        self.assertNotEqual(world.body_id('hazard0'), ids[1])
+
+    def test_forward_dirty(self):
+        ''' forward() should only recompute after the state was marked as changed '''
+        world = World(self.world_config(0))
+        world.build()
+        self.assertFalse(world.dirty)
+        xpos = world.data.xpos.copy()
+        world.data.qpos[:2] += 0.5
+        world.forward()
+        np.testing.assert_array_equal(world.data.xpos, xpos)
+        world.mark_dirty()
+        world.forward()
+        self.assertFalse(np.array_equal(world.data.xpos, xpos))
+
+    def test_scene_xml(self):
+        ''' Every object, mocap, weld and geom should make it into the compiled scene '''
+        config = self.world_config(0)
+        config['objects']['box'] = dict(config['objects']['gremlin0obj'], name='box', type='box')
+        world = World(dict(config, build_in_place=False))
+        world.build()
+        for name in ['box', 'col1', 'col4', 'gremlin0obj', 'gremlin0mocap', 'hazard0', 'floor']:
+            self.assertEqual(world.model.geom(name).name, name)
+        self.assertEqual(world.model.neq, 1)
+        self.assertEqual(world.model.nmocap, 1)
+        self.assertEqual(world.model.cam('track').name, 'track')
+        self.assertEqual(world.xml_string.count('<worldbody>'), 1)
+
+    def test_disk_model_cache(self):
+        ''' A scene loaded from the disk cache should match a freshly compiled one '''
+        with tempfile.TemporaryDirectory() as directory:
+            DISK_MODEL_CACHE.directory = directory
+            try:
+                MODEL_CACHE.clear()
+                World(self.world_config(0)).build()
+                entries = sorted(os.listdir(directory))
+                self.assertTrue(entries and all(e.endswith('.mjb') for e in entries))
+                MODEL_CACHE.clear()
+                cached = World(self.world_config(1))
+                cached.build()
+                # Entries from another MuJoCo version are replaced rather than loaded
+                for entry in entries:
+                    os.replace(os.path.join(directory, entry),
+                               os.path.join(directory, entry.split('-')[0] + '-0.0.0.mjb'))
+                MODEL_CACHE.clear()
+                World(self.world_config(2)).build()
+                self.assertEqual(sorted(os.listdir(directory)), entries)
+            finally:
+                DISK_MODEL_CACHE.directory = None
+                MODEL_CACHE.clear()
+        reference = World(dict(self.world_config(1), build_in_place=False))
+        reference.build()
+        np.testing.assert_allclose(cached.model.body_pos, reference.model.body_pos, atol=1e-12)
+        np.testing.assert_allclose(cached.data.xpos, reference.data.xpos, atol=1e-12)
+
+
+    def test_xml_files(self):
+        ''' Disk cache keys should cover included XML files and the asset files they load '''
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'assets'))
+            files = {'part.xml': '<mujoco><asset><mesh file="m.stl"/></asset></mujoco>',
+                     'assets/m.stl': 'solid', 't.png': 'png'}
+            for name, content in files.items():
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(content)
+            xml = ('<mujoco><compiler meshdir="assets"/><include file="part.xml"/>'
+                   '<asset><texture name="t" type="2d" file="t.png"/></asset></mujoco>')
+            paths = xml_files(xml, directory)
+            self.assertEqual(paths, [os.path.join(directory, name) for name in files])
+            key = files_hash(paths)
+            with open(os.path.join(directory, 'assets/m.stl'), 'w') as f:
+                f.write('solid changed')
+            self.assertNotEqual(files_hash(paths), key)
+
+
+if __name__ == '__main__':
+    unittest.main()